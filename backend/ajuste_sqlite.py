@@ -0,0 +1,341 @@
+"""
+Perfiles de ajuste de SQLite para get_connection() y comando que los compara
+sobre una copia de crm.db con una carga representativa de la API.
+
+    python ajuste_sqlite.py                      # mide todos los perfiles y recomienda uno
+    python ajuste_sqlite.py --perfiles defecto,equilibrado
+    python ajuste_sqlite.py --aplicar            # ademas guarda el mejor (data/sqlite_perfil.json)
+
+El perfil activo es CRM_SQLITE_PERFIL o, si no esta definido, el guardado con
+--aplicar. Las conexiones de la API duran una solicitud, asi que la cache de
+paginas (cache_size) se pierde al cerrar; mmap usa la cache del sistema, que
+comparten todas las conexiones y workers.
+"""
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import database as db
+
+# Perfiles de menor a mayor memoria. cache_size negativo = KiB por conexion;
+# page_size solo cambia con VACUUM (--aplicar); optimizar_cada_seg es el
+# intervalo del ANALYZE acotado (estadisticas para el planificador) que corre
+# el hilo de mantenimiento de cada worker, fuera de las solicitudes
+PERFILES = {
+    'defecto': {},
+    'contenedor_chico': {
+        'mmap_size': 0,
+        'cache_size': -2000,
+        'temp_store': 'FILE',
+        'page_size': 4096,
+        'optimizar_cada_seg': 3600
+    },
+    'equilibrado': {
+        'mmap_size': 64 * 1024 * 1024,
+        'cache_size': -16000,
+        'temp_store': 'MEMORY',
+        'page_size': 4096,
+        'optimizar_cada_seg': 3600
+    },
+    'lectura_intensiva': {
+        'mmap_size': 1024 * 1024 * 1024,
+        'cache_size': -128000,
+        'temp_store': 'MEMORY',
+        'page_size': 8192,
+        'optimizar_cada_seg': 600
+    }
+}
+
+# Filas que examina ANALYZE por indice al optimizar (acota su duracion)
+LIMITE_ANALISIS = 1000
+
+# Con el perfil 'defecto' no se analiza; cada cuanto se vuelve a mirar el perfil activo
+REVISAR_PERFIL_SEG = 3600
+
+# Rondas de medicion: los perfiles se alternan en cada ronda y se toma el
+# mejor tiempo de cada operacion, para no favorecer al que corre con la
+# cache del sistema ya caliente
+RONDAS = 2
+
+# Peso de cada operacion en la carga: la bandeja y el tablero se consultan
+# cada 10 s, el resto por accion del usuario. El puntaje de un perfil es el
+# promedio ponderado de sus tiempos relativos al primer perfil medido
+PESOS = {
+    'get_contactos': 1,
+    'get_contactos_desde': 10,
+    'get_mensajes_agente': 10,
+    'get_metricas': 2,
+    'get_timeline': 2,
+    'buscar_por_telefono': 2,
+    'crear_contacto': 1,
+    'crear_mensaje': 3
+}
+
+# Un perfil de menos memoria se prefiere si esta a menos de este margen del mejor
+MARGEN = 0.05
+
+# Perfil usado por el comando mientras mide (None = el configurado)
+PERFIL_FORZADO = None
+
+_guardado = {}
+# Telefonos de los contactos que crea la carga (unicos entre rondas)
+_telefonos = itertools.count()
+
+
+def ruta_perfil():
+    """El perfil aplicado vive junto a la base principal: data/sqlite_perfil.json."""
+    return os.path.join(os.path.dirname(db.DB_PATH), 'sqlite_perfil.json')
+
+
+def _perfil_guardado():
+    """Nombre guardado con --aplicar; se relee solo si cambia el archivo."""
+    archivo = ruta_perfil()
+    try:
+        version = os.stat(archivo).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _guardado.get('archivo') != archivo or _guardado.get('version') != version:
+        with open(archivo) as f:
+            _guardado.update(archivo=archivo, version=version, perfil=json.load(f)['perfil'])
+    return _guardado['perfil']
+
+
+def perfil_activo():
+    nombre = PERFIL_FORZADO or os.environ.get('CRM_SQLITE_PERFIL') or _perfil_guardado() or 'defecto'
+    if nombre not in PERFILES:
+        raise ValueError(f"Perfil de SQLite desconocido: {nombre}")
+    return nombre
+
+
+def configurar(conn, ruta):
+    """PRAGMAs del perfil activo en una conexion nueva; con 'defecto' no hace nada."""
+    perfil = PERFILES[perfil_activo()]
+    if not perfil:
+        return
+    conn.execute(f"PRAGMA mmap_size = {int(perfil['mmap_size'])}")
+    conn.execute(f"PRAGMA cache_size = {int(perfil['cache_size'])}")
+    conn.execute(f"PRAGMA temp_store = {perfil['temp_store']}")
+
+
+def optimizar():
+    """ANALYZE acotado de cada fragmento. Retorna las bases analizadas."""
+    analizadas = []
+    for ruta in db.rutas():
+        conn = db.get_connection(ruta)
+        try:
+            # PRAGMA optimize no analiza nada antes de SQLite 3.46: ANALYZE acotado
+            conn.execute(f'PRAGMA analysis_limit = {LIMITE_ANALISIS}')
+            conn.execute('ANALYZE')
+            conn.commit()
+            analizadas.append(ruta)
+        except sqlite3.OperationalError as e:
+            # Base ocupada: se intenta en la proxima vuelta
+            print(f"--> AJUSTE: ANALYZE de {ruta} postergado: {e}")
+        finally:
+            conn.close()
+    return analizadas
+
+
+def _bucle():
+    while True:
+        perfil = PERFILES[perfil_activo()]
+        time.sleep(perfil.get('optimizar_cada_seg', REVISAR_PERFIL_SEG))
+        try:
+            if PERFILES[perfil_activo()]:
+                optimizar()
+        except Exception as e:
+            print(f"--> AJUSTE: error optimizando: {e}")
+
+
+def iniciar_en_segundo_plano():
+    """Lanza el ANALYZE periodico del perfil activo (fuera de get_connection)."""
+    hilo = threading.Thread(target=_bucle, name='ajuste_sqlite', daemon=True)
+    hilo.start()
+    return hilo
+
+
+def copiar(origen, destino, page_size=None):
+    """Copia consistente (API de backup); con page_size la reescribe con VACUUM."""
+    fuente = sqlite3.connect(origen)
+    copia = sqlite3.connect(destino)
+    fuente.backup(copia)
+    fuente.close()
+    if page_size and copia.execute('PRAGMA page_size').fetchone()[0] != page_size:
+        copia.execute(f'PRAGMA page_size = {int(page_size)}')
+        copia.execute('VACUUM')
+    copia.close()
+
+
+def _muestras():
+    """Ids reales de la copia para la carga: la bandeja mas grande, un contacto, un telefono."""
+    conn = db.get_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT agente_id FROM mensajes GROUP BY agente_id ORDER BY COUNT(*) DESC LIMIT 1')
+    agente = cursor.fetchone()
+    cursor.execute('SELECT id, telefono, agente_asignado_id FROM contactos ORDER BY id DESC LIMIT 1')
+    contacto = cursor.fetchone()
+    cursor.execute('SELECT MAX(fecha) FROM contactos')
+    ultima = cursor.fetchone()[0]
+    conn.close()
+    if contacto is None:
+        raise ValueError('La base no tiene contactos: no hay carga representativa para medir')
+    return {
+        'agente_id': agente[0] if agente else contacto['agente_asignado_id'],
+        'contacto_id': contacto['id'],
+        'telefono': contacto['telefono'],
+        'desde': ultima
+    }
+
+
+def carga():
+    """(operacion, funcion) de lecturas y escrituras de la API sobre la base actual."""
+    muestras = _muestras()
+    contacto = db.get_contacto(muestras['contacto_id'])
+    return [
+        ('get_contactos', lambda: db.get_contactos()),
+        ('get_contactos_desde', lambda: db.get_contactos(desde=muestras['desde'])),
+        ('get_mensajes_agente', lambda: db.get_mensajes_agente(muestras['agente_id'])),
+        ('get_metricas', db.get_metricas),
+        ('get_timeline', lambda: db.get_timeline(muestras['contacto_id'])),
+        ('buscar_por_telefono', lambda: db.buscar_por_telefono(muestras['telefono'])),
+        ('crear_contacto', lambda: db.crear_contacto(
+            'Ajuste', f'88{next(_telefonos):08d}', contacto['propiedad_id'], contacto['agente_asignado_id'])),
+        # Se agrupa con el pendiente del contacto: escritura de una fila existente
+        ('crear_mensaje', lambda: db.crear_mensaje_plantilla(
+            contacto['id'], contacto['agente_asignado_id'], 'seguimiento')),
+    ]
+
+
+def medir_perfiles(nombres=None, rondas=RONDAS):
+    """
+    {perfil: {'tiempos': {operacion: seg}, 'puntaje': relativo}} sobre copias
+    de la base principal (una por perfil, todas a la vez en un directorio temporal).
+    """
+    import benchmark
+    import cache
+    global PERFIL_FORZADO
+
+    nombres = nombres or list(PERFILES)
+    ruta_original = db.DB_PATH
+    tamano_cache = cache.TAMANO_MAX
+    # Sin cache de entidades: se mide la base
+    cache.TAMANO_MAX = 0
+    directorio = tempfile.mkdtemp(prefix='crm_ajuste_')
+    copias = {}
+    tiempos = {nombre: {} for nombre in nombres}
+    try:
+        for nombre in nombres:
+            copias[nombre] = os.path.join(directorio, nombre, 'crm.db')
+            os.makedirs(os.path.dirname(copias[nombre]))
+            copiar(ruta_original, copias[nombre], PERFILES[nombre].get('page_size'))
+
+        for _ in range(rondas):
+            for nombre in nombres:
+                db.DB_PATH = copias[nombre]
+                PERFIL_FORZADO = nombre
+                for operacion, funcion in carga():
+                    funcion()  # calentar la cache del sistema
+                    segundos, _ = benchmark.medir(funcion)
+                    anterior = tiempos[nombre].get(operacion)
+                    tiempos[nombre][operacion] = segundos if anterior is None else min(anterior, segundos)
+    finally:
+        db.DB_PATH = ruta_original
+        PERFIL_FORZADO = None
+        cache.TAMANO_MAX = tamano_cache
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    referencia = tiempos[nombres[0]]
+    return {
+        nombre: {
+            'tiempos': tiempos[nombre],
+            'puntaje': sum(PESOS[op] * seg / referencia[op] for op, seg in tiempos[nombre].items())
+                       / sum(PESOS.values())
+        }
+        for nombre in nombres
+    }
+
+
+def recomendar(resultados):
+    """El de menor puntaje; uno anterior en PERFILES (menos memoria) si esta dentro de MARGEN."""
+    mejor = min(resultados.values(), key=lambda r: r['puntaje'])['puntaje']
+    return next(nombre for nombre in resultados if resultados[nombre]['puntaje'] <= mejor * (1 + MARGEN))
+
+
+def _page_size(ruta):
+    conn = sqlite3.connect(ruta)
+    valor = conn.execute('PRAGMA page_size').fetchone()[0]
+    conn.close()
+    return valor
+
+
+def aplicar(nombre):
+    """
+    Guarda el perfil para todos los workers y cambia page_size de cada
+    fragmento si hace falta. Ese cambio reescribe la base con VACUUM, asi
+    que exige la API detenida (lock de servicio, como restaurar un respaldo);
+    sin cambio de page_size el perfil se aplica en caliente.
+    """
+    import escritura
+    import respaldo
+    page_size = PERFILES[nombre].get('page_size')
+    cambiadas = [ruta for ruta in db.rutas() if page_size and _page_size(ruta) != page_size]
+    if cambiadas:
+        servicio = respaldo.bloquear_servicio(f'cambiar page_size a {page_size} (VACUUM)')
+        try:
+            escritura.detener_todos()
+            for ruta in cambiadas:
+                conn = sqlite3.connect(ruta, timeout=30)
+                conn.execute(f'PRAGMA page_size = {int(page_size)}')
+                conn.execute('VACUUM')
+                conn.close()
+        finally:
+            servicio.close()
+
+    archivo = ruta_perfil()
+    with open(archivo + '.tmp', 'w') as f:
+        json.dump({'perfil': nombre, 'aplicado': time.strftime('%Y-%m-%d %H:%M:%S')}, f)
+    os.replace(archivo + '.tmp', archivo)
+    return cambiadas
+
+
+def _argumento(nombre):
+    if nombre in sys.argv:
+        return sys.argv[sys.argv.index(nombre) + 1]
+    return None
+
+
+def main():
+    nombres = _argumento('--perfiles').split(',') if _argumento('--perfiles') else list(PERFILES)
+    desconocidos = set(nombres) - set(PERFILES)
+    if desconocidos:
+        print(f"Perfiles desconocidos: {', '.join(sorted(desconocidos))}")
+        sys.exit(1)
+
+    print(f"Midiendo {len(nombres)} perfiles sobre copias de {db.DB_PATH} (activo: {perfil_activo()})")
+    resultados = medir_perfiles(nombres)
+
+    print(f"\n{'operacion':<22}" + ''.join(f'{n:>19}' for n in nombres))
+    for operacion in PESOS:
+        print(f"{operacion:<22}" + ''.join(f"{resultados[n]['tiempos'][operacion] * 1000:>16.3f} ms" for n in nombres))
+    print(f"{'puntaje relativo':<22}" + ''.join(f"{resultados[n]['puntaje']:>19.3f}" for n in nombres))
+
+    mejor = recomendar(resultados)
+    mejora = resultados[nombres[0]]['puntaje'] / resultados[mejor]['puntaje']
+    print(f"\nRecomendado: {mejor} ({mejora:.2f}x contra {nombres[0]}, carga ponderada)")
+
+    if '--aplicar' in sys.argv:
+        cambiadas = aplicar(mejor)
+        print(f"Aplicado en {ruta_perfil()}" + (f" (VACUUM con page_size nuevo: {', '.join(cambiadas)})" if cambiadas else ''))
+    else:
+        print("Para usarlo: --aplicar, o CRM_SQLITE_PERFIL=" + mejor)
+
+
+if __name__ == '__main__':
+    # database.py importa este archivo como ajuste_sqlite: se usa ese modulo y su estado
+    import ajuste_sqlite
+    ajuste_sqlite.main()
@@ -0,0 +1,300 @@
+import abc
+import fcntl
+import json
+import os
+import pandas as pd
+import database as db
+import puntuacion
+
+DATA_DIR = 'data'
+
+# 'sqlite' (misma base que la API) o 'log' (archivos CSV + log de solo anexar)
+BACKEND = os.environ.get('CRM_ALMACENAMIENTO', 'sqlite')
+
+# Tamano del log (bytes) a partir del cual se compacta en el CSV
+COMPACTAR_BYTES = int(os.environ.get('CRM_LOG_COMPACTAR_BYTES', str(1024 * 1024)))
+
+COLUMNAS = {
+    'agentes': ['id', 'nombre', 'email', 'whatsapp', 'carga_trabajo'],
+    'propiedades': ['id', 'direccion', 'tipo', 'precio', 'agente_id'],
+    'contactos': ['id', 'nombre', 'telefono', 'fecha', 'propiedad_id', 'estado', 'agente_asignado_id'],
+    'mensajes': ['id', 'contacto_id', 'agente_id', 'tipo', 'contenido',
+                 'botones', 'fecha', 'respondido', 'respuesta', 'fecha_respuesta']
+}
+
+_instancia = None
+
+
+class Almacenamiento(abc.ABC):
+    """
+    Interfaz de persistencia de asignacion.py y mensajes.py. Un backend al
+    que le falte un metodo falla al instanciarse, no en medio de una peticion.
+    """
+
+    @abc.abstractmethod
+    def leer_agentes(self):
+        pass
+
+    @abc.abstractmethod
+    def leer_propiedades(self):
+        pass
+
+    @abc.abstractmethod
+    def leer_contactos(self):
+        pass
+
+    @abc.abstractmethod
+    def leer_mensajes(self, agente_id=None):
+        pass
+
+    @abc.abstractmethod
+    def agregar_contacto(self, contacto):
+        """Guarda un contacto nuevo y retorna su id."""
+
+    @abc.abstractmethod
+    def actualizar_estado_contacto(self, contacto_id, nuevo_estado):
+        pass
+
+    @abc.abstractmethod
+    def agregar_mensaje(self, mensaje):
+        """Guarda un mensaje nuevo y retorna su id."""
+
+    @abc.abstractmethod
+    def responder_mensaje(self, mensaje_id, respuesta, fecha_respuesta):
+        pass
+
+
+class AlmacenamientoSQLite(Almacenamiento):
+    """Usa las mismas tablas y funciones de escritura que database.py."""
+
+    def _leer(self, query, params=(), rutas=None):
+        """Lee de todos los fragmentos (o de los indicados) y concatena."""
+        partes = []
+        for ruta in rutas or db.rutas():
+            conn = db.get_connection(ruta)
+            partes.append(pd.read_sql_query(query, conn, params=params))
+            conn.close()
+        return partes[0] if len(partes) == 1 else pd.concat(partes, ignore_index=True)
+
+    def leer_agentes(self):
+        return self._leer('SELECT * FROM agentes')
+
+    def leer_propiedades(self):
+        return self._leer('SELECT * FROM propiedades')
+
+    def leer_contactos(self):
+        return self._leer('SELECT * FROM contactos')
+
+    def leer_mensajes(self, agente_id=None):
+        if agente_id is None:
+            return self._leer('SELECT * FROM mensajes')
+        # Con contenido y botones ya armados para los mensajes de plantilla
+        return pd.DataFrame(db.get_mensajes_agente(int(agente_id)))
+
+    def agregar_contacto(self, contacto):
+        nuevo = db.crear_contacto(
+            contacto['nombre'], contacto['telefono'], contacto.get('propiedad_id'),
+            contacto.get('agente_asignado_id'), contacto.get('estado', 'Asignado')
+        )
+        # La carga del agente en el motor sube con el lead ya confirmado
+        puntuacion.registrar(nuevo['agente_asignado_id'], asignados=1)
+        return nuevo['id']
+
+    def actualizar_estado_contacto(self, contacto_id, nuevo_estado):
+        return db.actualizar_estado_contacto(int(contacto_id), nuevo_estado)
+
+    def agregar_mensaje(self, mensaje):
+        if mensaje.get('plantilla'):
+            mensaje_id, nuevo = db.crear_mensaje_plantilla(
+                mensaje['contacto_id'], mensaje['agente_id'], mensaje['plantilla'],
+                json.loads(mensaje['parametros']) if mensaje.get('parametros') else None
+            )
+        else:
+            mensaje_id, nuevo = db.crear_mensaje(
+                mensaje['contacto_id'], mensaje['agente_id'], mensaje['tipo'],
+                mensaje['contenido'], mensaje.get('botones')
+            )
+        # La bandeja del agente en el motor de asignacion (misma base)
+        if nuevo:
+            puntuacion.registrar(mensaje['agente_id'], nuevos=1)
+        return mensaje_id
+
+    def responder_mensaje(self, mensaje_id, respuesta, fecha_respuesta):
+        agente_id = db.responder_mensaje(int(mensaje_id), respuesta)
+        if agente_id is not None:
+            puntuacion.registrar(agente_id, respondidos=1)
+        return agente_id is not None
+
+
+class _TablaLog:
+    """
+    Una tabla guardada como CSV compactado + log JSON de solo anexar.
+
+    Las escrituras agregan una linea al log (O(1)) bajo un flock exclusivo;
+    las lecturas toman el flock compartido y aplican el log sobre el CSV.
+    Cuando el log supera COMPACTAR_BYTES se reescribe el CSV y se vacia.
+    """
+
+    def __init__(self, directorio, nombre):
+        self.nombre = nombre
+        self.columnas = COLUMNAS[nombre]
+        self.ruta_csv = os.path.join(directorio, f'{nombre}.csv')
+        self.ruta_log = os.path.join(directorio, f'{nombre}.log')
+        self.ruta_seq = os.path.join(directorio, f'{nombre}.seq')
+        self.ruta_lock = os.path.join(directorio, f'{nombre}.lock')
+
+    def _bloquear(self, modo):
+        archivo = open(self.ruta_lock, 'a')
+        fcntl.flock(archivo, modo)
+        return archivo
+
+    def _cargar(self):
+        if os.path.exists(self.ruta_csv):
+            df = pd.read_csv(self.ruta_csv)
+        else:
+            df = pd.DataFrame(columns=self.columnas)
+
+        if not os.path.exists(self.ruta_log):
+            return df
+
+        nuevas = []
+        cambios = []
+        with open(self.ruta_log) as log:
+            for linea in log:
+                if not linea.strip():
+                    continue
+                registro = json.loads(linea)
+                if registro['op'] == 'insert':
+                    nuevas.append(registro['fila'])
+                else:
+                    cambios.append(registro)
+
+        if nuevas:
+            df = pd.concat([df, pd.DataFrame(nuevas)], ignore_index=True)
+        if cambios:
+            posiciones = pd.Series(df.index, index=df['id'])
+            for registro in cambios:
+                if registro['id'] in posiciones.index:
+                    idx = posiciones[registro['id']]
+                    for columna, valor in registro['cambios'].items():
+                        df.at[idx, columna] = valor
+        return df
+
+    def leer(self):
+        lock = self._bloquear(fcntl.LOCK_SH)
+        try:
+            return self._cargar()
+        finally:
+            lock.close()
+
+    def _ultimo_id(self):
+        """Contador persistente; se inicializa una sola vez desde los datos."""
+        if os.path.exists(self.ruta_seq):
+            with open(self.ruta_seq) as f:
+                return int(f.read().strip() or 0)
+        df = self._cargar()
+        return int(df['id'].max()) if not df.empty else 0
+
+    def _anexar(self, registro):
+        with open(self.ruta_log, 'a') as log:
+            log.write(json.dumps(registro, default=str) + '\n')
+            tamano = log.tell()
+        if tamano >= COMPACTAR_BYTES:
+            self._compactar()
+
+    def insertar(self, fila):
+        lock = self._bloquear(fcntl.LOCK_EX)
+        try:
+            nuevo_id = self._ultimo_id() + 1
+            with open(self.ruta_seq, 'w') as f:
+                f.write(str(nuevo_id))
+            self._anexar({'op': 'insert', 'fila': dict(fila, id=nuevo_id)})
+            return nuevo_id
+        finally:
+            lock.close()
+
+    def actualizar(self, id_fila, cambios):
+        """Anexa el cambio; retorna False si el id nunca fue asignado."""
+        lock = self._bloquear(fcntl.LOCK_EX)
+        try:
+            # No hay borrados: todo id entre 1 y el contador existe
+            if not 1 <= int(id_fila) <= self._ultimo_id():
+                return False
+            self._anexar({'op': 'update', 'id': int(id_fila), 'cambios': cambios})
+            return True
+        finally:
+            lock.close()
+
+    def _compactar(self):
+        df = self._cargar()
+        temporal = self.ruta_csv + '.tmp'
+        df.to_csv(temporal, index=False)
+        os.replace(temporal, self.ruta_csv)
+        open(self.ruta_log, 'w').close()
+
+    def compactar(self):
+        lock = self._bloquear(fcntl.LOCK_EX)
+        try:
+            self._compactar()
+        finally:
+            lock.close()
+
+
+class AlmacenamientoLog(Almacenamiento):
+    """Despliegues solo con CSV: anexar al log en vez de reescribir el archivo."""
+
+    def __init__(self, directorio=DATA_DIR):
+        os.makedirs(directorio, exist_ok=True)
+        self.tablas = {nombre: _TablaLog(directorio, nombre) for nombre in COLUMNAS}
+
+    def leer_agentes(self):
+        return self.tablas['agentes'].leer()
+
+    def leer_propiedades(self):
+        return self.tablas['propiedades'].leer()
+
+    def leer_contactos(self):
+        return self.tablas['contactos'].leer()
+
+    def leer_mensajes(self, agente_id=None):
+        mensajes = self.tablas['mensajes'].leer()
+        if agente_id is None or mensajes.empty:
+            return mensajes
+        return mensajes[mensajes['agente_id'] == agente_id]
+
+    def agregar_contacto(self, contacto):
+        return self.tablas['contactos'].insertar(contacto)
+
+    def actualizar_estado_contacto(self, contacto_id, nuevo_estado):
+        return self.tablas['contactos'].actualizar(contacto_id, {'estado': nuevo_estado})
+
+    def agregar_mensaje(self, mensaje):
+        return self.tablas['mensajes'].insertar(mensaje)
+
+    def responder_mensaje(self, mensaje_id, respuesta, fecha_respuesta):
+        return self.tablas['mensajes'].actualizar(mensaje_id, {
+            'respondido': True,
+            'respuesta': respuesta,
+            'fecha_respuesta': fecha_respuesta
+        })
+
+    def compactar(self):
+        for tabla in self.tablas.values():
+            tabla.compactar()
+
+
+def obtener_almacenamiento():
+    """Almacenamiento configurado por CRM_ALMACENAMIENTO."""
+    global _instancia
+    if _instancia is None:
+        if BACKEND == 'log':
+            _instancia = AlmacenamientoLog()
+        else:
+            _instancia = AlmacenamientoSQLite()
+    return _instancia
+
+
+if __name__ == '__main__':
+    # Compacta los logs pendientes en los CSV
+    AlmacenamientoLog().compactar()
+    print("Logs compactados")
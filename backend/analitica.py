@@ -0,0 +1,369 @@
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import database as db
+
+# Etapas del embudo en orden. Un contacto cuenta en todas las etapas que ya alcanzo.
+ETAPAS_EMBUDO = ['asignados', 'confirmados', 'contactados', 'en_negociacion', 'cerrados']
+
+# Etapa que representa cada estado. La etapa alcanzada es la mayor entre el
+# estado actual y los de historial_estados: un lead perdido en negociacion
+# sigue contando como confirmado, contactado y en negociacion
+RANGO_ESTADO = {
+    'Nuevo': 0,
+    'Asignado': 0,
+    'Confirmado': 1,
+    'Contactado': 2,
+    'En Proceso': 3,
+    'En Negociacion': 3,
+    'Cerrado': 4,
+    'Perdido': 0
+}
+
+PERCENTILES = [0.5, 0.9, 0.99]
+
+TAMANO_LOTE = 50000
+
+# Marca de la ultima actualizacion en resumen_control. Cambio de nombre al
+# calcular el embudo con el historial: las bases existentes recalculan todo una vez
+MARCA = 'ultima_actualizacion_historial'
+
+# Cada cuanto se actualizan los resumenes en segundo plano (segundos; 0 = solo
+# por consola). El dashboard solo lee las filas precalculadas
+INTERVALO_SEG = int(os.environ.get('CRM_ANALITICA_INTERVALO_SEG', '60'))
+
+
+def _dias_afectados(cursor, marca):
+    """
+    Dias cuyo resumen hay que recalcular desde la ultima marca (None = todos).
+    Como las lecturas con ?desde=, se repite database.MARGEN_DELTA_SEG hacia
+    atras: una transaccion confirmada despues de tomar la marca puede traer
+    una fecha anterior a ella.
+    """
+    if marca is None:
+        return None, None
+    margen = f'-{db.MARGEN_DELTA_SEG} seconds'
+
+    cursor.execute('''
+        SELECT DISTINCT date(fecha) FROM contactos WHERE fecha_actualizacion >= datetime(?, ?)
+    ''', (marca, margen))
+    dias_embudo = [row[0] for row in cursor.fetchall() if row[0]]
+
+    # El archivo no cambia: solo las respuestas de la base principal mueven la marca
+    cursor.execute('''
+        SELECT DISTINCT date(fecha) FROM main.mensajes WHERE fecha_respuesta >= datetime(?, ?)
+    ''', (marca, margen))
+    dias_respuesta = [row[0] for row in cursor.fetchall() if row[0]]
+
+    return dias_embudo, dias_respuesta
+
+
+def _cargar_dias(cursor, tabla, dias):
+    """Llena una tabla temporal con los dias a recalcular."""
+    cursor.execute(f'CREATE TEMP TABLE IF NOT EXISTS {tabla} (dia TEXT PRIMARY KEY)')
+    cursor.execute(f'DELETE FROM {tabla}')
+    cursor.executemany(f'INSERT OR IGNORE INTO {tabla} (dia) VALUES (?)', [(d,) for d in dias])
+
+
+def _rango_sql(columna):
+    """Expresion CASE con la etapa de RANGO_ESTADO de un estado."""
+    casos = ' '.join(f"WHEN '{estado}' THEN {rango}" for estado, rango in RANGO_ESTADO.items())
+    return f"CASE {columna} {casos} ELSE 0 END"
+
+
+def _calcular_embudo(conn, dias):
+    """
+    Cuenta contactos por (dia, agente) y etapa alcanzada, leyendo por lotes.
+    La etapa maxima del historial de cada contacto sale del indice cubriente
+    idx_historial_contacto_fecha.
+    """
+    rango = f'''MAX({_rango_sql('c.estado')}, COALESCE(
+                   (SELECT MAX({_rango_sql('h.estado')}) FROM historial_estados h
+                    WHERE h.contacto_id = c.id), 0)) AS rango'''
+    if dias is None:
+        query = f'''
+            SELECT date(c.fecha) AS dia, c.agente_asignado_id AS agente_id, c.estado, {rango}
+            FROM contactos c
+        '''
+    else:
+        _cargar_dias(conn.cursor(), 'temp_dias_embudo', dias)
+        query = f'''
+            SELECT date(c.fecha) AS dia, c.agente_asignado_id AS agente_id, c.estado, {rango}
+            FROM temp_dias_embudo d
+            JOIN contactos c ON c.fecha >= d.dia AND c.fecha < date(d.dia, '+1 day')
+        '''
+
+    etapas = np.arange(len(ETAPAS_EMBUDO))
+    parciales = []
+    for lote in pd.read_sql_query(query, conn, chunksize=TAMANO_LOTE):
+        lote = lote.dropna(subset=['dia', 'agente_id'])
+        if lote.empty:
+            continue
+        rango = lote['rango'].to_numpy()
+        alcanzadas = np.greater_equal.outer(rango, etapas).astype(np.int64)
+        conteos = pd.DataFrame(alcanzadas, columns=ETAPAS_EMBUDO, index=lote.index)
+        conteos['perdidos'] = (lote['estado'] == 'Perdido').astype(np.int64)
+        conteos['dia'] = lote['dia']
+        conteos['agente_id'] = lote['agente_id'].astype(np.int64)
+        parciales.append(conteos.groupby(['dia', 'agente_id']).sum())
+
+    if not parciales:
+        return pd.DataFrame(columns=ETAPAS_EMBUDO + ['perdidos'])
+    return pd.concat(parciales).groupby(level=['dia', 'agente_id']).sum()
+
+
+def _calcular_respuesta(conn, dias, origenes=('main.mensajes',)):
+    """
+    Percentiles del tiempo de respuesta (segundos) por (dia, agente). origenes
+    incluye archivo.mensajes si esta adjunto: un dia ya archivado en parte
+    se recalcula con todas sus respuestas.
+    """
+    if dias is not None:
+        _cargar_dias(conn.cursor(), 'temp_dias_respuesta', dias)
+    partes = []
+    for origen in origenes:
+        parte = f'''
+            SELECT date(m.fecha) AS dia, m.agente_id,
+                   (julianday(m.fecha_respuesta) - julianday(m.fecha)) * 86400.0 AS segundos
+            FROM {origen} m
+        '''
+        if dias is not None:
+            parte += " JOIN temp_dias_respuesta d ON m.fecha >= d.dia AND m.fecha < date(d.dia, '+1 day')"
+        partes.append(parte + ' WHERE m.fecha_respuesta IS NOT NULL')
+    query = ' UNION ALL '.join(partes)
+
+    lotes = [lote.dropna() for lote in pd.read_sql_query(query, conn, chunksize=TAMANO_LOTE)]
+    lotes = [lote for lote in lotes if not lote.empty]
+    if not lotes:
+        return pd.DataFrame(columns=['respondidos', 'promedio_seg', 'p50_seg', 'p90_seg', 'p99_seg'])
+
+    tiempos = pd.concat(lotes, ignore_index=True)
+    tiempos['agente_id'] = tiempos['agente_id'].astype(np.int64)
+    tiempos['segundos'] = tiempos['segundos'].clip(lower=0)
+    grupos = tiempos.groupby(['dia', 'agente_id'])['segundos']
+
+    resumen = grupos.agg(respondidos='count', promedio_seg='mean')
+    cuantiles = grupos.quantile(PERCENTILES).unstack()
+    cuantiles.columns = [f'p{int(p * 100)}_seg' for p in PERCENTILES]
+    return resumen.join(cuantiles)
+
+
+def _guardar(cursor, tabla, tabla_dias, dias, resumen):
+    """Reemplaza las filas de los dias recalculados por el nuevo resumen."""
+    if dias is None:
+        cursor.execute(f'DELETE FROM {tabla}')
+    else:
+        cursor.execute(f'DELETE FROM {tabla} WHERE dia IN (SELECT dia FROM {tabla_dias})')
+
+    if resumen.empty:
+        return 0
+
+    filas = resumen.reset_index()
+    columnas = list(filas.columns)
+    marcadores = ', '.join(['?'] * len(columnas))
+    valores = [
+        tuple(v.item() if isinstance(v, np.generic) else v for v in fila)
+        for fila in filas.itertuples(index=False, name=None)
+    ]
+    cursor.executemany(
+        f'INSERT INTO {tabla} ({", ".join(columnas)}) VALUES ({marcadores})',
+        valores
+    )
+    return len(valores)
+
+
+def actualizar_resumenes(reconstruir=False):
+    """
+    Recalcula los resumenes de embudo y tiempo de respuesta.
+
+    Solo procesa los dias con contactos o respuestas modificados desde la
+    ultima ejecucion, salvo que se pida reconstruir todo. Cada fragmento
+    guarda los resumenes de sus agentes.
+    """
+    total = {'embudo': 0, 'respuesta': 0}
+    for ruta in db.rutas():
+        resultado = _actualizar_fragmento(ruta, reconstruir)
+        total['embudo'] += resultado['embudo']
+        total['respuesta'] += resultado['respuesta']
+    return total
+
+
+def _actualizar_fragmento(ruta, reconstruir):
+    conn = db.get_connection(ruta)
+    cursor = conn.cursor()
+
+    # Mensajes que retencion.py ya movio al archivo del fragmento
+    origenes = ['main.mensajes']
+    archivo = db.ruta_archivo(ruta)
+    if os.path.exists(archivo):
+        cursor.execute('ATTACH DATABASE ? AS archivo', (archivo,))
+        cursor.execute("SELECT 1 FROM archivo.sqlite_master WHERE type = 'table' AND name = 'mensajes'")
+        if cursor.fetchone():
+            origenes.append('archivo.mensajes')
+
+    cursor.execute('SELECT CURRENT_TIMESTAMP')
+    inicio = cursor.fetchone()[0]
+
+    marca = None
+    if not reconstruir:
+        cursor.execute('SELECT valor FROM resumen_control WHERE nombre = ?', (MARCA,))
+        row = cursor.fetchone()
+        marca = row[0] if row else None
+
+    dias_embudo, dias_respuesta = _dias_afectados(cursor, marca)
+    if dias_embudo == [] and dias_respuesta == []:
+        cursor.execute('UPDATE resumen_control SET valor = ? WHERE nombre = ?', (inicio, MARCA))
+        conn.commit()
+        conn.close()
+        return {'embudo': 0, 'respuesta': 0}
+
+    embudo = _calcular_embudo(conn, dias_embudo) if dias_embudo != [] else None
+    respuesta = _calcular_respuesta(conn, dias_respuesta, origenes) if dias_respuesta != [] else None
+
+    filas_embudo = 0
+    filas_respuesta = 0
+    if embudo is not None:
+        filas_embudo = _guardar(cursor, 'resumen_embudo', 'temp_dias_embudo', dias_embudo, embudo)
+    if respuesta is not None:
+        filas_respuesta = _guardar(cursor, 'resumen_respuesta', 'temp_dias_respuesta', dias_respuesta, respuesta)
+
+    cursor.execute('''
+        INSERT INTO resumen_control (nombre, valor) VALUES (?, ?)
+        ON CONFLICT(nombre) DO UPDATE SET valor = excluded.valor
+    ''', (MARCA, inicio))
+
+    conn.commit()
+    conn.close()
+    return {'embudo': filas_embudo, 'respuesta': filas_respuesta}
+
+
+def _vencidos(intervalo):
+    """True si algun fragmento no actualizo sus resumenes en los ultimos intervalo segundos."""
+    for ruta in db.rutas():
+        conn = db.get_connection(ruta)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT 1 FROM resumen_control WHERE nombre = ? AND valor >= datetime('now', ?)
+        ''', (MARCA, f'-{int(intervalo)} seconds'))
+        vigente = cursor.fetchone() is not None
+        conn.close()
+        if not vigente:
+            return True
+    return False
+
+
+def _bucle(intervalo):
+    while True:
+        try:
+            # Con varios workers, el primero que despierta actualiza y el resto lo ve vigente
+            if _vencidos(intervalo):
+                actualizar_resumenes()
+        except Exception as e:
+            print(f"--> ANALITICA: error actualizando resumenes: {e}")
+        time.sleep(intervalo)
+
+
+def iniciar_en_segundo_plano(intervalo=INTERVALO_SEG):
+    """Lanza la actualizacion periodica de los resumenes (fuera de las consultas del dashboard)."""
+    if intervalo <= 0:
+        return None
+    hilo = threading.Thread(target=_bucle, args=(intervalo,), name='analitica', daemon=True)
+    hilo.start()
+    return hilo
+
+
+def obtener_embudo(desde=None, hasta=None, agente_id=None):
+    """Filas precalculadas de embudo y tiempo de respuesta por dia y agente."""
+    condiciones = []
+    params = []
+    if desde:
+        condiciones.append('e.dia >= ?')
+        params.append(desde)
+    if hasta:
+        condiciones.append('e.dia <= ?')
+        params.append(hasta)
+    if agente_id:
+        condiciones.append('e.agente_id = ?')
+        params.append(agente_id)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ''
+
+    filas = []
+    for ruta in ([db.ruta_para_id(agente_id)] if agente_id else db.rutas()):
+        conn = db.get_connection(ruta)
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT e.*, r.respondidos, r.promedio_seg, r.p50_seg, r.p90_seg, r.p99_seg
+            FROM resumen_embudo e
+            LEFT JOIN resumen_respuesta r ON r.dia = e.dia AND r.agente_id = e.agente_id
+            {where}
+            ORDER BY e.dia, e.agente_id
+        ''', params)
+        filas.extend(dict(row) for row in cursor.fetchall())
+        conn.close()
+
+    filas.sort(key=lambda f: (f['dia'], f['agente_id']))
+    return filas
+
+
+def _kpis_fragmento(ruta, por_agente):
+    """Agrega a por_agente el embudo y tiempos de los agentes de un fragmento."""
+    conn = db.get_connection(ruta)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT a.id, a.nombre,
+               COALESCE(SUM(e.asignados), 0) AS asignados,
+               COALESCE(SUM(e.confirmados), 0) AS confirmados,
+               COALESCE(SUM(e.contactados), 0) AS contactados,
+               COALESCE(SUM(e.en_negociacion), 0) AS en_negociacion,
+               COALESCE(SUM(e.cerrados), 0) AS cerrados,
+               COALESCE(SUM(e.perdidos), 0) AS perdidos
+        FROM agentes a
+        LEFT JOIN resumen_embudo e ON e.agente_id = a.id
+        GROUP BY a.id
+    ''')
+    por_agente.update({row['id']: dict(row) for row in cursor.fetchall()})
+
+    cursor.execute('''
+        SELECT agente_id, SUM(respondidos) AS respondidos,
+               SUM(promedio_seg * respondidos) / SUM(respondidos) AS promedio_seg
+        FROM resumen_respuesta
+        GROUP BY agente_id
+    ''')
+    for row in cursor.fetchall():
+        if row['agente_id'] in por_agente:
+            por_agente[row['agente_id']]['respondidos'] = row['respondidos']
+            por_agente[row['agente_id']]['promedio_respuesta_seg'] = row['promedio_seg']
+
+    conn.close()
+
+
+def obtener_kpis():
+    """Tasa de conversion, tiempo promedio de respuesta y embudo por agente."""
+    por_agente = {}
+    for ruta in db.rutas():
+        _kpis_fragmento(ruta, por_agente)
+
+    asignados = sum(a['asignados'] for a in por_agente.values())
+    cerrados = sum(a['cerrados'] for a in por_agente.values())
+    respondidos = sum(a.get('respondidos') or 0 for a in por_agente.values())
+    segundos = sum((a.get('promedio_respuesta_seg') or 0) * (a.get('respondidos') or 0)
+                   for a in por_agente.values())
+
+    for agente in por_agente.values():
+        agente['tasa_conversion'] = round(agente['cerrados'] / agente['asignados'], 4) if agente['asignados'] else 0
+
+    return {
+        'tasa_conversion': round(cerrados / asignados, 4) if asignados else 0,
+        'tiempo_respuesta_promedio_seg': round(segundos / respondidos, 1) if respondidos else None,
+        'por_agente': list(por_agente.values())
+    }
+
+
+if __name__ == '__main__':
+    import sys
+    db.init_db()
+    resultado = actualizar_resumenes(reconstruir='--reconstruir' in sys.argv)
+    print(f"Resumenes actualizados: {resultado['embudo']} filas de embudo, {resultado['respuesta']} de respuesta")
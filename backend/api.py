@@ -1,11 +1,30 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response
 from flask_cors import CORS
 from functools import wraps
+import gzip
+import os
+import sqlite3
 import database as db
+import ajuste_sqlite
+import analitica
+import cache
+import limites
+import perfilado
+import plantillas
+import puntuacion
+import reasignacion
+import respaldo
+import retencion
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
 
+# Sin ordenar claves: menos CPU al serializar listas grandes
+app.json.sort_keys = False
+
+# Respuestas de al menos este tamano se comprimen si el cliente acepta gzip
+COMPRIMIR_MIN_BYTES = int(os.environ.get('CRM_COMPRIMIR_MIN_BYTES', '1024'))
+
 # Usuario demo hardcodeado
 DEMO_USER = {
     'email': 'converging@demo.com',
@@ -17,6 +36,11 @@ DEMO_USER = {
 DEMO_TOKEN = 'demo_token_minicrm_2024'
 
 
+def _token_bearer():
+    auth_header = request.headers.get('Authorization', '')
+    return auth_header.split(' ')[1] if auth_header.startswith('Bearer ') else None
+
+
 def require_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -61,47 +85,222 @@ def auth_me():
         'name': DEMO_USER['name']
     })
 
-# Inicializar DB y migrar datos si es necesario
-db.init_db()
-db.migrate_from_csv()
-
-# Botones por tipo de mensaje
-BOTONES_POR_MENSAJE = {
-    'nuevo_lead': [
-        {'id': 'recibido', 'label': 'Recibido', 'accion': 'confirmar_recepcion'},
-        {'id': 'rechazar', 'label': 'Rechazar', 'accion': 'rechazar_lead'}
-    ],
-    'recordatorio_confirmacion': [
-        {'id': 'recibido', 'label': 'Recibido', 'accion': 'confirmar_recepcion'},
-        {'id': 'rechazar', 'label': 'Rechazar', 'accion': 'rechazar_lead'}
-    ],
-    'pedir_contacto': [
-        {'id': 'si_contacte', 'label': 'Si, contacte', 'accion': 'marcar_contactado'},
-        {'id': 'no_pude', 'label': 'No pude', 'accion': 'no_pudo_contactar'},
-        {'id': 'no_contesta', 'label': 'No contesta', 'accion': 'cliente_no_contesta'}
-    ],
-    'seguimiento': [
-        {'id': 'en_negociacion', 'label': 'En negociacion', 'accion': 'marcar_negociacion'},
-        {'id': 'cerrado', 'label': 'Cerrado', 'accion': 'marcar_cerrado'},
-        {'id': 'perdido', 'label': 'Perdido', 'accion': 'marcar_perdido'}
-    ],
-    'felicitacion': [],
-    'alerta_sin_respuesta': [
-        {'id': 'recibido', 'label': 'Recibido', 'accion': 'confirmar_recepcion'}
-    ]
+_servicio_iniciado = False
+
+
+def iniciar_servicio():
+    """
+    Arranque del proceso de la API: lock de servicio, base y tareas en segundo
+    plano. Lo llaman __main__ y el hook de gunicorn (gunicorn.conf.py); importar
+    el modulo (p. ej. simulador.py) no tiene efectos.
+    """
+    global _servicio_iniciado
+    if _servicio_iniciado:
+        return
+    _servicio_iniciado = True
+
+    # Lock de servicio: impide restaurar respaldos sobre la base mientras la API corre
+    respaldo.marcar_servicio_activo()
+
+    # Inicializar DB y migrar datos si es necesario
+    db.init_db()
+    db.migrate_from_csv()
+
+    # Archivado de mensajes antiguos en segundo plano (CRM_RETENCION_DIAS > 0)
+    retencion.iniciar_en_segundo_plano()
+
+    # Resumenes del dashboard actualizados en segundo plano (CRM_ANALITICA_INTERVALO_SEG)
+    analitica.iniciar_en_segundo_plano()
+
+    # ANALYZE acotado del perfil de ajuste_sqlite.py, fuera de las solicitudes
+    ajuste_sqlite.iniciar_en_segundo_plano()
+
+
+# Aviso de llamada perdida segun el estado del contacto (los demas estados
+# usan 'llamada_estado', que muestra el estado)
+PLANTILLA_LLAMADA_POR_ESTADO = {
+    'Cerrado': 'llamada_postventa',
+    'Perdido': 'llamada_reactivacion',
+    'Asignado': 'llamada_sin_contactar',
+    'Confirmado': 'llamada_sin_contactar',
+    'Contactado': 'llamada_contactado',
+    'En Negociacion': 'llamada_negociacion'
 }
 
 
+# Parametros que activan la respuesta paginada de GET /propiedades
+PARAMETROS_CATALOGO = ('tipo', 'precio_min', 'precio_max', 'sin_precio', 'agente_id', 'q', 'ids', 'limite',
+                       'cursor')
+
+
+def _campos():
+    """Columnas pedidas con ?fields=id,nombre (None = todas)."""
+    campos = request.args.get('fields')
+    if not campos:
+        return None
+    return [c.strip() for c in campos.split(',') if c.strip()]
+
+
+def _lista(filas, campos=None):
+    """
+    Con ?formato=compacto la lista se envia como arreglo de arreglos, con los
+    nombres de columna en la primera fila, en vez de repetirlos en cada objeto.
+    """
+    if request.args.get('formato') != 'compacto':
+        return filas
+    columnas = list(filas[0].keys()) if filas else (campos or [])
+    return [columnas] + [[fila[c] for c in columnas] for fila in filas]
+
+
+@app.after_request
+def comprimir(response):
+    """gzip para respuestas grandes si el cliente lo acepta."""
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '')):
+        return response
+
+    datos = response.get_data()
+    if len(datos) < COMPRIMIR_MIN_BYTES:
+        return response
+
+    response.set_data(gzip.compress(datos, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Content-Length'] = len(response.get_data())
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.before_request
+def iniciar_perfil():
+    """cProfile para la solicitud si trae X-Perfil: 1 (autenticada) o cae en el muestreo."""
+    pedido = request.headers.get('X-Perfil') == '1' and _token_bearer() == DEMO_TOKEN
+    if perfilado.debe_perfilar(pedido):
+        g.perfil = perfilado.iniciar()
+
+
+@app.teardown_request
+def terminar_perfil(exc):
+    perfil = g.pop('perfil', None)
+    if perfil is not None:
+        perfilado.terminar(perfil, request.endpoint)
+
+
+@app.before_request
+def admitir_escritura():
+    """
+    Limite por cliente y cupo global para las escrituras. Las lecturas no
+    pasan por aqui: siempre tienen hilos libres aunque un cliente sature.
+    """
+    if (request.method in ('GET', 'HEAD', 'OPTIONS')
+            or request.endpoint is None
+            or request.endpoint in limites.EXENTOS):
+        return None
+
+    try:
+        permiso, espera = limites.admitir(limites.clave_cliente(_token_bearer(), request.remote_addr),
+                                          request.endpoint)
+    except sqlite3.OperationalError as e:
+        # Si el archivo de limites no responde se deja pasar la escritura
+        print(f"--> LIMITES: sin control de admision: {e}")
+        return None
+
+    if permiso is None:
+        response = jsonify({'error': 'Demasiadas solicitudes, reintente mas tarde',
+                            'reintentar_en': round(espera, 2)})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(limites.segundos_reintento(espera))
+        return response
+    g.permiso_escritura = permiso
+    return None
+
+
+@app.teardown_request
+def liberar_escritura(exc):
+    permiso = g.pop('permiso_escritura', None)
+    if permiso is not None:
+        limites.liberar(permiso)
+
+
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({'status': 'ok'})
 
 
+@app.route('/limites', methods=['GET'])
+@require_auth
+def get_limites():
+    """Contadores del limitador, compartidos por todos los workers."""
+    return jsonify(limites.estadisticas())
+
+
+@app.route('/cache', methods=['GET'])
+@require_auth
+def get_cache():
+    """Aciertos, fallos, desalojos e invalidaciones de las caches de este worker."""
+    return jsonify(dict(cache.estadisticas(), plantillas=plantillas.estadisticas()))
+
+
+@app.route('/perfiles', methods=['GET'])
+@require_auth
+def get_perfiles():
+    """Endpoints perfilados, con solicitudes y tiempo total de todos los workers."""
+    return jsonify(perfilado.listar())
+
+
+@app.route('/perfiles', methods=['DELETE'])
+@require_auth
+def borrar_perfiles():
+    perfilado.reiniciar()
+    return jsonify({'message': 'Perfiles borrados'})
+
+
+@app.route('/perfiles/<endpoint>/<formato>', methods=['GET'])
+@require_auth
+def descargar_perfil(endpoint, formato):
+    """pstats combinado (.prof) o pilas colapsadas para flamegraph (.txt)."""
+    if formato not in ('pstats', 'colapsado'):
+        return jsonify({'error': 'Formato invalido: pstats o colapsado'}), 400
+    stats = perfilado.combinar(endpoint)
+    if stats is None:
+        return jsonify({'error': 'Sin perfiles para ese endpoint'}), 404
+
+    if formato == 'pstats':
+        return Response(perfilado.exportar_pstats(stats), mimetype='application/octet-stream', headers={
+            'Content-Disposition': f'attachment; filename={endpoint}.prof'
+        })
+    return Response(perfilado.pilas_colapsadas(stats), mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename={endpoint}.txt'
+    })
+
+
+@app.route('/respaldos', methods=['GET'])
+@require_auth
+def get_respaldos():
+    return jsonify(respaldo.listar_respaldos())
+
+
+@app.route('/respaldos', methods=['POST'])
+@require_auth
+def crear_respaldo():
+    """Respaldo en linea (la API sigue atendiendo). {"incremental": true} opcional."""
+    data = request.json or {}
+    try:
+        return jsonify(respaldo.crear_respaldo(incremental=bool(data.get('incremental')))), 201
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/contactos', methods=['GET'])
 @require_auth
 def get_contactos():
-    contactos = db.get_contactos()
-    return jsonify(contactos)
+    campos = _campos()
+    try:
+        contactos = db.get_contactos(campos, desde=request.args.get('desde'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(_lista(contactos, campos))
 
 
 @app.route('/contactos', methods=['POST'])
@@ -116,6 +315,18 @@ def create_contacto():
     propiedad_id = data.get('propiedad_id')
     modo = data.get('modo_asignacion', 'auto')
 
+    # Reintentos del portal o doble click: responder con el contacto ya creado
+    clave = request.headers.get('Idempotency-Key')
+    if clave:
+        existente = db.get_contacto_por_idempotencia(clave)
+        if existente:
+            return jsonify(existente), 200
+
+    # Si ya hay un lead abierto con el mismo telefono, se vincula a ese
+    existente = db.buscar_lead_abierto(telefono)
+    if existente:
+        return _lead_duplicado(existente, clave)
+
     # Determinar agente
     agente_id = None
 
@@ -123,34 +334,53 @@ def create_contacto():
         agente_id = data.get('agente_manual_id')
     elif modo == 'round_robin':
         agente_id = db.get_agente_menos_carga()
-    else:
-        # Auto: si hay propiedad, usar su agente; sino round robin
+    elif modo == 'propiedad':
+        # Agente de la propiedad; sino round robin
         if propiedad_id:
             propiedad = db.get_propiedad(propiedad_id)
             if propiedad:
                 agente_id = propiedad['agente_id']
         if not agente_id:
             agente_id = db.get_agente_menos_carga()
+    else:
+        # Auto: puntaje por carga, conversion, especialidad y bandeja (puntuacion.py)
+        propiedad = db.get_propiedad(propiedad_id) if propiedad_id else None
+        agente_id = puntuacion.asignar(puntuacion.lead_desde_propiedad(propiedad))
 
     # Crear contacto
-    nuevo_contacto = db.crear_contacto(nombre, telefono, propiedad_id, agente_id)
-
-    # Generar mensaje inicial para el agente
+    try:
+        nuevo_contacto = db.crear_contacto(nombre, telefono, propiedad_id, agente_id)
+    except sqlite3.IntegrityError:
+        # Otra peticion creo el mismo lead entre la busqueda y el insert;
+        # no se registro carga, asi que no hay nada que deshacer en el motor
+        return _lead_duplicado(db.buscar_lead_abierto(telefono), clave)
+    puntuacion.registrar(agente_id, asignados=1)
+
+    if clave:
+        db.guardar_idempotencia(clave, nuevo_contacto['id'])
+
+    # Generar mensaje inicial para el agente (el texto se arma al leer)
     agente = db.get_agente(agente_id)
-    propiedad = db.get_propiedad(propiedad_id) if propiedad_id else None
+    _avisar(nuevo_contacto['id'], agente_id, 'nuevo_lead')
+
+    print(f"--> NOTIFICACION: Lead {nombre} asignado a {agente['nombre']}")
 
-    prop_info = ""
-    if propiedad:
-        prop_info = f"\nInteresado en: {propiedad['tipo']} - {propiedad['direccion']}"
+    return jsonify(nuevo_contacto), 201
 
-    contenido = f"Nuevo lead asignado: {nombre} ({telefono}){prop_info}"
-    botones = str(BOTONES_POR_MENSAJE['nuevo_lead'])
 
-    db.crear_mensaje(nuevo_contacto['id'], agente_id, 'nuevo_lead', contenido, botones)
+def _avisar(contacto_id, agente_id, plantilla, parametros=None):
+    """Mensaje de plantilla para el agente; si no se agrupo con un pendiente, suma a su bandeja en el motor."""
+    _, nuevo = db.crear_mensaje_plantilla(contacto_id, agente_id, plantilla, parametros)
+    if nuevo:
+        puntuacion.registrar(agente_id, nuevos=1)
 
-    print(f"--> NOTIFICACION: Lead {nombre} asignado a {agente['nombre']}")
 
-    return jsonify(nuevo_contacto), 201
+def _lead_duplicado(contacto, clave):
+    """Respuesta para un lead que ya existia: sin reasignar ni notificar."""
+    if clave:
+        db.guardar_idempotencia(clave, contacto['id'])
+    print(f"--> DUPLICADO: {contacto['nombre']} ya tiene un lead abierto (id {contacto['id']})")
+    return jsonify(contacto), 200
 
 
 @app.route('/contactos/<int:id>', methods=['PATCH'])
@@ -162,13 +392,34 @@ def update_contacto(id):
     if not nuevo_estado:
         return jsonify({'error': 'Falta el nuevo estado'}), 400
 
-    exito = db.actualizar_estado_contacto(id, nuevo_estado)
+    contacto = db.get_contacto(id) if nuevo_estado in db.ESTADOS_CERRADOS else None
+    try:
+        exito = db.actualizar_estado_contacto(id, nuevo_estado)
+    except sqlite3.IntegrityError:
+        # Reabrir un lead cuyo telefono ya tiene otro lead abierto
+        abierto = db.buscar_lead_abierto(db.get_contacto(id)['telefono'])
+        return jsonify({
+            'error': 'Ya hay un lead abierto con ese telefono',
+            'contacto_abierto_id': abierto['id'] if abierto else None
+        }), 409
     if exito:
+        if contacto and contacto['estado'] not in db.ESTADOS_CERRADOS:
+            puntuacion.registrar(contacto['agente_asignado_id'], cerrados=1)
         return jsonify({'message': 'Estado actualizado'}), 200
     else:
         return jsonify({'error': 'Contacto no encontrado'}), 404
 
 
+@app.route('/contactos/<int:id>/timeline', methods=['GET'])
+@require_auth
+def get_timeline_contacto(id):
+    """Mensajes, respuestas y cambios de estado del lead en orden cronologico."""
+    contacto = db.get_contacto(id)
+    if not contacto:
+        return jsonify({'error': 'Contacto no encontrado'}), 404
+    return jsonify({'contacto': contacto, 'eventos': db.get_timeline(id)})
+
+
 @app.route('/agentes', methods=['GET'])
 @require_auth
 def get_agentes():
@@ -176,34 +427,121 @@ def get_agentes():
     return jsonify(agentes)
 
 
+@app.route('/agentes/<int:agente_id>', methods=['PATCH'])
+@require_auth
+def update_agente(agente_id):
+    """Marca un agente como disponible o no para recibir leads nuevos."""
+    data = request.json or {}
+    if 'disponible' not in data:
+        return jsonify({'error': 'Falta disponible'}), 400
+
+    if not db.actualizar_disponibilidad(agente_id, data['disponible']):
+        return jsonify({'error': 'Agente no encontrado'}), 404
+    puntuacion.obtener_motor(forzar=True)
+    return jsonify(db.get_agente(agente_id))
+
+
+@app.route('/agentes/rebalancear', methods=['POST'])
+@require_auth
+def rebalancear_agentes():
+    """Reparte los leads abiertos de los agentes indicados (licencia, baja)."""
+    data = request.json or {}
+    agentes_ids = data.get('agentes') or []
+    if not agentes_ids:
+        return jsonify({'error': 'Faltan agentes'}), 400
+
+    resultado = reasignacion.rebalancear(agentes_ids, licencia=bool(data.get('licencia')))
+    return jsonify(resultado)
+
+
 @app.route('/propiedades', methods=['GET'])
 @require_auth
 def get_propiedades():
-    propiedades = db.get_propiedades()
-    return jsonify(propiedades)
+    campos = _campos()
+
+    # Sin parametros se mantiene la lista completa para clientes existentes
+    if not any(p in request.args for p in PARAMETROS_CATALOGO):
+        try:
+            propiedades = db.get_propiedades(campos)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(_lista(propiedades, campos))
+
+    ids = request.args.get('ids')
+    try:
+        items, siguiente = db.get_catalogo_propiedades(
+            tipo=request.args.get('tipo'),
+            precio_min=request.args.get('precio_min', type=int),
+            precio_max=request.args.get('precio_max', type=int),
+            agente_id=request.args.get('agente_id', type=int),
+            texto=request.args.get('q'),
+            ids=[int(i) for i in ids.split(',') if i] if ids else None,
+            limite=min(request.args.get('limite', 50, type=int), 200),
+            cursor_pagina=request.args.get('cursor'),
+            campos=campos,
+            sin_precio=request.args.get('sin_precio') in ('1', 'true')
+        )
+    except ValueError:
+        return jsonify({'error': 'Parametros invalidos'}), 400
+
+    return jsonify({
+        'items': _lista(items, campos),
+        'siguiente_cursor': siguiente,
+        'facetas': db.get_facetas_propiedades()
+    })
+
+
+@app.route('/buscar', methods=['GET'])
+@require_auth
+def buscar():
+    texto = request.args.get('q', '').strip()
+    if not texto:
+        return jsonify({'error': 'Parametro q requerido'}), 400
+
+    limite = min(request.args.get('limite', 10, type=int), 50)
+    return jsonify(db.buscar(texto, limite))
 
 
 @app.route('/dashboard', methods=['GET'])
 @require_auth
 def get_dashboard():
     metricas = db.get_metricas()
+    metricas.update(analitica.obtener_kpis())
     return jsonify(metricas)
 
 
+@app.route('/dashboard/embudo', methods=['GET'])
+@require_auth
+def get_dashboard_embudo():
+    filas = analitica.obtener_embudo(
+        desde=request.args.get('desde'),
+        hasta=request.args.get('hasta'),
+        agente_id=request.args.get('agente_id', type=int)
+    )
+    return jsonify(filas)
+
+
 # --- ENDPOINTS DE MENSAJES ---
 
 @app.route('/mensajes/agente/<int:agente_id>', methods=['GET'])
 @require_auth
 def get_mensajes_agente(agente_id):
-    mensajes = db.get_mensajes_agente(agente_id)
-    # Parsear botones de string a lista
+    incluir_archivo = request.args.get('incluir_archivo') in ('1', 'true')
+    campos = _campos()
+    try:
+        mensajes = db.get_mensajes_agente(agente_id, incluir_archivo, campos, desde=request.args.get('desde'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # Parsear botones de string a lista (los de plantilla ya son lista)
     for msg in mensajes:
-        try:
-            msg['botones'] = eval(msg['botones']) if msg['botones'] else []
-        except:
-            msg['botones'] = []
-        msg['respondido'] = bool(msg['respondido'])
-    return jsonify(mensajes)
+        if 'botones' in msg and not isinstance(msg['botones'], list):
+            try:
+                msg['botones'] = eval(msg['botones']) if msg['botones'] else []
+            except:
+                msg['botones'] = []
+        if 'respondido' in msg:
+            msg['respondido'] = bool(msg['respondido'])
+    return jsonify(_lista(mensajes, campos))
 
 
 @app.route('/mensajes/accion', methods=['POST'])
@@ -224,8 +562,10 @@ def ejecutar_accion():
     agente_id = contacto['agente_asignado_id']
     agente = db.get_agente(agente_id)
 
-    # Marcar mensaje como respondido
-    db.responder_mensaje(mensaje_id, accion)
+    # Marcar mensaje como respondido (solo la primera respuesta descuenta la bandeja)
+    agente_mensaje = db.responder_mensaje(mensaje_id, accion)
+    if agente_mensaje is not None:
+        puntuacion.registrar(agente_mensaje, respondidos=1)
 
     # Ejecutar accion
     nuevo_estado = None
@@ -233,50 +573,46 @@ def ejecutar_accion():
 
     if accion == 'confirmar_recepcion':
         nuevo_estado = 'Confirmado'
-        contenido = f"¿Pudiste contactar a {contacto['nombre']}?"
-        botones = str(BOTONES_POR_MENSAJE['pedir_contacto'])
-        db.crear_mensaje(contacto_id, agente_id, 'pedir_contacto', contenido, botones)
+        _avisar(contacto_id, agente_id, 'pedir_contacto')
 
     elif accion == 'rechazar_lead':
-        nuevo_estado = 'Nuevo'
-        # TODO: reasignar
+        nuevo_agente_id = reasignacion.reasignar_rechazo(contacto, agente_id)
+        if nuevo_agente_id:
+            nuevo_agente = db.get_agente(nuevo_agente_id)
+            mensaje_respuesta = f"Lead reasignado a {nuevo_agente['nombre']}"
+        else:
+            # No hay otro agente en la oficina: sigue con el mismo agente, vuelto a 'Nuevo'
+            nuevo_estado = 'Nuevo'
+            mensaje_respuesta = "No hay otro agente disponible en la oficina: el lead sigue asignado a vos"
 
     elif accion == 'marcar_contactado':
         nuevo_estado = 'Contactado'
-        contenido = f"¿Como va la gestion con {contacto['nombre']}?"
-        botones = str(BOTONES_POR_MENSAJE['seguimiento'])
-        db.crear_mensaje(contacto_id, agente_id, 'seguimiento', contenido, botones)
+        _avisar(contacto_id, agente_id, 'seguimiento')
 
     elif accion == 'no_pudo_contactar':
         mensaje_respuesta = "Entendido. Intenta nuevamente pronto."
-        contenido = f"Recordatorio: Intenta contactar a {contacto['nombre']} ({contacto['telefono']})"
-        botones = str(BOTONES_POR_MENSAJE['pedir_contacto'])
-        db.crear_mensaje(contacto_id, agente_id, 'pedir_contacto', contenido, botones)
+        _avisar(contacto_id, agente_id, 'reintentar_contacto')
 
     elif accion == 'cliente_no_contesta':
         mensaje_respuesta = "OK. Te recordaremos en unas horas."
-        contenido = f"¿Pudiste contactar a {contacto['nombre']}? (intento anterior: no contesta)"
-        botones = str(BOTONES_POR_MENSAJE['pedir_contacto'])
-        db.crear_mensaje(contacto_id, agente_id, 'pedir_contacto', contenido, botones)
+        _avisar(contacto_id, agente_id, 'no_contesta')
 
     elif accion == 'marcar_negociacion':
         nuevo_estado = 'En Negociacion'
-        contenido = f"¿Como va la gestion con {contacto['nombre']}?"
-        botones = str(BOTONES_POR_MENSAJE['seguimiento'])
-        db.crear_mensaje(contacto_id, agente_id, 'seguimiento', contenido, botones)
+        _avisar(contacto_id, agente_id, 'seguimiento')
 
     elif accion == 'marcar_cerrado':
         nuevo_estado = 'Cerrado'
-        contenido = f"Felicitaciones! Lead {contacto['nombre']} marcado como cerrado."
-        db.crear_mensaje(contacto_id, agente_id, 'felicitacion', contenido, None)
+        _avisar(contacto_id, agente_id, 'felicitacion')
 
     elif accion == 'marcar_perdido':
         nuevo_estado = 'Perdido'
-        contenido = f"Lead {contacto['nombre']} marcado como perdido. Sigue adelante!"
-        db.crear_mensaje(contacto_id, agente_id, 'felicitacion', contenido, None)
+        _avisar(contacto_id, agente_id, 'lead_perdido')
 
     if nuevo_estado:
         db.actualizar_estado_contacto(contacto_id, nuevo_estado)
+        if nuevo_estado in db.ESTADOS_CERRADOS:
+            puntuacion.registrar(agente_id, cerrados=1)
 
     return jsonify({
         'success': True,
@@ -321,19 +657,8 @@ def buscar_por_telefono():
     if not telefono:
         return jsonify({'error': 'Telefono requerido'}), 400
 
-    contactos = db.get_contactos()
-
-    # Buscar coincidencia (parcial o exacta)
-    encontrados = []
-    for c in contactos:
-        if telefono in c['telefono'] or c['telefono'] in telefono:
-            agente = db.get_agente(c['agente_asignado_id'])
-            propiedad = db.get_propiedad(c['propiedad_id']) if c['propiedad_id'] else None
-            encontrados.append({
-                'contacto': c,
-                'agente': agente,
-                'propiedad': propiedad
-            })
+    # Coincidencia por telefono normalizado, en todas las oficinas
+    encontrados = db.buscar_por_telefono(telefono)
 
     if not encontrados:
         return jsonify({'encontrado': False, 'mensaje': 'Cliente no encontrado'})
@@ -360,52 +685,16 @@ def enviar_seguimiento():
     agente = db.get_agente(agente_id)
     estado_actual = contacto['estado']
 
-    # Generar mensaje segun el contexto
+    # Generar mensaje segun el contexto (plantillas.py)
+    parametros = None
     if tipo_seguimiento == 'llamada_perdida':
-        if estado_actual == 'Cerrado':
-            contenido = f"Postventa: {contacto['nombre']} ({contacto['telefono']}) intento comunicarse. Ya es cliente cerrado."
-            botones = str([
-                {'id': 'atendido', 'label': 'Ya lo atendi', 'accion': 'marcar_atendido_postventa'},
-                {'id': 'llamar', 'label': 'Voy a llamar', 'accion': 'confirmar_llamada'}
-            ])
-        elif estado_actual == 'Perdido':
-            contenido = f"Reactivacion: {contacto['nombre']} ({contacto['telefono']}) llamo nuevamente. Estaba marcado como perdido."
-            botones = str([
-                {'id': 'reactivar', 'label': 'Reactivar lead', 'accion': 'reactivar_lead'},
-                {'id': 'ignorar', 'label': 'No interesa', 'accion': 'mantener_perdido'}
-            ])
-        elif estado_actual in ['Asignado', 'Confirmado']:
-            contenido = f"Llamada perdida: {contacto['nombre']} ({contacto['telefono']}) intento comunicarse. Aun no lo has contactado."
-            botones = str([
-                {'id': 'contactado', 'label': 'Ya lo contacte', 'accion': 'marcar_contactado'},
-                {'id': 'llamar', 'label': 'Voy a llamar', 'accion': 'confirmar_llamada'}
-            ])
-        elif estado_actual == 'Contactado':
-            contenido = f"Seguimiento: {contacto['nombre']} ({contacto['telefono']}) llamo. Ya lo habias contactado antes."
-            botones = str([
-                {'id': 'en_negociacion', 'label': 'En negociacion', 'accion': 'marcar_negociacion'},
-                {'id': 'cerrado', 'label': 'Cerrado', 'accion': 'marcar_cerrado'},
-                {'id': 'perdido', 'label': 'Perdido', 'accion': 'marcar_perdido'}
-            ])
-        elif estado_actual == 'En Negociacion':
-            contenido = f"Cliente activo: {contacto['nombre']} ({contacto['telefono']}) llamo. Esta en negociacion."
-            botones = str([
-                {'id': 'cerrado', 'label': 'Cerrado', 'accion': 'marcar_cerrado'},
-                {'id': 'seguir', 'label': 'Sigo en contacto', 'accion': 'confirmar_seguimiento'},
-                {'id': 'perdido', 'label': 'Perdido', 'accion': 'marcar_perdido'}
-            ])
-        else:
-            contenido = f"Llamada de: {contacto['nombre']} ({contacto['telefono']}). Estado actual: {estado_actual}"
-            botones = str([
-                {'id': 'atendido', 'label': 'Atendido', 'accion': 'marcar_atendido'}
-            ])
+        plantilla = PLANTILLA_LLAMADA_POR_ESTADO.get(estado_actual)
+        if plantilla is None:
+            plantilla, parametros = 'llamada_estado', {'estado': estado_actual}
     else:
-        contenido = f"Seguimiento requerido: {contacto['nombre']} ({contacto['telefono']})"
-        botones = str([
-            {'id': 'atendido', 'label': 'Atendido', 'accion': 'marcar_atendido'}
-        ])
+        plantilla = 'seguimiento_requerido'
 
-    db.crear_mensaje(contacto_id, agente_id, 'seguimiento_llamada', contenido, botones)
+    _avisar(contacto_id, agente_id, plantilla, parametros)
 
     return jsonify({
         'success': True,
@@ -415,4 +704,5 @@ def enviar_seguimiento():
 
 
 if __name__ == '__main__':
+    iniciar_servicio()
     app.run(host='0.0.0.0', port=5000, debug=True)
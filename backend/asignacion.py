@@ -1,25 +1,17 @@
 import pandas as pd
-import os
+import almacenamiento
 import mensajes as msg_module
-
-DATA_DIR = 'data'
+import puntuacion
+from almacenamiento import obtener_almacenamiento
 
 def cargar_datos():
-    agentes = pd.read_csv(os.path.join(DATA_DIR, 'agentes.csv'))
-    propiedades = pd.read_csv(os.path.join(DATA_DIR, 'propiedades.csv'))
-
-    # Cargar contactos si existe, si no crear dataframe vacio
-    contactos_path = os.path.join(DATA_DIR, 'contactos.csv')
-    if os.path.exists(contactos_path):
-        contactos = pd.read_csv(contactos_path)
-    else:
-        contactos = pd.DataFrame(columns=['id', 'nombre', 'telefono', 'fecha', 'propiedad_id', 'estado', 'agente_asignado_id'])
+    almacenamiento = obtener_almacenamiento()
+    agentes = almacenamiento.leer_agentes()
+    propiedades = almacenamiento.leer_propiedades()
+    contactos = almacenamiento.leer_contactos()
 
     return agentes, propiedades, contactos
 
-def guardar_contactos(df_contactos):
-    df_contactos.to_csv(os.path.join(DATA_DIR, 'contactos.csv'), index=False)
-
 def asignar_agente_round_robin(agentes, contactos):
     """
     Asigna al agente con menos carga de contactos.
@@ -34,18 +26,19 @@ def asignar_agente_round_robin(agentes, contactos):
     return int(conteo.idxmin())
 
 
-def asignar_agente(nuevo_contacto_dict):
+def asignar_agente(nuevo_contacto_dict, datos=None):
     """
     Asigna un agente a un nuevo contacto.
 
     Modos de asignacion (campo 'modo_asignacion'):
-    - 'propiedad': Asigna al agente de la propiedad (default si hay propiedad)
+    - 'auto' (default): Agente de mayor puntaje segun puntuacion.py
+    - 'propiedad': Asigna al agente de la propiedad (sino round_robin)
     - 'round_robin': Asigna al agente con menos carga
     - 'manual': Usa el agente_id especificado en el campo 'agente_manual_id'
 
-    Si no hay propiedad y no se especifica modo, usa round_robin.
+    'datos' permite reutilizar las tablas ya cargadas por el llamador.
     """
-    agentes, propiedades, contactos = cargar_datos()
+    agentes, propiedades, contactos = datos if datos is not None else cargar_datos()
 
     agente_asignado_id = None
     modo = nuevo_contacto_dict.get('modo_asignacion', 'auto')
@@ -60,7 +53,27 @@ def asignar_agente(nuevo_contacto_dict):
     elif modo == 'round_robin':
         agente_asignado_id = asignar_agente_round_robin(agentes, contactos)
 
-    # Modo auto o propiedad: primero intenta por propiedad, sino round_robin
+    # Modo auto: puntaje sobre las mismas tablas ya cargadas
+    elif modo == 'auto':
+        propiedad = None
+        propiedad_id = nuevo_contacto_dict.get('propiedad_id')
+        if propiedad_id:
+            fila = propiedades[propiedades['id'] == int(propiedad_id)]
+            if not fila.empty:
+                propiedad = fila.iloc[0].to_dict()
+        lead = puntuacion.lead_desde_propiedad(propiedad)
+        if almacenamiento.BACKEND == 'log':
+            # Sin base SQLite: el motor se arma con las tablas del log
+            mensajes = obtener_almacenamiento().leer_mensajes()
+            motor = puntuacion.MotorPuntuacion().cargar(
+                *puntuacion.caracteristicas_tablas(agentes, propiedades, contactos, mensajes)
+            )
+            agente_asignado_id = motor.mejor_agente(lead)
+        else:
+            # Motor compartido en memoria (misma base que la API), ajustado con cada escritura
+            agente_asignado_id = puntuacion.asignar(lead)
+
+    # Modo propiedad: primero intenta por propiedad, sino round_robin
     else:
         propiedad_id = nuevo_contacto_dict.get('propiedad_id')
         if propiedad_id:
@@ -84,14 +97,9 @@ def crear_contacto(datos):
     """
     agentes, propiedades, contactos = cargar_datos()
 
-    nuevo_id = 1
-    if not contactos.empty:
-        nuevo_id = int(contactos['id'].max()) + 1
-
-    agente_id = asignar_agente(datos)
+    agente_id = asignar_agente(datos, (agentes, propiedades, contactos))
 
     nuevo_contacto = {
-        'id': nuevo_id,
         'nombre': datos['nombre'],
         'telefono': datos['telefono'],
         'fecha': pd.Timestamp.now(),
@@ -100,9 +108,8 @@ def crear_contacto(datos):
         'agente_asignado_id': agente_id
     }
 
-    # Usar pd.concat en lugar de append (deprecated)
-    contactos = pd.concat([contactos, pd.DataFrame([nuevo_contacto])], ignore_index=True)
-    guardar_contactos(contactos)
+    # Una sola escritura; no se reescribe la tabla completa
+    nuevo_contacto['id'] = obtener_almacenamiento().agregar_contacto(nuevo_contacto)
 
     # Generar mensaje inicial para el agente
     agente = agentes[agentes['id'] == agente_id].iloc[0].to_dict()
@@ -117,14 +124,7 @@ def crear_contacto(datos):
     return nuevo_contacto
 
 def actualizar_estado_contacto(contacto_id, nuevo_estado):
-    agentes, propiedades, contactos = cargar_datos()
-
-    if contacto_id in contactos['id'].values:
-        idx = contactos[contactos['id'] == contacto_id].index[0]
-        contactos.at[idx, 'estado'] = nuevo_estado
-        guardar_contactos(contactos)
-        return True
-    return False
+    return obtener_almacenamiento().actualizar_estado_contacto(contacto_id, nuevo_estado)
 
 def obtener_metricas():
     agentes, propiedades, contactos = cargar_datos()
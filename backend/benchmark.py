@@ -0,0 +1,217 @@
+"""
+Micro-benchmarks de database.py (y de los caminos pandas de asignacion.py y
+mensajes.py) sobre bases temporales de varios tamanos.
+
+    python benchmark.py                              # 1k, 100k y 1M contactos
+    python benchmark.py --tamanos 1000,10000,100000  # corrida rapida
+    python benchmark.py --guardar base.json          # guarda la linea base
+    python benchmark.py --comparar base.json         # marca regresiones (--tolerancia 2.0)
+
+Para cada operacion ajusta tiempo ~ n^k entre los tamanos y la marca si k
+supera lo esperado (p. ej. una busqueda por indice que crece como O(n)).
+Sale con codigo 1 si hay operaciones marcadas.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import cache
+import database as db
+
+TAMANOS = (1000, 100000, 1000000)
+
+# Agentes que reciben los contactos generados, y uno con bandeja chica fija
+AGENTES = 50
+MENSAJES_AGENTE_CHICO = 10
+
+# Tiempo minimo y repeticiones maximas por medicion
+MIN_SEG = 0.2
+MAX_REPETICIONES = 50
+
+# Exponente maximo aceptado por crecimiento esperado
+EXPONENTE_MAX = {
+    'log': 0.3,   # indice: casi constante
+    'n': 1.3      # recorre la tabla (o devuelve algo proporcional a n)
+}
+
+# Una medicion es regresion si tarda mas que la linea base por este factor
+# (--tolerancia) y por al menos RUIDO_SEG
+TOLERANCIA = 2.0
+RUIDO_SEG = 0.0005
+
+
+def sembrar(n):
+    """Base con n contactos (un mensaje por contacto, la mitad respondidos)."""
+    db.init_db()
+    conn = db.get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        WITH RECURSIVE s(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM s WHERE i < {AGENTES + 1})
+        INSERT INTO agentes (id, nombre, email, whatsapp) SELECT i, 'Agente ' || i, '', '' FROM s
+    ''')
+    propiedades = max(10, n // 10)
+    cursor.execute(f'''
+        WITH RECURSIVE s(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM s WHERE i < {propiedades})
+        INSERT INTO propiedades (id, direccion, tipo, precio, agente_id)
+        SELECT i, 'Calle ' || i, CASE i % 4 WHEN 0 THEN 'Casa' WHEN 1 THEN 'Departamento'
+                                           WHEN 2 THEN 'Terreno' ELSE 'Local Comercial' END,
+               1000000 + (i * 7919) % 14000000, 1 + i % {AGENTES}
+        FROM s
+    ''')
+    # Los ultimos MENSAJES_AGENTE_CHICO contactos son del agente chico
+    cursor.execute(f'''
+        WITH RECURSIVE s(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM s WHERE i < {n})
+        INSERT INTO contactos (id, nombre, telefono, telefono_normalizado, fecha, fecha_actualizacion,
+                               propiedad_id, estado, agente_asignado_id)
+        SELECT i, 'Contacto ' || i, printf('55%08d', i), printf('55%08d', i),
+               datetime('now', '-' || (i % 2592000) || ' seconds'),
+               datetime('now', '-' || (i % 2592000) || ' seconds'),
+               1 + i % {propiedades},
+               CASE i % 5 WHEN 0 THEN 'Asignado' WHEN 1 THEN 'Contactado' WHEN 2 THEN 'En Negociacion'
+                          WHEN 3 THEN 'Cerrado' ELSE 'Perdido' END,
+               CASE WHEN i > {n - MENSAJES_AGENTE_CHICO} THEN {AGENTES + 1} ELSE 1 + i % {AGENTES} END
+        FROM s
+    ''')
+    cursor.execute('''
+        INSERT INTO mensajes (id, contacto_id, agente_id, tipo, contenido, fecha, respondido, respuesta)
+        SELECT id, id, agente_asignado_id, 'nuevo_lead', 'Nuevo lead asignado: ' || nombre, fecha,
+               id % 2, CASE id % 2 WHEN 1 THEN 'confirmar_recepcion' END
+        FROM contactos
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def medir(funcion):
+    """Mediana de varias ejecuciones (al menos MIN_SEG en total)."""
+    tiempos = []
+    inicio = time.perf_counter()
+    while len(tiempos) < MAX_REPETICIONES and (time.perf_counter() - inicio < MIN_SEG or not tiempos):
+        t0 = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter() - t0)
+    return float(np.median(tiempos)), len(tiempos)
+
+
+def operaciones(n):
+    """(nombre, crecimiento esperado, funcion) medidos sobre la base sembrada."""
+    import asignacion
+    import mensajes
+
+    agente_grande = 1
+    agente_chico = AGENTES + 1
+    nuevos = iter(range(n + 1, n + 1 + MAX_REPETICIONES * 2))
+    # Mensajes pendientes (id par) para responder de a uno
+    pendientes = iter(range(2, n, 2))
+    hace_un_minuto = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - 60))
+
+    return [
+        ('get_contactos', 'n', lambda: db.get_contactos(['id', 'estado', 'agente_asignado_id'])),
+        ('get_contactos_desde', 'log', lambda: db.get_contactos(desde=hace_un_minuto)),
+        ('get_mensajes_agente_chico', 'log', lambda: db.get_mensajes_agente(agente_chico)),
+        ('get_mensajes_agente_grande', 'n', lambda: db.get_mensajes_agente(agente_grande)),
+        ('get_metricas', 'n', db.get_metricas),
+        # Cuenta los contactos de cada agente: recorre el indice completo
+        ('get_agente_menos_carga', 'n', db.get_agente_menos_carga),
+        ('buscar_por_telefono', 'log', lambda: db.buscar_por_telefono(f'55{n // 2:08d}')),
+        ('crear_contacto', 'log', lambda: db.crear_contacto(
+            'Bench', f'66{next(nuevos):08d}', 1, agente_grande)),
+        ('responder_mensaje', 'log', lambda: db.responder_mensaje(next(pendientes), 'bench')),
+        ('pandas_mensajes_agente_chico', 'log', lambda: mensajes.obtener_mensajes_agente(agente_chico)),
+        ('pandas_obtener_metricas', 'n', asignacion.obtener_metricas),
+        ('pandas_round_robin', 'n', lambda: asignacion.asignar_agente(
+            {'nombre': 'Bench', 'modo_asignacion': 'round_robin'})),
+    ]
+
+
+def correr(tamanos):
+    """{operacion: {'esperado', 'tiempos': {n: seg}}}"""
+    resultados = {}
+    ruta_original = db.DB_PATH
+    tamano_cache = cache.TAMANO_MAX
+    # Sin cache de entidades: se mide la base
+    cache.TAMANO_MAX = 0
+    try:
+        for n in tamanos:
+            directorio = tempfile.mkdtemp(prefix='crm_bench_')
+            db.DB_PATH = os.path.join(directorio, 'crm.db')
+            try:
+                inicio = time.perf_counter()
+                sembrar(n)
+                print(f"\n{n} contactos (sembrado en {time.perf_counter() - inicio:.1f} s)")
+                for nombre, esperado, funcion in operaciones(n):
+                    segundos, repeticiones = medir(funcion)
+                    resultados.setdefault(nombre, {'esperado': esperado, 'tiempos': {}})['tiempos'][str(n)] = segundos
+                    print(f"  {nombre:<30} {segundos * 1000:>10.3f} ms  ({repeticiones} rep.)")
+            finally:
+                shutil.rmtree(directorio, ignore_errors=True)
+    finally:
+        db.DB_PATH = ruta_original
+        cache.TAMANO_MAX = tamano_cache
+    return resultados
+
+
+def exponente(tiempos):
+    """Pendiente de log(tiempo) contra log(n): 0 ~ constante, 1 ~ lineal."""
+    tamanos = np.array([int(n) for n in tiempos], dtype=float)
+    segundos = np.maximum(np.array(list(tiempos.values())), 1e-7)
+    if len(tamanos) < 2:
+        return None
+    return float(np.polyfit(np.log(tamanos), np.log(segundos), 1)[0])
+
+
+def analizar(resultados, base=None, tolerancia=TOLERANCIA):
+    """Lista de problemas: crecimiento peor que el esperado o regresion contra la base."""
+    problemas = []
+    print(f"\n{'operacion':<30} {'esperado':>8} {'exponente':>10}")
+    for nombre, datos in resultados.items():
+        k = exponente(datos['tiempos'])
+        datos['exponente'] = k
+        marca = ''
+        if k is not None and k > EXPONENTE_MAX[datos['esperado']]:
+            marca = '  <-- crece mas de lo esperado'
+            problemas.append(f"{nombre}: n^{k:.2f}, se esperaba {datos['esperado']}")
+        print(f"{nombre:<30} {datos['esperado']:>8} {'-' if k is None else f'{k:.2f}':>10}{marca}")
+
+        anteriores = (base or {}).get(nombre, {}).get('tiempos', {})
+        for n, segundos in datos['tiempos'].items():
+            anterior = anteriores.get(n)
+            if anterior and segundos > anterior * tolerancia and segundos - anterior > RUIDO_SEG:
+                problemas.append(f"{nombre} con {n}: {segundos * 1000:.3f} ms, "
+                                 f"linea base {anterior * 1000:.3f} ms")
+    return problemas
+
+
+def _argumento(nombre):
+    if nombre in sys.argv:
+        return sys.argv[sys.argv.index(nombre) + 1]
+    return None
+
+
+if __name__ == '__main__':
+    tamanos = TAMANOS
+    if _argumento('--tamanos'):
+        tamanos = [int(n) for n in _argumento('--tamanos').split(',')]
+
+    base = None
+    if _argumento('--comparar'):
+        with open(_argumento('--comparar')) as f:
+            base = json.load(f)
+
+    resultados = correr(tamanos)
+    problemas = analizar(resultados, base, float(_argumento('--tolerancia') or TOLERANCIA))
+
+    if _argumento('--guardar'):
+        with open(_argumento('--guardar'), 'w') as f:
+            json.dump(resultados, f, indent=2)
+        print(f"\nLinea base guardada en {_argumento('--guardar')}")
+
+    if problemas:
+        print('\nProblemas:')
+        for problema in problemas:
+            print(f'  - {problema}')
+        sys.exit(1)
+    print('\nSin problemas')
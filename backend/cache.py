@@ -0,0 +1,170 @@
+import fcntl
+import os
+import threading
+import time
+from collections import OrderedDict
+import database as db
+
+# Entradas por entidad (contacto, agente, propiedad) y vigencia maxima
+TAMANO_MAX = int(os.environ.get('CRM_CACHE_TAMANO', '2000'))
+TTL_SEG = float(os.environ.get('CRM_CACHE_TTL_SEG', '30'))
+
+ENTIDADES = ('contacto', 'agente', 'propiedad')
+
+
+def ruta_version(entidad):
+    """
+    Marca compartida entre workers: un archivo vacio por entidad cuya fecha
+    de modificacion cambia con cada escritura (data/cache/contacto.version).
+    """
+    return os.path.join(os.path.dirname(db.DB_PATH), 'cache', f'{entidad}.version')
+
+
+def _leer_version(ruta):
+    try:
+        return os.stat(ruta).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class CacheEntidad:
+    """LRU con TTL de filas por id, invalidada por las escrituras de database.py."""
+
+    def __init__(self, entidad, tamano_max=TAMANO_MAX, ttl_seg=TTL_SEG):
+        self.entidad = entidad
+        self.tamano_max = tamano_max
+        self.ttl_seg = ttl_seg
+        self._filas = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._ruta_version = None
+        # Sube con cada invalidacion: una lectura que empezo antes no se guarda
+        self._generacion = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.desalojos = 0
+        self.invalidaciones = 0
+
+    def _sincronizar(self):
+        """Si otro worker escribio (cambio la marca), se descarta todo. Con _lock."""
+        ruta = ruta_version(self.entidad)
+        version = _leer_version(ruta)
+        if ruta != self._ruta_version or version != self._version:
+            if self._filas:
+                self.invalidaciones += len(self._filas)
+                self._filas.clear()
+            self._generacion += 1
+            self._ruta_version, self._version = ruta, version
+
+    def leer(self, entidad_id, cargar):
+        """Fila en cache o cargar() (una copia: quien la recibe puede modificarla)."""
+        with self._lock:
+            self._sincronizar()
+            entrada = self._filas.get(entidad_id)
+            if entrada and entrada[0] > time.monotonic():
+                self._filas.move_to_end(entidad_id)
+                self.aciertos += 1
+                return dict(entrada[1])
+            self.fallos += 1
+            generacion = self._generacion
+
+        fila = cargar()
+        if fila is not None:
+            with self._lock:
+                if self._generacion == generacion:
+                    self._guardar(entidad_id, fila)
+        return fila
+
+    def _guardar(self, entidad_id, fila):
+        self._filas[entidad_id] = (time.monotonic() + self.ttl_seg, dict(fila))
+        self._filas.move_to_end(entidad_id)
+        while len(self._filas) > self.tamano_max:
+            self._filas.popitem(last=False)
+            self.desalojos += 1
+
+    def _marcar_escritura(self):
+        """
+        Avisa a los demas workers. Con _lock, y con flock sobre la marca para
+        que ningun otro worker la cambie entre leerla y escribirla: asi se
+        adopta exactamente la version escrita y nunca una ajena sin invalidar.
+        """
+        ruta = ruta_version(self.entidad)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        with open(ruta, 'a') as marca:
+            fcntl.flock(marca, fcntl.LOCK_EX)
+            self._sincronizar()
+            # Estrictamente mayor que la anterior aunque el reloj retroceda
+            version = max(time.time_ns(), (self._version or 0) + 1)
+            os.utime(ruta, ns=(version, version))
+            self._version = version
+        self._generacion += 1
+
+    def invalidar(self, *ids):
+        with self._lock:
+            self._marcar_escritura()
+            for entidad_id in ids:
+                if self._filas.pop(entidad_id, None) is not None:
+                    self.invalidaciones += 1
+
+    def invalidar_todo(self):
+        with self._lock:
+            self._marcar_escritura()
+            self.invalidaciones += len(self._filas)
+            self._filas.clear()
+
+    def actualizar(self, entidad_id, fila):
+        """Escritura con la fila nueva ya confirmada: reemplaza la entrada."""
+        with self._lock:
+            self._marcar_escritura()
+            self._guardar(entidad_id, fila)
+
+    def estadisticas(self):
+        with self._lock:
+            consultas = self.aciertos + self.fallos
+            return {
+                'entradas': len(self._filas),
+                'tamano_max': self.tamano_max,
+                'ttl_seg': self.ttl_seg,
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'tasa_aciertos': round(self.aciertos / consultas, 3) if consultas else None,
+                'desalojos': self.desalojos,
+                'invalidaciones': self.invalidaciones
+            }
+
+
+_caches = {entidad: CacheEntidad(entidad) for entidad in ENTIDADES}
+
+
+def _clave(entidad_id):
+    try:
+        return int(entidad_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def leer(entidad, entidad_id, cargar):
+    clave = _clave(entidad_id)
+    if clave is None or TAMANO_MAX <= 0:
+        return cargar()
+    return _caches[entidad].leer(clave, cargar)
+
+
+def invalidar(entidad, *ids):
+    _caches[entidad].invalidar(*(c for c in map(_clave, ids) if c is not None))
+
+
+def invalidar_todo(*entidades):
+    for entidad in entidades or ENTIDADES:
+        _caches[entidad].invalidar_todo()
+
+
+def actualizar(entidad, entidad_id, fila):
+    if fila is None:
+        invalidar(entidad, entidad_id)
+    else:
+        _caches[entidad].actualizar(_clave(entidad_id), fila)
+
+
+def estadisticas():
+    return {entidad: c.estadisticas() for entidad, c in _caches.items()}
@@ -1,31 +1,225 @@
+import json
 import sqlite3
 import os
+import re
 import pandas as pd
+import ajuste_sqlite
+import cache
+import escritura
+import fragmentos
+import plantillas
 
+# Base principal: fragmento de la oficina 'central' mientras no se mueva
 DB_PATH = 'data/crm.db'
 DATA_DIR = 'data'
 
+# Vigencia de las claves Idempotency-Key de POST /contactos
+IDEMPOTENCIA_TTL_HORAS = 24
 
-def get_connection():
-    """Obtiene conexion a SQLite."""
-    os.makedirs(DATA_DIR, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+# Lead abierto repetido que se cerro al crear el indice unico por telefono
+ESTADO_DUPLICADO = 'Duplicado'
+
+# Estados en los que un lead ya no esta abierto
+ESTADOS_CERRADOS = ('Cerrado', 'Perdido', ESTADO_DUPLICADO)
+
+# Avisos que se reemplazan entre si: por contacto queda a lo sumo uno
+# pendiente por familia, con un contador de repeticiones
+FAMILIAS_MENSAJE = {
+    'recordatorio_confirmacion': 'confirmacion',
+    'alerta_sin_respuesta': 'confirmacion',
+    'pedir_contacto': 'contacto',
+    'seguimiento': 'seguimiento',
+    'seguimiento_llamada': 'llamada'
+}
+
+# Tope de recencia de la busqueda: se ordenan por relevancia solo las
+# coincidencias mas recientes. Un termino con menos coincidencias da el top
+# exacto; uno muy comun da los mas relevantes entre los mas recientes (bm25
+# sobre todas cuesta ~2 us por fila: 0.5 s con 200k coincidencias)
+RECIENTES_A_RANKEAR = 2000
+
+# Las lecturas incrementales (?desde=) repiten este margen hacia atras, para
+# no perder filas confirmadas tarde con una marca de tiempo anterior
+MARGEN_DELTA_SEG = 5
+
+# Rangos de precio para las facetas del catalogo: (etiqueta, minimo incluido)
+RANGOS_PRECIO = [
+    ('0-2M', 0),
+    ('2M-5M', 2000000),
+    ('5M-10M', 5000000),
+    ('10M+', 10000000)
+]
+
+# Faceta de las propiedades sin tipo o sin precio (se filtran con IS NULL)
+SIN_TIPO = 'Sin tipo'
+SIN_PRECIO = 'Sin precio'
+
+
+def get_connection(ruta=None):
+    """Obtiene conexion a SQLite (por defecto, la base principal) con el perfil de ajuste_sqlite.py."""
+    ruta = ruta or DB_PATH
+    os.makedirs(os.path.dirname(ruta) or '.', exist_ok=True)
+    conn = sqlite3.connect(ruta)
     conn.row_factory = sqlite3.Row
+    ajuste_sqlite.configurar(conn, ruta)
     return conn
 
 
+# Fragmentos por oficina (ver fragmentos.py)
+
+def mapa_fragmentos():
+    return fragmentos.cargar_mapa(DB_PATH)
+
+
+def rutas():
+    """Archivos de todos los fragmentos, la base principal primero."""
+    resultado = [DB_PATH]
+    for datos in mapa_fragmentos().values():
+        if datos['ruta'] not in resultado:
+            resultado.append(datos['ruta'])
+    return resultado
+
+
+def ruta_oficina(oficina):
+    mapa = mapa_fragmentos()
+    if oficina not in mapa:
+        raise ValueError(f'Oficina desconocida: {oficina}')
+    return mapa[oficina]['ruta']
+
+
+def ruta_para_id(entidad_id):
+    """Fragmento que guarda el agente, propiedad, contacto o mensaje con ese id."""
+    if entidad_id is None:
+        return ruta_oficina(fragmentos.OFICINA_PRINCIPAL)
+    mapa = mapa_fragmentos()
+    return mapa[fragmentos.oficina_de_id(mapa, entidad_id)]['ruta']
+
+
+def ruta_archivo(ruta):
+    """Base de mensajes archivados de un fragmento: crm.db -> crm_archivo.db."""
+    base, extension = os.path.splitext(ruta)
+    return f'{base}_archivo{extension}'
+
+
+def _nuevo_id(cursor, tabla, oficina_de, cantidad=1):
+    """
+    Siguiente id libre del bloque de la oficina duena de 'oficina_de' (un id
+    del mismo bloque, o None para la principal); con cantidad reserva ids
+    consecutivos y retorna el primero. La tabla secuencias solo avanza: un id
+    cuya fila se archivo o borro no se vuelve a entregar. Corre dentro de la
+    transaccion de escritura, por lo que no hay carreras entre escritores.
+    """
+    mapa = mapa_fragmentos()
+    oficina = fragmentos.oficina_de_id(mapa, oficina_de or 0)
+    inicio, fin = fragmentos.rango_ids(mapa[oficina]['numero'])
+    # MAX(id) cubre filas insertadas con id explicito (migracion, sembradores)
+    cursor.execute(f'''
+        INSERT INTO secuencias (tabla, bloque, ultimo)
+        SELECT ?, ?, COALESCE(MAX(id), ?) + ? FROM {tabla} WHERE id BETWEEN ? AND ?
+        ON CONFLICT (tabla, bloque) DO UPDATE SET ultimo = MAX(ultimo + ?, excluded.ultimo)
+        RETURNING ultimo
+    ''', (tabla, inicio, inicio, cantidad, inicio, fin, cantidad))
+    return cursor.fetchone()[0] - cantidad + 1
+
+
+def _consultar_todos(query, params=()):
+    """Ejecuta la consulta en cada fragmento y junta las filas."""
+    filas = []
+    for ruta in rutas():
+        conn = get_connection(ruta)
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        filas.extend(dict(row) for row in cursor.fetchall())
+        conn.close()
+    return filas
+
+
+def _consultar_uno(entidad_id, query, params):
+    """Una fila del fragmento que guarda entidad_id."""
+    conn = get_connection(ruta_para_id(entidad_id))
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+_columnas_tabla = {}
+
+
+def proyeccion(tabla, campos, prefijo='', obligatorios=('id',)):
+    """
+    Columnas para el SELECT a partir de ?fields= (lista de nombres). Sin
+    campos retorna todas; un nombre que no es columna da ValueError.
+    """
+    if not campos:
+        return f'{prefijo}*'
+    if tabla not in _columnas_tabla:
+        conn = get_connection()
+        _columnas_tabla[tabla] = [row[1] for row in conn.execute(f'PRAGMA table_info({tabla})')]
+        conn.close()
+    desconocidos = set(campos) - set(_columnas_tabla[tabla])
+    if desconocidos:
+        raise ValueError(f"Campos desconocidos: {', '.join(sorted(desconocidos))}")
+    elegidos = [c for c in obligatorios if c not in campos] + list(campos)
+    return ', '.join(f'{prefijo}{c}' for c in elegidos)
+
+
+def _escribir(operacion, ruta=None):
+    """
+    Ejecuta operacion(cursor) en un fragmento y confirma. Con el escritor
+    agrupado activo (CRM_ESCRITURA_VENTANA_MS > 0) se comparte el commit con
+    otras peticiones; hay un escritor por fragmento.
+    """
+    ruta = ruta or DB_PATH
+    if escritura.activo():
+        escritor = escritura.obtener_escritor(ruta, lambda: get_connection(ruta))
+        return escritor.enviar(operacion).result()
+
+    conn = get_connection(ruta)
+    try:
+        resultado = operacion(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+    return resultado
+
+
+def normalizar_telefono(telefono):
+    """Deja solo los ultimos 10 digitos, sin extension ni prefijo de pais."""
+    if not telefono:
+        return None
+    numero = re.split(r'\s*(?:x|ext\.?)\s*\d*$', str(telefono).strip().lower())[0]
+    digitos = re.sub(r'\D', '', numero)
+    return digitos[-10:] or None
+
+
 def init_db():
-    """Crea las tablas si no existen."""
-    conn = get_connection()
+    """Crea las tablas si no existen, en cada fragmento."""
+    for ruta in rutas():
+        init_fragmento(ruta)
+
+
+def init_fragmento(ruta):
+    """Esquema completo de un fragmento."""
+    conn = get_connection(ruta)
     cursor = conn.cursor()
 
+    # auto_vacuum incremental para que retencion.py libere espacio por pasos.
+    # Solo rige si se fija antes de crear la primera tabla; una base existente
+    # se convierte una vez con 'python retencion.py --auto-vacuum' (VACUUM)
+    cursor.execute('SELECT COUNT(*) FROM sqlite_master')
+    if cursor.fetchone()[0] == 0:
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS agentes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             nombre TEXT NOT NULL,
             email TEXT,
             whatsapp TEXT,
-            carga_trabajo INTEGER DEFAULT 0
+            carga_trabajo INTEGER DEFAULT 0,
+            disponible INTEGER DEFAULT 1
         )
     ''')
 
@@ -49,6 +243,8 @@ def init_db():
             propiedad_id INTEGER,
             estado TEXT DEFAULT 'Asignado',
             agente_asignado_id INTEGER,
+            fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            telefono_normalizado TEXT,
             FOREIGN KEY (propiedad_id) REFERENCES propiedades(id),
             FOREIGN KEY (agente_asignado_id) REFERENCES agentes(id)
         )
@@ -65,18 +261,387 @@ def init_db():
             fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             respondido INTEGER DEFAULT 0,
             respuesta TEXT,
+            fecha_respuesta TIMESTAMP,
             FOREIGN KEY (contacto_id) REFERENCES contactos(id),
             FOREIGN KEY (agente_id) REFERENCES agentes(id)
         )
     ''')
 
+    # Columnas agregadas despues de la primera version del esquema
+    if _agregar_columna(cursor, 'contactos', 'fecha_actualizacion', 'TIMESTAMP'):
+        cursor.execute('UPDATE contactos SET fecha_actualizacion = fecha')
+    _agregar_columna(cursor, 'mensajes', 'fecha_respuesta', 'TIMESTAMP')
+    _agregar_columna(cursor, 'contactos', 'telefono_normalizado', 'TEXT')
+    _agregar_columna(cursor, 'agentes', 'disponible', 'INTEGER DEFAULT 1')
+    _agregar_columna(cursor, 'mensajes', 'familia', 'TEXT')
+    _agregar_columna(cursor, 'mensajes', 'repeticiones', 'INTEGER DEFAULT 1')
+    # Mensajes guardados como plantilla + parametros (contenido vacio, ver plantillas.py)
+    _agregar_columna(cursor, 'mensajes', 'plantilla', 'TEXT')
+    _agregar_columna(cursor, 'mensajes', 'parametros', 'TEXT')
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_contactos_fecha ON contactos(fecha)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_contactos_actualizacion ON contactos(fecha_actualizacion)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mensajes_respuesta ON mensajes(fecha_respuesta)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mensajes_agente_fecha ON mensajes(agente_id, fecha)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mensajes_fecha ON mensajes(fecha)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mensajes_pendientes ON mensajes(agente_id) WHERE respondido = 0')
+    # (contacto_id, fecha) reemplaza al indice solo por contacto: timeline ordenado
+    cursor.execute('DROP INDEX IF EXISTS idx_mensajes_contacto')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mensajes_contacto_fecha ON mensajes(contacto_id, fecha)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_contactos_agente ON contactos(agente_asignado_id, estado)')
+
+    _crear_indice_pendientes(cursor)
+
+    # Claves de idempotencia de POST /contactos
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS idempotencia (
+            clave TEXT PRIMARY KEY,
+            contacto_id INTEGER NOT NULL,
+            expira TIMESTAMP NOT NULL,
+            FOREIGN KEY (contacto_id) REFERENCES contactos(id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_idempotencia_expira ON idempotencia(expira)')
+
+    # Ultimo id entregado por tabla y bloque de oficina (ver _nuevo_id)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS secuencias (
+            tabla TEXT NOT NULL,
+            bloque INTEGER NOT NULL,
+            ultimo INTEGER NOT NULL,
+            PRIMARY KEY (tabla, bloque)
+        )
+    ''')
+    _secuencias_archivo(cursor, ruta)
+
+    _crear_busqueda(cursor)
+    _crear_facetas(cursor)
+    _crear_historial(cursor)
+    # Despues del historial: los duplicados que cierre quedan registrados
+    _crear_indice_leads_abiertos(conn)
+
+    # Resumenes precalculados por analitica.py (dia, agente)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS resumen_embudo (
+            dia TEXT NOT NULL,
+            agente_id INTEGER NOT NULL,
+            asignados INTEGER DEFAULT 0,
+            confirmados INTEGER DEFAULT 0,
+            contactados INTEGER DEFAULT 0,
+            en_negociacion INTEGER DEFAULT 0,
+            cerrados INTEGER DEFAULT 0,
+            perdidos INTEGER DEFAULT 0,
+            PRIMARY KEY (dia, agente_id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS resumen_respuesta (
+            dia TEXT NOT NULL,
+            agente_id INTEGER NOT NULL,
+            respondidos INTEGER DEFAULT 0,
+            promedio_seg REAL,
+            p50_seg REAL,
+            p90_seg REAL,
+            p99_seg REAL,
+            PRIMARY KEY (dia, agente_id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS resumen_control (
+            nombre TEXT PRIMARY KEY,
+            valor TEXT
+        )
+    ''')
+
     conn.commit()
     conn.close()
 
 
+def _agregar_columna(cursor, tabla, columna, definicion):
+    """Agrega una columna si no existe. Retorna True si la agrego."""
+    cursor.execute(f'PRAGMA table_info({tabla})')
+    if columna in [row[1] for row in cursor.fetchall()]:
+        return False
+    cursor.execute(f'ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}')
+    return True
+
+
+def _secuencias_archivo(cursor, ruta):
+    """
+    La secuencia de mensajes arranca despues del mayor id archivado de cada
+    bloque: en bases anteriores a secuencias el archivo puede tener ids mas
+    altos que los que quedan en el fragmento.
+    """
+    archivo = ruta_archivo(ruta)
+    if not os.path.exists(archivo):
+        return
+    conn = sqlite3.connect(archivo)
+    maximos = []
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'mensajes'").fetchone():
+        for datos in mapa_fragmentos().values():
+            inicio, fin = fragmentos.rango_ids(datos['numero'])
+            ultimo = conn.execute('SELECT MAX(id) FROM mensajes WHERE id BETWEEN ? AND ?',
+                                  (inicio, fin)).fetchone()[0]
+            if ultimo is not None:
+                maximos.append((inicio, ultimo))
+    conn.close()
+    cursor.executemany('''
+        INSERT INTO secuencias (tabla, bloque, ultimo) VALUES ('mensajes', ?, ?)
+        ON CONFLICT (tabla, bloque) DO UPDATE SET ultimo = MAX(ultimo, excluded.ultimo)
+    ''', maximos)
+
+
+def _crear_indice_pendientes(cursor):
+    """
+    Indice unico de avisos pendientes por (contacto, familia). La primera vez
+    asigna la familia a los mensajes existentes y deja solo el pendiente mas
+    nuevo de cada grupo; los anteriores quedan respondidos como 'reemplazado'.
+    """
+    cursor.execute('''
+        SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_mensajes_pendiente_familia'
+    ''')
+    if cursor.fetchone():
+        return
+
+    cursor.executemany(
+        'UPDATE mensajes SET familia = ? WHERE tipo = ? AND familia IS NULL',
+        [(familia, tipo) for tipo, familia in FAMILIAS_MENSAJE.items()]
+    )
+    cursor.execute('''
+        UPDATE mensajes SET repeticiones = g.total
+        FROM (SELECT MAX(id) AS id, COUNT(*) AS total FROM mensajes
+              WHERE respondido = 0 AND familia IS NOT NULL
+              GROUP BY contacto_id, familia HAVING COUNT(*) > 1) g
+        WHERE mensajes.id = g.id
+    ''')
+    cursor.execute('''
+        UPDATE mensajes SET respondido = 1, respuesta = 'reemplazado', fecha_respuesta = CURRENT_TIMESTAMP
+        WHERE respondido = 0 AND familia IS NOT NULL
+          AND id NOT IN (SELECT MAX(id) FROM mensajes
+                         WHERE respondido = 0 AND familia IS NOT NULL
+                         GROUP BY contacto_id, familia)
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX ux_mensajes_pendiente_familia ON mensajes(contacto_id, familia)
+        WHERE respondido = 0 AND familia IS NOT NULL
+    ''')
+
+
+def _crear_indice_leads_abiertos(conn):
+    """
+    Indice unico por telefono normalizado entre los leads abiertos.
+
+    Se crea la primera vez o si cambio ESTADOS_CERRADOS: normaliza los
+    telefonos que falten y, si hay leads abiertos duplicados, deja abierto el
+    mas antiguo y cierra los demas como ESTADO_DUPLICADO (con su cambio en el
+    historial y sus avisos pendientes respondidos). Todos conservan el
+    telefono normalizado, asi la busqueda por telefono los sigue encontrando.
+    """
+    cursor = conn.cursor()
+    predicado = f'estado NOT IN {ESTADOS_CERRADOS}'
+    cursor.execute('''
+        SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'ux_contactos_lead_abierto'
+    ''')
+    row = cursor.fetchone()
+    if row and predicado in row[0]:
+        return
+
+    cursor.execute('DROP INDEX IF EXISTS ux_contactos_lead_abierto')
+    conn.create_function('normalizar_telefono', 1, normalizar_telefono)
+    cursor.execute('''
+        UPDATE contactos SET telefono_normalizado = normalizar_telefono(telefono)
+        WHERE telefono_normalizado IS NULL
+    ''')
+
+    cursor.execute(f'''
+        SELECT c.id, c.estado, c.agente_asignado_id, o.id AS original
+        FROM contactos c
+        JOIN (SELECT telefono_normalizado, MIN(id) AS id FROM contactos
+              WHERE {predicado} AND telefono_normalizado IS NOT NULL
+              GROUP BY telefono_normalizado HAVING COUNT(*) > 1) o
+          ON o.telefono_normalizado = c.telefono_normalizado
+        WHERE c.{predicado} AND c.id <> o.id
+    ''')
+    duplicados = cursor.fetchall()
+    if duplicados:
+        cursor.executemany('''
+            INSERT INTO historial_estados (contacto_id, estado_anterior, estado, agente_id) VALUES (?, ?, ?, ?)
+        ''', [(d['id'], d['estado'], ESTADO_DUPLICADO, d['agente_asignado_id']) for d in duplicados])
+        cursor.executemany('''
+            UPDATE contactos SET estado = ?, fecha_actualizacion = CURRENT_TIMESTAMP WHERE id = ?
+        ''', [(ESTADO_DUPLICADO, d['id']) for d in duplicados])
+        cursor.executemany('''
+            UPDATE mensajes SET respondido = 1, respuesta = 'duplicado', fecha_respuesta = CURRENT_TIMESTAMP
+            WHERE contacto_id = ? AND respondido = 0
+        ''', [(d['id'],) for d in duplicados])
+        for d in duplicados:
+            print(f"--> DUPLICADO: lead {d['id']} cerrado como {ESTADO_DUPLICADO} (queda abierto el {d['original']})")
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_contactos_telefono_norm ON contactos(telefono_normalizado)')
+    cursor.execute(f'''
+        CREATE UNIQUE INDEX ux_contactos_lead_abierto ON contactos(telefono_normalizado)
+        WHERE {predicado}
+    ''')
+
+
+def _crear_busqueda(cursor):
+    """Tablas FTS5 sobre contactos y propiedades, sincronizadas por triggers."""
+    cursor.execute("SELECT name FROM sqlite_master WHERE name IN ('contactos_fts', 'propiedades_fts')")
+    existentes = {row[0] for row in cursor.fetchall()}
+
+    # remove_diacritics 2: 'jose' encuentra 'José', 'peña' encuentra 'Pena'
+    tokenizador = "unicode61 remove_diacritics 2"
+
+    cursor.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS contactos_fts USING fts5(
+            nombre,
+            content='contactos', content_rowid='id',
+            tokenize="{tokenizador}", prefix='2 3'
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS propiedades_fts USING fts5(
+            direccion, tipo,
+            content='propiedades', content_rowid='id',
+            tokenize="{tokenizador}", prefix='2 3'
+        )
+    ''')
+
+    cursor.executescript('''
+        CREATE TRIGGER IF NOT EXISTS contactos_fts_ai AFTER INSERT ON contactos BEGIN
+            INSERT INTO contactos_fts (rowid, nombre) VALUES (new.id, new.nombre);
+        END;
+        CREATE TRIGGER IF NOT EXISTS contactos_fts_ad AFTER DELETE ON contactos BEGIN
+            INSERT INTO contactos_fts (contactos_fts, rowid, nombre) VALUES ('delete', old.id, old.nombre);
+        END;
+        CREATE TRIGGER IF NOT EXISTS contactos_fts_au AFTER UPDATE OF nombre ON contactos BEGIN
+            INSERT INTO contactos_fts (contactos_fts, rowid, nombre) VALUES ('delete', old.id, old.nombre);
+            INSERT INTO contactos_fts (rowid, nombre) VALUES (new.id, new.nombre);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS propiedades_fts_ai AFTER INSERT ON propiedades BEGIN
+            INSERT INTO propiedades_fts (rowid, direccion, tipo) VALUES (new.id, new.direccion, new.tipo);
+        END;
+        CREATE TRIGGER IF NOT EXISTS propiedades_fts_ad AFTER DELETE ON propiedades BEGIN
+            INSERT INTO propiedades_fts (propiedades_fts, rowid, direccion, tipo)
+            VALUES ('delete', old.id, old.direccion, old.tipo);
+        END;
+        CREATE TRIGGER IF NOT EXISTS propiedades_fts_au AFTER UPDATE OF direccion, tipo ON propiedades BEGIN
+            INSERT INTO propiedades_fts (propiedades_fts, rowid, direccion, tipo)
+            VALUES ('delete', old.id, old.direccion, old.tipo);
+            INSERT INTO propiedades_fts (rowid, direccion, tipo) VALUES (new.id, new.direccion, new.tipo);
+        END;
+    ''')
+
+    # Indexar filas que ya existian antes de crear las tablas
+    if 'contactos_fts' not in existentes:
+        cursor.execute("INSERT INTO contactos_fts (contactos_fts) VALUES ('rebuild')")
+    if 'propiedades_fts' not in existentes:
+        cursor.execute("INSERT INTO propiedades_fts (propiedades_fts) VALUES ('rebuild')")
+
+
+def _rango_precio_sql(columna):
+    """Expresion CASE que asigna el rango de precio de RANGOS_PRECIO."""
+    casos = ' '.join(
+        f"WHEN {columna} >= {minimo} THEN '{etiqueta}'"
+        for etiqueta, minimo in reversed(RANGOS_PRECIO)
+    )
+    return f"CASE {casos} ELSE '{SIN_PRECIO}' END"
+
+
+def _crear_facetas(cursor):
+    """Indices del catalogo y conteos por faceta mantenidos por triggers."""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_propiedades_precio ON propiedades(precio, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_propiedades_tipo_precio ON propiedades(tipo, precio, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_propiedades_agente_precio ON propiedades(agente_id, precio, id)')
+
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'propiedades_facetas'")
+    existia = cursor.fetchone() is not None
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS propiedades_facetas (
+            faceta TEXT NOT NULL,
+            valor TEXT NOT NULL,
+            total INTEGER DEFAULT 0,
+            PRIMARY KEY (faceta, valor)
+        )
+    ''')
+
+    def sumar(fila, delta):
+        return f'''
+            INSERT INTO propiedades_facetas (faceta, valor, total)
+            VALUES ('tipo', COALESCE({fila}.tipo, '{SIN_TIPO}'), {delta})
+            ON CONFLICT (faceta, valor) DO UPDATE SET total = total + {delta};
+            INSERT INTO propiedades_facetas (faceta, valor, total)
+            VALUES ('precio', {_rango_precio_sql(f'{fila}.precio')}, {delta})
+            ON CONFLICT (faceta, valor) DO UPDATE SET total = total + {delta};
+        '''
+
+    cursor.executescript(f'''
+        CREATE TRIGGER IF NOT EXISTS propiedades_facetas_ai AFTER INSERT ON propiedades BEGIN
+            {sumar('new', 1)}
+        END;
+        CREATE TRIGGER IF NOT EXISTS propiedades_facetas_ad AFTER DELETE ON propiedades BEGIN
+            {sumar('old', -1)}
+        END;
+        CREATE TRIGGER IF NOT EXISTS propiedades_facetas_au AFTER UPDATE OF tipo, precio ON propiedades BEGIN
+            {sumar('old', -1)}
+            {sumar('new', 1)}
+        END;
+    ''')
+
+    # Conteo inicial de las propiedades que ya existian
+    if not existia:
+        cursor.execute(f'''
+            INSERT INTO propiedades_facetas (faceta, valor, total)
+            SELECT 'tipo', COALESCE(tipo, '{SIN_TIPO}'), COUNT(*) FROM propiedades GROUP BY 2
+            UNION ALL
+            SELECT 'precio', {_rango_precio_sql('precio')}, COUNT(*) FROM propiedades GROUP BY 2
+        ''')
+
+
+def _crear_historial(cursor):
+    """
+    Cambios de estado de cada contacto. Sin columna id propia: al mover una
+    oficina las filas se copian sin chocar con las del fragmento destino.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'historial_estados'")
+    existia = cursor.fetchone() is not None
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS historial_estados (
+            contacto_id INTEGER NOT NULL,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            estado_anterior TEXT,
+            estado TEXT NOT NULL,
+            agente_id INTEGER,
+            FOREIGN KEY (contacto_id) REFERENCES contactos(id)
+        )
+    ''')
+    # Cubre la consulta del timeline: se lee solo el indice
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_historial_contacto_fecha
+        ON historial_estados(contacto_id, fecha, estado_anterior, estado, agente_id)
+    ''')
+
+    # Estado vigente de los contactos que ya existian
+    if not existia:
+        _historial_inicial(cursor)
+
+
+def _historial_inicial(cursor):
+    cursor.execute('''
+        INSERT INTO historial_estados (contacto_id, fecha, estado, agente_id)
+        SELECT id, COALESCE(fecha_actualizacion, fecha), estado, agente_asignado_id FROM contactos
+        WHERE id NOT IN (SELECT contacto_id FROM historial_estados)
+    ''')
+
+
 def migrate_from_csv():
-    """Migra datos existentes de CSV a SQLite."""
-    conn = get_connection()
+    """Migra datos existentes de CSV a SQLite (oficina principal)."""
+    conn = get_connection(ruta_oficina(fragmentos.OFICINA_PRINCIPAL))
     cursor = conn.cursor()
 
     # Verificar si ya hay datos
@@ -112,18 +677,23 @@ def migrate_from_csv():
     contactos_csv = os.path.join(DATA_DIR, 'contactos.csv')
     if os.path.exists(contactos_csv):
         df = pd.read_csv(contactos_csv)
+        # Se recrea al final, normalizando telefonos y resolviendo duplicados
+        cursor.execute('DROP INDEX IF EXISTS ux_contactos_lead_abierto')
         for _, row in df.iterrows():
             cursor.execute('''
                 INSERT INTO contactos (id, nombre, telefono, fecha, propiedad_id, estado, agente_asignado_id)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (row['id'], row['nombre'], row['telefono'], row['fecha'],
                   row.get('propiedad_id'), row['estado'], row.get('agente_asignado_id')))
+        _historial_inicial(cursor)
         print(f"Migrados {len(df)} contactos")
 
     # Migrar mensajes si existen
     mensajes_csv = os.path.join(DATA_DIR, 'mensajes.csv')
     if os.path.exists(mensajes_csv):
         df = pd.read_csv(mensajes_csv)
+        # Se recrea al final, agrupando los avisos pendientes repetidos
+        cursor.execute('DROP INDEX IF EXISTS ux_mensajes_pendiente_familia')
         for _, row in df.iterrows():
             cursor.execute('''
                 INSERT INTO mensajes (id, contacto_id, agente_id, tipo, contenido, botones, fecha, respondido, respuesta)
@@ -133,143 +703,506 @@ def migrate_from_csv():
                   1 if row.get('respondido') else 0, row.get('respuesta')))
         print(f"Migrados {len(df)} mensajes")
 
+    _crear_indice_leads_abiertos(conn)
+    _crear_indice_pendientes(cursor)
+
     conn.commit()
     conn.close()
+    cache.invalidar_todo()
     print("Migracion completada")
 
 
 # Funciones de acceso a datos
+#
+# Las lecturas por id van al fragmento de ese id; los listados y metricas
+# consultan todos los fragmentos y juntan el resultado.
 
 def get_agentes():
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM agentes')
-    rows = cursor.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    return _consultar_todos('SELECT * FROM agentes')
 
 
 def get_agente(agente_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM agentes WHERE id = ?', (agente_id,))
-    row = cursor.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    return cache.leer('agente', agente_id, lambda: _consultar_uno(
+        agente_id, 'SELECT * FROM agentes WHERE id = ?', (agente_id,)
+    ))
 
 
-def get_propiedades():
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM propiedades')
-    rows = cursor.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+def crear_agente(nombre, email, whatsapp, oficina=fragmentos.OFICINA_PRINCIPAL):
+    """Da de alta un agente en el fragmento y bloque de ids de su oficina."""
+    ruta = ruta_oficina(oficina)
+    inicio, _ = fragmentos.rango_ids(mapa_fragmentos()[oficina]['numero'])
+
+    def operacion(cursor):
+        nuevo_id = _nuevo_id(cursor, 'agentes', inicio)
+        cursor.execute('''
+            INSERT INTO agentes (id, nombre, email, whatsapp) VALUES (?, ?, ?, ?)
+        ''', (nuevo_id, nombre, email, whatsapp))
+        return nuevo_id
+
+    return get_agente(_escribir(operacion, ruta))
+
+
+def get_propiedades(campos=None):
+    return _consultar_todos(f'SELECT {proyeccion("propiedades", campos)} FROM propiedades')
+
+
+def crear_propiedad(direccion, tipo, precio, agente_id):
+    """La propiedad queda en la oficina de su agente."""
+    def operacion(cursor):
+        nuevo_id = _nuevo_id(cursor, 'propiedades', agente_id)
+        cursor.execute('''
+            INSERT INTO propiedades (id, direccion, tipo, precio, agente_id) VALUES (?, ?, ?, ?, ?)
+        ''', (nuevo_id, direccion, tipo, precio, agente_id))
+        return nuevo_id
+
+    return get_propiedad(_escribir(operacion, ruta_para_id(agente_id)))
+
+
+def get_catalogo_propiedades(tipo=None, precio_min=None, precio_max=None, agente_id=None,
+                             texto=None, ids=None, limite=50, cursor_pagina=None, campos=None,
+                             sin_precio=False):
+    """
+    Pagina del catalogo ordenada por (precio, id), con filtros opcionales.
+    Las propiedades sin precio van primero, como en el indice.
+
+    cursor_pagina es el 'precio:id' de la ultima fila de la pagina anterior
+    ('null:id' si no tenia precio); la paginacion por llave evita OFFSET y usa
+    los indices compuestos. Cada fragmento aporta su propia pagina y se
+    mezclan por (precio, id); por eso la proyeccion siempre incluye precio e id.
+    tipo SIN_TIPO y sin_precio filtran las propiedades sin tipo o sin precio.
+    """
+    columnas = proyeccion('propiedades', campos, 'p.', obligatorios=('id', 'precio'))
+    condiciones = []
+    params = []
+    if tipo == SIN_TIPO:
+        condiciones.append('p.tipo IS NULL')
+    elif tipo:
+        condiciones.append('p.tipo = ?')
+        params.append(tipo)
+    if sin_precio:
+        condiciones.append('p.precio IS NULL')
+    if agente_id:
+        condiciones.append('p.agente_id = ?')
+        params.append(agente_id)
+    if precio_min is not None:
+        condiciones.append('p.precio >= ?')
+        params.append(precio_min)
+    if precio_max is not None:
+        condiciones.append('p.precio <= ?')
+        params.append(precio_max)
+    if ids:
+        condiciones.append(f"p.id IN ({', '.join(['?'] * len(ids))})")
+        params.extend(ids)
+    consulta = consulta_fts(texto)
+    if consulta:
+        condiciones.append('p.id IN (SELECT rowid FROM propiedades_fts WHERE propiedades_fts MATCH ?)')
+        params.append(consulta)
+    if cursor_pagina:
+        ultimo_precio, ultimo_id = cursor_pagina.split(':')
+        if ultimo_precio == 'null':
+            condiciones.append('(p.precio IS NOT NULL OR p.id > ?)')
+            params.append(int(ultimo_id))
+        else:
+            condiciones.append('(p.precio > ? OR (p.precio = ? AND p.id > ?))')
+            params.extend([int(ultimo_precio), int(ultimo_precio), int(ultimo_id)])
+
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ''
+
+    # Con agente_id solo hace falta su fragmento
+    fuentes = [ruta_para_id(agente_id)] if agente_id else rutas()
+    rows = []
+    for ruta in fuentes:
+        conn = get_connection(ruta)
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT {columnas} FROM propiedades p
+            {where}
+            ORDER BY p.precio, p.id
+            LIMIT ?
+        ''', params + [limite + 1])
+        rows.extend(dict(row) for row in cursor.fetchall())
+        conn.close()
+
+    if len(fuentes) > 1:
+        rows.sort(key=lambda p: (p['precio'] is not None, p['precio'] or 0, p['id']))
+
+    siguiente = None
+    if len(rows) > limite:
+        rows = rows[:limite]
+        ultimo = rows[-1]
+        siguiente = f"{'null' if ultimo['precio'] is None else ultimo['precio']}:{ultimo['id']}"
+    return rows, siguiente
+
+
+def get_facetas_propiedades():
+    """Conteos por tipo y rango de precio desde propiedades_facetas."""
+    facetas = {'tipo': {}, 'precio': {}}
+    for row in _consultar_todos('SELECT faceta, valor, total FROM propiedades_facetas WHERE total > 0'):
+        valores = facetas.setdefault(row['faceta'], {})
+        valores[row['valor']] = valores.get(row['valor'], 0) + row['total']
+    return facetas
 
 
 def get_propiedad(propiedad_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM propiedades WHERE id = ?', (propiedad_id,))
-    row = cursor.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    return cache.leer('propiedad', propiedad_id, lambda: _consultar_uno(
+        propiedad_id, 'SELECT * FROM propiedades WHERE id = ?', (propiedad_id,)
+    ))
 
 
-def get_contactos():
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM contactos ORDER BY fecha DESC')
-    rows = cursor.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+def get_contactos(campos=None, desde=None):
+    """Todos los contactos, o con desde solo los modificados a partir de esa marca."""
+    # Con varios fragmentos se mezclan por fecha, que entonces hace falta leer.
+    # Los deltas tambien se ordenan aqui: con ORDER BY fecha SQLite recorre
+    # idx_contactos_fecha completo en vez del rango de idx_contactos_actualizacion
+    ordenar = len(rutas()) > 1 or bool(desde)
+    obligatorios = ('id', 'fecha') if ordenar else ('id',)
+    columnas = proyeccion('contactos', campos, obligatorios=obligatorios)
+    if desde:
+        contactos = _consultar_todos(f'''
+            SELECT {columnas} FROM contactos
+            WHERE fecha_actualizacion >= datetime(?, ?)
+        ''', (desde, f'-{MARGEN_DELTA_SEG} seconds'))
+    else:
+        contactos = _consultar_todos(f'SELECT {columnas} FROM contactos ORDER BY fecha DESC')
+    if ordenar:
+        contactos.sort(key=lambda c: c['fecha'] or '', reverse=True)
+        if campos and 'fecha' not in campos:
+            for c in contactos:
+                del c['fecha']
+    return contactos
 
 
 def get_contacto(contacto_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM contactos WHERE id = ?', (contacto_id,))
-    row = cursor.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    return cache.leer('contacto', contacto_id, lambda: _consultar_uno(
+        contacto_id, 'SELECT * FROM contactos WHERE id = ?', (contacto_id,)
+    ))
 
 
 def crear_contacto(nombre, telefono, propiedad_id, agente_id, estado='Asignado'):
-    conn = get_connection()
+    """El contacto (y luego sus mensajes) queda en la oficina del agente asignado."""
+    def operacion(cursor):
+        nuevo_id = _nuevo_id(cursor, 'contactos', agente_id)
+        cursor.execute('''
+            INSERT INTO contactos (id, nombre, telefono, telefono_normalizado, propiedad_id,
+                                   agente_asignado_id, estado, fecha_actualizacion)
+            VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (nuevo_id, nombre, telefono, normalizar_telefono(telefono), propiedad_id, agente_id, estado))
+        cursor.execute('''
+            INSERT INTO historial_estados (contacto_id, estado, agente_id) VALUES (?, ?, ?)
+        ''', (nuevo_id, estado, agente_id))
+        return nuevo_id
+
+    return get_contacto(_escribir(operacion, ruta_para_id(agente_id)))
+
+
+def buscar_lead_abierto(telefono):
+    """
+    Lead abierto con el mismo telefono normalizado (usa el indice unico
+    parcial de cada fragmento).
+    """
+    normalizado = normalizar_telefono(telefono)
+    if not normalizado:
+        return None
+    rows = _consultar_todos(f'''
+        SELECT * FROM contactos
+        WHERE telefono_normalizado = ? AND estado NOT IN {ESTADOS_CERRADOS}
+    ''', (normalizado,))
+    return rows[0] if rows else None
+
+
+def buscar_por_telefono(telefono, limite=50):
+    """
+    Identificador de llamadas: contactos cuyo telefono normalizado empieza con
+    los digitos dados (un numero completo coincide exacto), con su agente y
+    propiedad. Usa idx_contactos_telefono_norm en cada fragmento.
+
+    Si el prefijo no encuentra nada (numero local, ultimos digitos) se busca
+    como antes, por coincidencia parcial en cualquier sentido, recorriendo
+    la tabla.
+    """
+    normalizado = normalizar_telefono(telefono)
+    if not normalizado:
+        return []
+    # ':' es el caracter siguiente a '9': el rango cubre todos los que empiezan igual
+    contactos = _consultar_todos('''
+        SELECT * FROM contactos
+        WHERE telefono_normalizado >= ? AND telefono_normalizado < ?
+        ORDER BY fecha DESC
+        LIMIT ?
+    ''', (normalizado, normalizado + ':', limite))
+    if not contactos:
+        contactos = _consultar_todos('''
+            SELECT * FROM contactos
+            WHERE instr(telefono_normalizado, :digitos) > 0 OR instr(:digitos, telefono_normalizado) > 0
+            ORDER BY fecha DESC
+            LIMIT :limite
+        ''', {'digitos': normalizado, 'limite': limite})
+    contactos.sort(key=lambda c: c['fecha'] or '', reverse=True)
+    return [{
+        'contacto': c,
+        'agente': get_agente(c['agente_asignado_id']),
+        'propiedad': get_propiedad(c['propiedad_id']) if c['propiedad_id'] else None
+    } for c in contactos[:limite]]
+
+
+def get_contacto_por_idempotencia(clave):
+    """Contacto registrado con una Idempotency-Key vigente."""
+    rows = _consultar_todos('''
+        SELECT c.* FROM idempotencia i
+        JOIN contactos c ON c.id = i.contacto_id
+        WHERE i.clave = ? AND i.expira > CURRENT_TIMESTAMP
+    ''', (clave,))
+    return rows[0] if rows else None
+
+
+def guardar_idempotencia(clave, contacto_id):
+    """Registra la clave junto al contacto y purga las vencidas."""
+    conn = get_connection(ruta_para_id(contacto_id))
     cursor = conn.cursor()
+    cursor.execute('DELETE FROM idempotencia WHERE expira <= CURRENT_TIMESTAMP')
     cursor.execute('''
-        INSERT INTO contactos (nombre, telefono, propiedad_id, agente_asignado_id, estado)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (nombre, telefono, propiedad_id, agente_id, estado))
-    nuevo_id = cursor.lastrowid
+        INSERT OR REPLACE INTO idempotencia (clave, contacto_id, expira)
+        VALUES (?, ?, datetime('now', ?))
+    ''', (clave, contacto_id, f'+{IDEMPOTENCIA_TTL_HORAS} hours'))
     conn.commit()
     conn.close()
-    return get_contacto(nuevo_id)
 
 
 def actualizar_estado_contacto(contacto_id, nuevo_estado):
-    conn = get_connection()
+    """Cambia el estado y, si es distinto del anterior, lo registra en el historial."""
+    def operacion(cursor):
+        cursor.execute('''
+            INSERT INTO historial_estados (contacto_id, estado_anterior, estado, agente_id)
+            SELECT id, estado, ?, agente_asignado_id FROM contactos
+            WHERE id = ? AND estado IS NOT ?
+        ''', (nuevo_estado, contacto_id, nuevo_estado))
+        cursor.execute('''
+            UPDATE contactos SET estado = ?, fecha_actualizacion = CURRENT_TIMESTAMP
+            WHERE id = ?
+            RETURNING *
+        ''', (nuevo_estado, contacto_id))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+    # La fila confirmada reemplaza a la de la cache: el siguiente boton no relee
+    fila = _escribir(operacion, ruta_para_id(contacto_id))
+    cache.actualizar('contacto', contacto_id, fila)
+    return fila is not None
+
+
+def _renderizar_mensajes(cursor, filas, contacto_id=None):
+    """
+    Completa contenido y botones de los mensajes guardados como plantilla con
+    los datos actuales de su contacto, leidos en una sola consulta (el
+    contacto vive en el mismo fragmento que sus mensajes).
+    """
+    ids = {fila.get('contacto_id', contacto_id) for fila in filas if fila.get('plantilla')}
+    if not ids:
+        return filas
+
+    cursor.execute('''
+        SELECT c.id, c.nombre, c.telefono, c.propiedad_id, p.tipo, p.direccion
+        FROM contactos c LEFT JOIN propiedades p ON p.id = c.propiedad_id
+        WHERE c.id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(sorted(ids)),))
+    datos = {}
+    for row in cursor.fetchall():
+        tipo, direccion = row['tipo'], row['direccion']
+        if row['propiedad_id'] and tipo is None:
+            # Propiedad de otra oficina
+            propiedad = get_propiedad(row['propiedad_id']) or {}
+            tipo, direccion = propiedad.get('tipo'), propiedad.get('direccion')
+        datos[row['id']] = (row['nombre'], row['telefono'], tipo, direccion)
+
+    for fila in filas:
+        if fila.get('plantilla'):
+            contacto = datos.get(fila.get('contacto_id', contacto_id), ('', ''))
+            contenido, botones = plantillas.renderizar(fila['plantilla'], fila.get('parametros'), *contacto)
+            if 'contenido' in fila:
+                fila['contenido'] = contenido
+            if 'botones' in fila:
+                fila['botones'] = botones
+    return filas
+
+
+def get_mensajes_agente(agente_id, incluir_archivo=False, campos=None, desde=None):
+    """
+    Mensajes de un agente. Con desde, solo los creados o respondidos a partir
+    de esa marca (el archivo no cambia, asi que no se consulta).
+    """
+    ruta = ruta_para_id(agente_id)
+    archivo = ruta_archivo(ruta)
+    # El UNION con el archivo se ordena por fecha, que debe estar en la proyeccion
+    obligatorios = ('id', 'fecha') if incluir_archivo else ('id',)
+    # Para armar contenido o botones hacen falta la plantilla y el contacto
+    extra = []
+    if campos and {'contenido', 'botones'} & set(campos):
+        extra = [c for c in ('contacto_id', 'plantilla', 'parametros') if c not in campos]
+    columnas = proyeccion('mensajes', campos and list(campos) + extra, obligatorios=obligatorios)
+    conn = get_connection(ruta)
     cursor = conn.cursor()
-    cursor.execute('UPDATE contactos SET estado = ? WHERE id = ?', (nuevo_estado, contacto_id))
-    affected = cursor.rowcount
-    conn.commit()
+
+    if desde:
+        cursor.execute(f'''
+            SELECT {columnas} FROM mensajes WHERE agente_id = ? AND fecha >= datetime(?, ?)
+            UNION
+            SELECT {columnas} FROM mensajes WHERE agente_id = ? AND fecha_respuesta >= datetime(?, ?)
+        ''', (agente_id, desde, f'-{MARGEN_DELTA_SEG} seconds') * 2)
+        filas = sorted((dict(row) for row in cursor.fetchall()), key=lambda m: (m.get('fecha') or '', m['id']))
+    elif not incluir_archivo or not os.path.exists(archivo):
+        cursor.execute(f'SELECT {columnas} FROM mensajes WHERE agente_id = ? ORDER BY fecha ASC', (agente_id,))
+        filas = [dict(row) for row in cursor.fetchall()]
+    else:
+        cursor.execute('ATTACH DATABASE ? AS archivo', (archivo,))
+        if columnas == '*':
+            cursor.execute('PRAGMA table_info(mensajes)')
+            columnas = ', '.join(row[1] for row in cursor.fetchall())
+        cursor.execute(f'''
+            SELECT {columnas}, 0 AS archivado FROM main.mensajes WHERE agente_id = ?
+            UNION ALL
+            SELECT {columnas}, 1 AS archivado FROM archivo.mensajes WHERE agente_id = ?
+            ORDER BY fecha ASC
+        ''', (agente_id, agente_id))
+        filas = [dict(row) for row in cursor.fetchall()]
+
+    _renderizar_mensajes(cursor, filas)
     conn.close()
-    return affected > 0
+    for fila in filas:
+        for columna in extra:
+            del fila[columna]
+    return filas
 
 
-def get_mensajes_agente(agente_id):
-    conn = get_connection()
+def get_timeline(contacto_id):
+    """
+    Historial de un contacto en orden cronologico: mensajes enviados al
+    agente, respuestas con botones y cambios de estado (incluye mensajes
+    archivados). Cada parte es un rango de (contacto_id, fecha).
+    """
+    ruta = ruta_para_id(contacto_id)
+    archivo = ruta_archivo(ruta)
+    conn = get_connection(ruta)
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM mensajes WHERE agente_id = ? ORDER BY fecha ASC', (agente_id,))
-    rows = cursor.fetchall()
+
+    origenes = ['main.mensajes']
+    if os.path.exists(archivo):
+        cursor.execute('ATTACH DATABASE ? AS archivo', (archivo,))
+        origenes.append('archivo.mensajes')
+
+    partes = ['''
+        SELECT fecha, 'estado' AS evento, NULL AS mensaje_id, agente_id, NULL AS tipo,
+               NULL AS contenido, NULL AS respuesta, estado_anterior, estado,
+               NULL AS plantilla, NULL AS parametros
+        FROM historial_estados WHERE contacto_id = :id
+    ''']
+    for origen in origenes:
+        partes.append(f'''
+            SELECT fecha, 'mensaje', id, agente_id, tipo, contenido, NULL, NULL, NULL, plantilla, parametros
+            FROM {origen} WHERE contacto_id = :id
+        ''')
+        partes.append(f'''
+            SELECT fecha_respuesta, 'respuesta', id, agente_id, tipo, NULL, respuesta, NULL, NULL, NULL, NULL
+            FROM {origen} WHERE contacto_id = :id AND respondido = 1 AND fecha_respuesta IS NOT NULL
+        ''')
+    cursor.execute(' UNION ALL '.join(partes) + ' ORDER BY fecha, mensaje_id', {'id': contacto_id})
+    eventos = _renderizar_mensajes(cursor, [dict(row) for row in cursor.fetchall()], contacto_id)
     conn.close()
-    return [dict(row) for row in rows]
+    # Solo los campos que aplican a cada tipo de evento
+    return [{k: v for k, v in evento.items() if v is not None and k not in ('plantilla', 'parametros')}
+            for evento in eventos]
+
+
+def _guardar_mensaje(contacto_id, agente_id, tipo, contenido, botones, plantilla=None, parametros=None):
+    familia = FAMILIAS_MENSAJE.get(tipo)
+
+    def operacion(cursor):
+        if familia:
+            cursor.execute('''
+                UPDATE mensajes SET agente_id = ?, tipo = ?, contenido = ?, botones = ?, plantilla = ?,
+                                    parametros = ?, fecha = CURRENT_TIMESTAMP, repeticiones = repeticiones + 1
+                WHERE contacto_id = ? AND familia = ? AND respondido = 0
+                RETURNING id
+            ''', (agente_id, tipo, contenido, botones, plantilla, parametros, contacto_id, familia))
+            row = cursor.fetchone()
+            if row:
+                return row[0], False
+
+        nuevo_id = _nuevo_id(cursor, 'mensajes', contacto_id)
+        cursor.execute('''
+            INSERT INTO mensajes (id, contacto_id, agente_id, tipo, contenido, botones, familia,
+                                  plantilla, parametros)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (nuevo_id, contacto_id, agente_id, tipo, contenido, botones, familia, plantilla, parametros))
+        return nuevo_id, True
+
+    return _escribir(operacion, ruta_para_id(contacto_id))
 
 
 def crear_mensaje(contacto_id, agente_id, tipo, contenido, botones=None):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO mensajes (contacto_id, agente_id, tipo, contenido, botones)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (contacto_id, agente_id, tipo, contenido, botones))
-    nuevo_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return nuevo_id
+    """
+    Mensaje de texto libre, en el fragmento de su contacto. Si ya hay un aviso
+    pendiente de la misma familia para el contacto, se reemplaza su contenido
+    y se suma una repeticion en vez de agregar otra fila. Retorna (id, nuevo):
+    nuevo es False si se agrupo con el pendiente (la bandeja no crece).
+    """
+    return _guardar_mensaje(contacto_id, agente_id, tipo, contenido, botones)
+
+
+def crear_mensaje_plantilla(contacto_id, agente_id, plantilla, parametros=None):
+    """
+    Como crear_mensaje, pero guarda solo el id de la plantilla y sus
+    parametros propios (dict); el texto y los botones se arman al leer.
+    """
+    return _guardar_mensaje(contacto_id, agente_id, plantillas.tipo(plantilla), '', None,
+                            plantilla, plantillas.codificar(parametros))
 
 
 def responder_mensaje(mensaje_id, respuesta):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE mensajes SET respondido = 1, respuesta = ? WHERE id = ?', (respuesta, mensaje_id))
-    affected = cursor.rowcount
-    conn.commit()
-    conn.close()
-    return affected > 0
+    """
+    Marca un mensaje pendiente como respondido. Retorna su agente_id, o None
+    si no existe o ya estaba respondido (se conserva la primera respuesta).
+    """
+    def operacion(cursor):
+        cursor.execute('''
+            UPDATE mensajes SET respondido = 1, respuesta = ?, fecha_respuesta = CURRENT_TIMESTAMP
+            WHERE id = ? AND respondido = 0
+            RETURNING agente_id
+        ''', (respuesta, mensaje_id))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    return _escribir(operacion, ruta_para_id(mensaje_id))
 
 
 def get_metricas():
-    conn = get_connection()
-    cursor = conn.cursor()
+    total = 0
+    por_estado = {}
+    por_agente = []
+    for ruta in rutas():
+        conn = get_connection(ruta)
+        cursor = conn.cursor()
 
-    cursor.execute('SELECT COUNT(*) FROM contactos')
-    total = cursor.fetchone()[0]
+        cursor.execute('SELECT COUNT(*) FROM contactos')
+        total += cursor.fetchone()[0]
 
-    cursor.execute('SELECT estado, COUNT(*) FROM contactos GROUP BY estado')
-    por_estado = {row[0]: row[1] for row in cursor.fetchall()}
+        cursor.execute('SELECT estado, COUNT(*) FROM contactos GROUP BY estado')
+        for estado, cantidad in cursor.fetchall():
+            por_estado[estado] = por_estado.get(estado, 0) + cantidad
 
-    cursor.execute('''
-        SELECT a.nombre, COUNT(c.id) as count
-        FROM agentes a
-        LEFT JOIN contactos c ON a.id = c.agente_asignado_id
-        GROUP BY a.id
-        ORDER BY count DESC
-        LIMIT 5
-    ''')
-    top_agentes = {row[0]: row[1] for row in cursor.fetchall()}
+        cursor.execute('''
+            SELECT a.nombre, COUNT(c.id) as count
+            FROM agentes a
+            LEFT JOIN contactos c ON a.id = c.agente_asignado_id
+            GROUP BY a.id
+            ORDER BY count DESC
+            LIMIT 5
+        ''')
+        por_agente.extend(tuple(row) for row in cursor.fetchall())
 
-    conn.close()
+        conn.close()
+
+    por_agente.sort(key=lambda fila: fila[1], reverse=True)
+    top_agentes = {nombre: cantidad for nombre, cantidad in por_agente[:5]}
 
     return {
         'total_contactos': total,
@@ -278,8 +1211,65 @@ def get_metricas():
     }
 
 
+def consulta_fts(texto):
+    """
+    Convierte texto libre en una consulta FTS5 para typeahead: las palabras
+    completas deben coincidir y la ultima se busca como prefijo.
+    """
+    palabras = re.findall(r'\w+', texto or '')
+    if not palabras:
+        return ''
+    terminos = [f'"{p}"' for p in palabras[:-1]] + [f'"{palabras[-1]}"*']
+    return ' '.join(terminos)
+
+
+def buscar(texto, limite=10):
+    """
+    Busqueda por prefijo en contactos y propiedades, ordenada por relevancia
+    entre las RECIENTES_A_RANKEAR coincidencias mas recientes de cada tabla
+    (tope intencional: el typeahead prioriza lo reciente y no calcula bm25
+    sobre toda la tabla para un prefijo muy comun).
+    """
+    consulta = consulta_fts(texto)
+    if not consulta:
+        return {'contactos': [], 'propiedades': []}
+
+    contactos = _consultar_todos('''
+        SELECT c.*, a.nombre AS agente_nombre, a.whatsapp AS agente_whatsapp, f.rank AS relevancia
+        FROM (
+            SELECT rowid, rank FROM contactos_fts
+            WHERE contactos_fts MATCH ?
+            ORDER BY rowid DESC
+            LIMIT ?
+        ) f
+        JOIN contactos c ON c.id = f.rowid
+        LEFT JOIN agentes a ON a.id = c.agente_asignado_id
+        ORDER BY f.rank
+        LIMIT ?
+    ''', (consulta, RECIENTES_A_RANKEAR, limite))
+
+    propiedades = _consultar_todos('''
+        SELECT p.*, a.nombre AS agente_nombre, a.whatsapp AS agente_whatsapp, f.rank AS relevancia
+        FROM (
+            SELECT rowid, rank FROM propiedades_fts
+            WHERE propiedades_fts MATCH ?
+            ORDER BY rowid DESC
+            LIMIT ?
+        ) f
+        JOIN propiedades p ON p.id = f.rowid
+        LEFT JOIN agentes a ON a.id = p.agente_id
+        ORDER BY f.rank
+        LIMIT ?
+    ''', (consulta, RECIENTES_A_RANKEAR, limite))
+
+    # bm25 es por fragmento; alcanza para intercalar los mejores de cada uno
+    contactos.sort(key=lambda c: c['relevancia'])
+    propiedades.sort(key=lambda p: p['relevancia'])
+    return {'contactos': contactos[:limite], 'propiedades': propiedades[:limite]}
+
+
 def contar_contactos_agente(agente_id):
-    conn = get_connection()
+    conn = get_connection(ruta_para_id(agente_id))
     cursor = conn.cursor()
     cursor.execute('SELECT COUNT(*) FROM contactos WHERE agente_asignado_id = ?', (agente_id,))
     count = cursor.fetchone()[0]
@@ -288,20 +1278,136 @@ def contar_contactos_agente(agente_id):
 
 
 def get_agente_menos_carga():
-    """Retorna el agente con menos contactos asignados."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+    """Retorna el agente disponible con menos contactos asignados (entre todas las oficinas)."""
+    candidatos = _consultar_todos('''
         SELECT a.id, COUNT(c.id) as carga
         FROM agentes a
         LEFT JOIN contactos c ON a.id = c.agente_asignado_id
+        WHERE a.disponible = 1
         GROUP BY a.id
         ORDER BY carga ASC
         LIMIT 1
     ''')
-    row = cursor.fetchone()
-    conn.close()
-    return row[0] if row else None
+    if not candidatos:
+        return None
+    return min(candidatos, key=lambda a: a['carga'])['id']
+
+
+def actualizar_disponibilidad(agente_id, disponible):
+    """Agentes no disponibles (licencia) no reciben leads nuevos."""
+    def operacion(cursor):
+        cursor.execute('''
+            UPDATE agentes SET disponible = ? WHERE id = ? RETURNING *
+        ''', (1 if disponible else 0, agente_id))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+    fila = _escribir(operacion, ruta_para_id(agente_id))
+    cache.actualizar('agente', agente_id, fila)
+    return fila is not None
+
+
+def get_leads_abiertos(agentes_ids):
+    """Leads abiertos de los agentes, con tipo, precio y dueno de su propiedad."""
+    leads = []
+    por_ruta = {}
+    for agente_id in agentes_ids:
+        por_ruta.setdefault(ruta_para_id(agente_id), []).append(int(agente_id))
+    for ruta, ids in por_ruta.items():
+        conn = get_connection(ruta)
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT c.id, c.agente_asignado_id, p.tipo, p.precio, p.agente_id AS propietario_id
+            FROM contactos c
+            LEFT JOIN propiedades p ON p.id = c.propiedad_id
+            WHERE c.agente_asignado_id IN ({', '.join(['?'] * len(ids))})
+              AND c.estado NOT IN {ESTADOS_CERRADOS}
+        ''', ids)
+        leads.extend(dict(row) for row in cursor.fetchall())
+        conn.close()
+    return leads
+
+
+def reasignar_contactos(asignaciones, nuevo_estado=None):
+    """
+    Pasa contactos de un mismo fragmento a otros agentes en una transaccion.
+
+    asignaciones es una lista de (contacto_id, agente_nuevo_id). Los mensajes
+    pendientes de esos contactos quedan respondidos como 'reasignado', cada
+    agente nuevo recibe un aviso 'nuevo_lead' y se recalcula carga_trabajo de
+    los agentes involucrados. Retorna los pendientes reemplazados por agente.
+    """
+    if not asignaciones:
+        return {}
+
+    def operacion(cursor):
+        cursor.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS reasignacion (
+                contacto_id INTEGER PRIMARY KEY,
+                agente_anterior INTEGER,
+                agente_nuevo INTEGER
+            )
+        ''')
+        cursor.execute('DELETE FROM temp.reasignacion')
+        cursor.executemany(
+            'INSERT OR REPLACE INTO temp.reasignacion (contacto_id, agente_nuevo) VALUES (?, ?)',
+            asignaciones
+        )
+        cursor.execute('''
+            UPDATE temp.reasignacion SET agente_anterior = c.agente_asignado_id
+            FROM contactos c WHERE c.id = reasignacion.contacto_id
+        ''')
+
+        cursor.execute('''
+            SELECT m.agente_id, COUNT(*) FROM temp.reasignacion r
+            JOIN mensajes m ON m.contacto_id = r.contacto_id
+            WHERE m.respondido = 0
+            GROUP BY m.agente_id
+        ''')
+        reemplazados = {row[0]: row[1] for row in cursor.fetchall()}
+        cursor.execute('''
+            UPDATE mensajes SET respondido = 1, respuesta = 'reasignado',
+                                fecha_respuesta = CURRENT_TIMESTAMP
+            WHERE respondido = 0 AND contacto_id IN (SELECT contacto_id FROM temp.reasignacion)
+        ''')
+
+        cursor.execute('''
+            INSERT INTO historial_estados (contacto_id, estado_anterior, estado, agente_id)
+            SELECT c.id, c.estado, COALESCE(?, c.estado), r.agente_nuevo
+            FROM temp.reasignacion r JOIN contactos c ON c.id = r.contacto_id
+        ''', (nuevo_estado,))
+        cursor.execute('''
+            UPDATE contactos SET agente_asignado_id = r.agente_nuevo,
+                                 estado = COALESCE(?, contactos.estado),
+                                 fecha_actualizacion = CURRENT_TIMESTAMP
+            FROM temp.reasignacion r WHERE contactos.id = r.contacto_id
+        ''', (nuevo_estado,))
+
+        # Ids consecutivos dentro del bloque de la oficina
+        cursor.execute('SELECT COUNT(*) FROM temp.reasignacion')
+        primer_id = _nuevo_id(cursor, 'mensajes', asignaciones[0][0], cursor.fetchone()[0])
+        cursor.execute('''
+            INSERT INTO mensajes (id, contacto_id, agente_id, tipo, contenido, plantilla)
+            SELECT ? + ROW_NUMBER() OVER (ORDER BY r.contacto_id) - 1,
+                   r.contacto_id, r.agente_nuevo, ?, '', 'lead_reasignado'
+            FROM temp.reasignacion r
+        ''', (primer_id, plantillas.tipo('lead_reasignado')))
+
+        cursor.execute(f'''
+            UPDATE agentes SET carga_trabajo = (
+                SELECT COUNT(*) FROM contactos c
+                WHERE c.agente_asignado_id = agentes.id AND c.estado NOT IN {ESTADOS_CERRADOS}
+            )
+            WHERE id IN (SELECT agente_anterior FROM temp.reasignacion
+                         UNION SELECT agente_nuevo FROM temp.reasignacion)
+        ''')
+        return reemplazados
+
+    reemplazados = _escribir(operacion, ruta_para_id(asignaciones[0][0]))
+    cache.invalidar('contacto', *(contacto_id for contacto_id, _ in asignaciones))
+    # carga_trabajo cambio en los agentes anteriores y nuevos
+    cache.invalidar_todo('agente')
+    return reemplazados
 
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# Ventana para agrupar escrituras en un solo commit (ms). 0 = commits sincronos.
+VENTANA_MS = float(os.environ.get('CRM_ESCRITURA_VENTANA_MS', '0'))
+
+# Maximo de operaciones por transaccion
+MAX_LOTE = int(os.environ.get('CRM_ESCRITURA_MAX_LOTE', '64'))
+
+_escritores = {}
+_lock = threading.Lock()
+
+
+class EscritorAgrupado:
+    """
+    Hilo que junta las escrituras de peticiones concurrentes y las confirma
+    en una sola transaccion (group commit).
+
+    Cada operacion es una funcion que recibe un cursor y retorna su resultado.
+    Corre dentro de un SAVEPOINT propio: si falla, solo esa operacion se
+    revierte y su Future recibe la excepcion; las demas del lote se confirman.
+    """
+
+    def __init__(self, abrir_conexion, ventana_ms=VENTANA_MS, max_lote=MAX_LOTE):
+        self._abrir_conexion = abrir_conexion
+        self._ventana = ventana_ms / 1000.0
+        self._max_lote = max_lote
+        self._cola = queue.Queue()
+        self._hilo = threading.Thread(target=self._bucle, name='escritor-agrupado', daemon=True)
+        self._hilo.start()
+
+    def enviar(self, operacion):
+        """Encola una operacion y retorna un Future con su resultado."""
+        futuro = Future()
+        self._cola.put((operacion, futuro))
+        return futuro
+
+    def detener(self):
+        """Procesa lo pendiente y termina el hilo."""
+        self._cola.put(None)
+        self._hilo.join()
+
+    def _bucle(self):
+        conn = self._abrir_conexion()
+        # Transacciones manuales: BEGIN/COMMIT explicitos
+        conn.isolation_level = None
+
+        while True:
+            primera = self._cola.get()
+            if primera is None:
+                break
+
+            lote = [primera]
+            limite = time.monotonic() + self._ventana
+            fin = False
+            while len(lote) < self._max_lote:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    siguiente = self._cola.get(timeout=restante)
+                except queue.Empty:
+                    break
+                if siguiente is None:
+                    fin = True
+                    break
+                lote.append(siguiente)
+
+            self._ejecutar(conn, lote)
+            if fin:
+                break
+
+        conn.close()
+
+    def _ejecutar(self, conn, lote):
+        cursor = conn.cursor()
+        resultados = []
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            for operacion, futuro in lote:
+                cursor.execute('SAVEPOINT operacion')
+                try:
+                    resultado = operacion(cursor)
+                    cursor.execute('RELEASE operacion')
+                    resultados.append((futuro, resultado, None))
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO operacion')
+                    cursor.execute('RELEASE operacion')
+                    resultados.append((futuro, None, e))
+            cursor.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            for _, futuro in lote:
+                futuro.set_exception(e)
+            return
+
+        for futuro, resultado, error in resultados:
+            if error is not None:
+                futuro.set_exception(error)
+            else:
+                futuro.set_result(resultado)
+
+
+def activo():
+    return VENTANA_MS > 0
+
+
+def obtener_escritor(ruta, abrir_conexion):
+    """Escritor unico por archivo de base de datos."""
+    with _lock:
+        escritor = _escritores.get(ruta)
+        if escritor is None:
+            escritor = EscritorAgrupado(abrir_conexion)
+            _escritores[ruta] = escritor
+        return escritor
+
+
+@atexit.register
+def detener_todos():
+    with _lock:
+        escritores = list(_escritores.values())
+        _escritores.clear()
+    for escritor in escritores:
+        escritor.detener()
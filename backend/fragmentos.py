@@ -0,0 +1,65 @@
+import json
+import os
+
+# Cada oficina usa un bloque de ids propio: id // BLOQUE_IDS = numero de oficina.
+# Asi cualquier id indica en que fragmento esta, sin consultar un indice global.
+BLOQUE_IDS = 10 ** 9
+
+# Oficina de los datos existentes (ids 1..BLOQUE_IDS-1) y de la base principal
+OFICINA_PRINCIPAL = 'central'
+
+_cache = {}
+
+
+def ruta_mapa(ruta_principal):
+    """El mapa vive junto a la base principal: data/fragmentos.json."""
+    return os.path.join(os.path.dirname(ruta_principal), 'fragmentos.json')
+
+
+def mapa_inicial(ruta_principal):
+    return {OFICINA_PRINCIPAL: {'numero': 0, 'ruta': ruta_principal}}
+
+
+def cargar_mapa(ruta_principal):
+    """
+    Mapa oficina -> {'numero', 'ruta'}. Sin archivo, todo esta en la base
+    principal. Se relee solo cuando cambia el archivo (rebalanceos).
+    """
+    archivo = ruta_mapa(ruta_principal)
+    try:
+        version = os.stat(archivo).st_mtime_ns
+    except FileNotFoundError:
+        return mapa_inicial(ruta_principal)
+
+    guardado = _cache.get(archivo)
+    if guardado and guardado[0] == version:
+        return guardado[1]
+
+    with open(archivo) as f:
+        mapa = json.load(f)['oficinas']
+    mapa.setdefault(OFICINA_PRINCIPAL, mapa_inicial(ruta_principal)[OFICINA_PRINCIPAL])
+    _cache[archivo] = (version, mapa)
+    return mapa
+
+
+def guardar_mapa(ruta_principal, mapa):
+    """Reemplaza el mapa de forma atomica."""
+    archivo = ruta_mapa(ruta_principal)
+    temporal = archivo + '.tmp'
+    with open(temporal, 'w') as f:
+        json.dump({'oficinas': mapa}, f, indent=2)
+    os.replace(temporal, archivo)
+
+
+def rango_ids(numero):
+    """Primer y ultimo id del bloque de una oficina."""
+    return numero * BLOQUE_IDS, (numero + 1) * BLOQUE_IDS - 1
+
+
+def oficina_de_id(mapa, entidad_id):
+    """Oficina duena de un id; los bloques sin oficina caen en la principal."""
+    numero = int(entidad_id) // BLOQUE_IDS
+    for oficina, datos in mapa.items():
+        if datos['numero'] == numero:
+            return oficina
+    return OFICINA_PRINCIPAL
@@ -0,0 +1,8 @@
+# Configuracion de gunicorn; se lee sola al correr desde backend/:
+#     gunicorn -w 4 -b 0.0.0.0:5000 api:app
+
+
+def post_worker_init(worker):
+    """Cada worker arranca su servicio (lock, base y tareas en segundo plano)."""
+    import api
+    api.iniciar_servicio()
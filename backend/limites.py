@@ -0,0 +1,208 @@
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+import database as db
+
+# Limite por cliente y ruta: (tokens por segundo, rafaga). Se cambian con
+# CRM_LIMITES="create_contacto=5/20,enviar_seguimiento=1/5,*=10/20"
+# ('*' = cualquier otra escritura; los nombres son los endpoints de api.py)
+LIMITES_DEFECTO = {
+    '*': (10.0, 20.0),
+    'create_contacto': (2.0, 10.0),
+    'enviar_seguimiento': (2.0, 10.0)
+}
+
+# Escrituras simultaneas entre todos los workers; el resto de los hilos
+# queda libre para las lecturas del dashboard y la vista de agente
+MAX_ESCRITURAS = int(os.environ.get('CRM_MAX_ESCRITURAS', '4'))
+
+# Retry-After sugerido cuando el cupo de escrituras esta lleno (segundos)
+ESPERA_SATURADO_SEG = 1
+
+# Cupos de escritura mas viejos que esto se consideran de un worker caido
+CUPO_VENCIDO_SEG = 60
+
+# Cada cuanto un hilo borra las cubetas ociosas (segundos)
+PURGA_SEG = 60
+
+# POST que no escriben en la base: no pasan por el limitador
+EXENTOS = ('login', 'buscar_por_telefono')
+
+_local = threading.local()
+
+
+def _leer_limites(texto):
+    limites = dict(LIMITES_DEFECTO)
+    for par in filter(None, (p.strip() for p in (texto or '').split(','))):
+        ruta, _, valor = par.partition('=')
+        tasa, _, rafaga = valor.partition('/')
+        limites[ruta.strip()] = (float(tasa), float(rafaga or tasa))
+    return limites
+
+
+LIMITES = _leer_limites(os.environ.get('CRM_LIMITES'))
+
+# Tras este tiempo sin pedidos cualquier cubeta ya se relleno: la fila no aporta nada
+CUBETA_OCIOSA_SEG = max(rafaga / tasa for tasa, rafaga in LIMITES.values())
+
+
+def ruta_limites():
+    """El estado compartido vive junto a la base principal: data/limites.db."""
+    return os.path.join(os.path.dirname(db.DB_PATH), 'limites.db')
+
+
+def _conexion():
+    """Una conexion por hilo; el archivo es compartido por todos los workers."""
+    ruta = ruta_limites()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.ruta == ruta:
+        return conn
+
+    os.makedirs(os.path.dirname(ruta) or '.', exist_ok=True)
+    conn = sqlite3.connect(ruta, timeout=2, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode = WAL')
+    # Estado efimero: no hace falta sobrevivir a un corte de luz
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS cubetas (
+            clave TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            actualizado REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_cubetas_actualizado ON cubetas(actualizado);
+        CREATE TABLE IF NOT EXISTS escrituras_en_curso (
+            id INTEGER PRIMARY KEY,
+            endpoint TEXT,
+            inicio REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS contadores (
+            endpoint TEXT PRIMARY KEY,
+            admitidas INTEGER NOT NULL DEFAULT 0,
+            limitadas INTEGER NOT NULL DEFAULT 0,
+            saturadas INTEGER NOT NULL DEFAULT 0
+        );
+    ''')
+    _local.conn, _local.ruta, _local.purga = conn, ruta, 0.0
+    return conn
+
+
+def clave_cliente(token, direccion):
+    """
+    Cliente = token (resumido, no se guarda en claro) + IP. Varios clientes
+    pueden compartir token (DEMO_TOKEN), asi que el token solo no alcanza.
+    """
+    if token:
+        return 't:' + hashlib.sha256(token.encode()).hexdigest()[:16] + f'@{direccion}'
+    return f'ip:{direccion}'
+
+
+def limite(endpoint):
+    return LIMITES.get(endpoint, LIMITES['*'])
+
+
+def _contar(cursor, endpoint, columna):
+    cursor.execute(f'''
+        INSERT INTO contadores (endpoint, {columna}) VALUES (?, 1)
+        ON CONFLICT(endpoint) DO UPDATE SET {columna} = {columna} + 1
+    ''', (endpoint,))
+
+
+def _purgar_ociosas(cursor, ahora):
+    """Borra las cubetas llenas hace rato; sin esto la tabla crece con cada cliente."""
+    if ahora - _local.purga < PURGA_SEG:
+        return
+    _local.purga = ahora
+    cursor.execute('DELETE FROM cubetas WHERE actualizado < ?', (ahora - CUBETA_OCIOSA_SEG,))
+
+
+def admitir(cliente, endpoint):
+    """
+    Cubeta de tokens por (cliente, endpoint) y cupo global de escrituras, en
+    una sola transaccion sobre data/limites.db.
+
+    Retorna (permiso, espera): con permiso se debe llamar a liberar() al
+    terminar; sin permiso, espera son los segundos sugeridos para reintentar.
+    """
+    tasa, rafaga = limite(endpoint)
+    clave = f'{cliente}|{endpoint}'
+    conn = _conexion()
+    cursor = conn.cursor()
+    ahora = time.time()
+
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.execute('SELECT tokens, actualizado FROM cubetas WHERE clave = ?', (clave,))
+        row = cursor.fetchone()
+        tokens = rafaga if row is None else min(rafaga, row[0] + (ahora - row[1]) * tasa)
+
+        if tokens < 1:
+            _contar(cursor, endpoint, 'limitadas')
+            permiso, espera = None, (1 - tokens) / tasa
+        else:
+            cursor.execute('DELETE FROM escrituras_en_curso WHERE inicio < ?', (ahora - CUPO_VENCIDO_SEG,))
+            cursor.execute('SELECT COUNT(*) FROM escrituras_en_curso')
+            if cursor.fetchone()[0] >= MAX_ESCRITURAS:
+                # Saturado: no se descuenta el token del cliente
+                _contar(cursor, endpoint, 'saturadas')
+                permiso, espera = None, ESPERA_SATURADO_SEG
+            else:
+                tokens -= 1
+                cursor.execute('INSERT INTO escrituras_en_curso (endpoint, inicio) VALUES (?, ?)', (endpoint, ahora))
+                permiso, espera = cursor.lastrowid, 0
+                _contar(cursor, endpoint, 'admitidas')
+
+        cursor.execute('''
+            INSERT OR REPLACE INTO cubetas (clave, tokens, actualizado) VALUES (?, ?, ?)
+        ''', (clave, tokens, ahora))
+        _purgar_ociosas(cursor, ahora)
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+
+    return permiso, espera
+
+
+def liberar(permiso):
+    _conexion().execute('DELETE FROM escrituras_en_curso WHERE id = ?', (permiso,))
+
+
+def segundos_reintento(espera):
+    """Valor entero para la cabecera Retry-After."""
+    return max(1, math.ceil(espera))
+
+
+def estadisticas():
+    """Contadores por endpoint, escrituras en curso y cubetas mas vacias."""
+    conn = _conexion()
+    cursor = conn.cursor()
+    ahora = time.time()
+
+    cursor.execute('SELECT COUNT(*) FROM escrituras_en_curso WHERE inicio >= ?', (ahora - CUPO_VENCIDO_SEG,))
+    en_curso = cursor.fetchone()[0]
+
+    cursor.execute('SELECT endpoint, admitidas, limitadas, saturadas FROM contadores ORDER BY endpoint')
+    rutas = [dict(zip(('endpoint', 'admitidas', 'limitadas', 'saturadas'), row)) for row in cursor.fetchall()]
+
+    cursor.execute('SELECT clave, tokens, actualizado FROM cubetas')
+    clientes = []
+    for clave, tokens, actualizado in cursor.fetchall():
+        cliente, _, endpoint = clave.rpartition('|')
+        tasa, rafaga = limite(endpoint)
+        clientes.append({
+            'cliente': cliente,
+            'endpoint': endpoint,
+            'tokens': round(min(rafaga, tokens + (ahora - actualizado) * tasa), 2)
+        })
+    clientes.sort(key=lambda c: c['tokens'])
+
+    return {
+        'max_escrituras': MAX_ESCRITURAS,
+        'escrituras_en_curso': en_curso,
+        'limites': {ruta: {'tasa': tasa, 'rafaga': rafaga} for ruta, (tasa, rafaga) in LIMITES.items()},
+        'rutas': rutas,
+        'clientes': clientes[:20]
+    }
@@ -0,0 +1,151 @@
+import os
+import database as db
+import fragmentos
+
+# Tablas con filas por oficina y la columna cuyo id indica el bloque
+TABLAS_OFICINA = [
+    ('agentes', 'id'),
+    ('propiedades', 'id'),
+    ('contactos', 'id'),
+    ('mensajes', 'id'),
+    ('idempotencia', 'contacto_id'),
+    ('historial_estados', 'contacto_id'),
+    ('resumen_embudo', 'agente_id'),
+    ('resumen_respuesta', 'agente_id'),
+    ('secuencias', 'bloque')
+]
+
+
+def _copiar_mapa():
+    return {oficina: dict(datos) for oficina, datos in db.mapa_fragmentos().items()}
+
+
+def agregar_oficina(oficina, ruta):
+    """Registra una oficina nueva con su propio bloque de ids y fragmento."""
+    mapa = _copiar_mapa()
+    if oficina in mapa:
+        raise ValueError(f'La oficina {oficina} ya existe')
+    db.init_fragmento(ruta)
+    numero = max(datos['numero'] for datos in mapa.values()) + 1
+    mapa[oficina] = {'numero': numero, 'ruta': ruta}
+    fragmentos.guardar_mapa(db.DB_PATH, mapa)
+    return mapa[oficina]
+
+
+def mover_oficina(oficina, nueva_ruta):
+    """
+    Mueve todas las filas de una oficina a otro fragmento.
+
+    Copia y borrado ocurren en una sola transaccion sobre ambos archivos; el
+    mapa se actualiza antes del COMMIT, mientras se tiene el bloqueo de
+    escritura, para que ninguna escritura quede en el fragmento viejo.
+    """
+    mapa = _copiar_mapa()
+    if oficina not in mapa:
+        raise ValueError(f'Oficina desconocida: {oficina}')
+    origen = mapa[oficina]['ruta']
+    if os.path.abspath(origen) == os.path.abspath(nueva_ruta):
+        return 0
+
+    db.init_fragmento(nueva_ruta)
+    inicio, fin = fragmentos.rango_ids(mapa[oficina]['numero'])
+    mapa_anterior = _copiar_mapa()
+
+    conn = db.get_connection(origen)
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    cursor.execute('ATTACH DATABASE ? AS destino', (nueva_ruta,))
+
+    movidas = 0
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        for tabla, columna in TABLAS_OFICINA:
+            cursor.execute(f'PRAGMA main.table_info({tabla})')
+            columnas = ', '.join(row[1] for row in cursor.fetchall())
+            cursor.execute(f'''
+                INSERT INTO destino.{tabla} ({columnas})
+                SELECT {columnas} FROM main.{tabla} WHERE {columna} BETWEEN ? AND ?
+            ''', (inicio, fin))
+            movidas += cursor.rowcount
+        # Dependientes primero (mensajes antes que contactos)
+        for tabla, columna in reversed(TABLAS_OFICINA):
+            cursor.execute(f'DELETE FROM main.{tabla} WHERE {columna} BETWEEN ? AND ?', (inicio, fin))
+
+        mapa[oficina]['ruta'] = nueva_ruta
+        fragmentos.guardar_mapa(db.DB_PATH, mapa)
+        cursor.execute('COMMIT')
+    except Exception:
+        if conn.in_transaction:
+            cursor.execute('ROLLBACK')
+        fragmentos.guardar_mapa(db.DB_PATH, mapa_anterior)
+        raise
+    finally:
+        conn.close()
+
+    _mover_archivo(origen, nueva_ruta, inicio, fin)
+    return movidas
+
+
+def _mover_archivo(origen, destino, inicio, fin):
+    """Mensajes archivados de la oficina al archivo del fragmento nuevo."""
+    archivo_origen = db.ruta_archivo(origen)
+    if not os.path.exists(archivo_origen):
+        return
+
+    conn = db.get_connection(archivo_origen)
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'mensajes'")
+    if cursor.fetchone() is None:
+        conn.close()
+        return
+
+    cursor.execute('ATTACH DATABASE ? AS destino', (db.ruta_archivo(destino),))
+    cursor.execute('CREATE TABLE IF NOT EXISTS destino.mensajes AS SELECT * FROM main.mensajes WHERE 0')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS destino.ux_archivo_id ON mensajes(id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS destino.idx_archivo_agente_fecha ON mensajes(agente_id, fecha)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS destino.idx_archivo_contacto_fecha ON mensajes(contacto_id, fecha)')
+    cursor.execute('PRAGMA main.table_info(mensajes)')
+    columnas = ', '.join(row[1] for row in cursor.fetchall())
+    cursor.execute(f'''
+        INSERT OR REPLACE INTO destino.mensajes ({columnas})
+        SELECT {columnas} FROM main.mensajes WHERE id BETWEEN ? AND ?
+    ''', (inicio, fin))
+    cursor.execute('DELETE FROM main.mensajes WHERE id BETWEEN ? AND ?', (inicio, fin))
+    conn.commit()
+    conn.close()
+
+
+def listar_oficinas():
+    """Oficinas con su fragmento y cantidad de agentes y contactos."""
+    resultado = []
+    for oficina, datos in sorted(db.mapa_fragmentos().items(), key=lambda o: o[1]['numero']):
+        inicio, fin = fragmentos.rango_ids(datos['numero'])
+        conn = db.get_connection(datos['ruta'])
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM agentes WHERE id BETWEEN ? AND ?', (inicio, fin))
+        agentes = cursor.fetchone()[0]
+        cursor.execute('SELECT COUNT(*) FROM contactos WHERE id BETWEEN ? AND ?', (inicio, fin))
+        contactos = cursor.fetchone()[0]
+        conn.close()
+        resultado.append(dict(datos, oficina=oficina, agentes=agentes, contactos=contactos))
+    return resultado
+
+
+if __name__ == '__main__':
+    import sys
+    db.init_db()
+    comando = sys.argv[1] if len(sys.argv) > 1 else 'listar'
+
+    if comando == 'agregar' and len(sys.argv) == 4:
+        datos = agregar_oficina(sys.argv[2], sys.argv[3])
+        print(f"Oficina {sys.argv[2]} agregada (bloque {datos['numero']}) en {datos['ruta']}")
+    elif comando == 'mover' and len(sys.argv) == 4:
+        movidas = mover_oficina(sys.argv[2], sys.argv[3])
+        print(f"Oficina {sys.argv[2]} movida a {sys.argv[3]} ({movidas} filas)")
+    elif comando == 'listar':
+        for o in listar_oficinas():
+            print(f"{o['oficina']:<15} bloque {o['numero']:<3} {o['ruta']:<30} "
+                  f"{o['agentes']} agentes, {o['contactos']} contactos")
+    else:
+        print("Uso: python oficinas.py [listar | agregar <oficina> <ruta> | mover <oficina> <ruta>]")
+        sys.exit(1)
@@ -0,0 +1,156 @@
+import cProfile
+import marshal
+import os
+import pstats
+import random
+import threading
+import time
+from collections import Counter
+import database as db
+
+# Fraccion de solicitudes perfiladas sin pedirlo (0 = solo con la cabecera X-Perfil: 1)
+MUESTREO = float(os.environ.get('CRM_PERFIL_MUESTREO', '0'))
+
+# Profundidad maxima de las pilas colapsadas y tiempo minimo por pila (microsegundos)
+PROFUNDIDAD_MAX = 64
+MINIMO_US = 1
+
+_perfiles = {}
+_lock = threading.Lock()
+
+
+def dir_perfiles():
+    """Un archivo por endpoint y worker: data/perfiles/<endpoint>.<pid>.prof."""
+    return os.path.join(os.path.dirname(db.DB_PATH), 'perfiles')
+
+
+def debe_perfilar(pedido):
+    """pedido = la solicitud trae X-Perfil con un token valido."""
+    return pedido or (MUESTREO > 0 and random.random() < MUESTREO)
+
+
+def iniciar():
+    perfil = cProfile.Profile()
+    perfil.enable()
+    return perfil, time.perf_counter()
+
+
+def terminar(inicio, endpoint):
+    """Suma el perfil de la solicitud al acumulado del endpoint y lo guarda."""
+    perfil, comienzo = inicio
+    perfil.disable()
+    segundos = time.perf_counter() - comienzo
+    endpoint = endpoint or 'sin_ruta'
+
+    with _lock:
+        acumulado = _perfiles.get(endpoint)
+        if acumulado is None:
+            acumulado = _perfiles[endpoint] = {'stats': pstats.Stats(perfil), 'solicitudes': 0, 'segundos': 0.0}
+        else:
+            acumulado['stats'].add(perfil)
+        acumulado['solicitudes'] += 1
+        acumulado['segundos'] += segundos
+        datos = marshal.dumps(acumulado['stats'].stats)
+        resumen = (acumulado['solicitudes'], acumulado['segundos'])
+
+    # Los demas workers lo leen al descargar
+    os.makedirs(dir_perfiles(), exist_ok=True)
+    archivo = os.path.join(dir_perfiles(), f'{endpoint}.{os.getpid()}.prof')
+    with open(archivo + '.tmp', 'wb') as f:
+        f.write(datos)
+    os.replace(archivo + '.tmp', archivo)
+    with open(archivo + '.resumen', 'w') as f:
+        f.write(f'{resumen[0]} {resumen[1]}')
+
+
+def _archivos(endpoint=None):
+    if not os.path.isdir(dir_perfiles()):
+        return []
+    return [os.path.join(dir_perfiles(), nombre) for nombre in sorted(os.listdir(dir_perfiles()))
+            if nombre.endswith('.prof') and (endpoint is None or nombre.rsplit('.', 2)[0] == endpoint)]
+
+
+def listar():
+    """Endpoints perfilados con solicitudes y segundos, sumando todos los workers."""
+    rutas = {}
+    for archivo in _archivos():
+        endpoint = os.path.basename(archivo).rsplit('.', 2)[0]
+        try:
+            with open(archivo + '.resumen') as f:
+                solicitudes, segundos = f.read().split()
+        except (FileNotFoundError, ValueError):
+            continue
+        ruta = rutas.setdefault(endpoint, {'endpoint': endpoint, 'solicitudes': 0, 'segundos': 0.0})
+        ruta['solicitudes'] += int(solicitudes)
+        ruta['segundos'] += float(segundos)
+    for ruta in rutas.values():
+        ruta['promedio_ms'] = round(ruta['segundos'] / ruta['solicitudes'] * 1000, 2)
+        ruta['segundos'] = round(ruta['segundos'], 3)
+    return sorted(rutas.values(), key=lambda r: r['segundos'], reverse=True)
+
+
+def combinar(endpoint):
+    """pstats.Stats con los perfiles del endpoint de todos los workers (o None)."""
+    archivos = _archivos(endpoint)
+    if not archivos:
+        return None
+    stats = pstats.Stats(archivos[0])
+    for archivo in archivos[1:]:
+        stats.add(archivo)
+    return stats
+
+
+def exportar_pstats(stats):
+    """Formato de Stats.dump_stats: se abre con pstats, snakeviz, etc."""
+    return marshal.dumps(stats.stats)
+
+
+def _nombre(funcion):
+    archivo, linea, nombre = funcion
+    if archivo == '~':
+        return nombre
+    return f'{os.path.basename(archivo)}:{nombre}:{linea}'
+
+
+def pilas_colapsadas(stats):
+    """
+    Pilas 'a;b;c microsegundos' para flamegraph.pl o speedscope. cProfile
+    guarda solo llamador -> llamado, asi que el tiempo propio de cada funcion
+    se reparte entre sus caminos en proporcion al tiempo de cada llamada.
+    """
+    llamados = {}
+    for funcion, (_, _, _, _, llamadores) in stats.stats.items():
+        for llamador, (_, _, _, ct) in llamadores.items():
+            llamados.setdefault(llamador, []).append((funcion, ct))
+
+    pilas = Counter()
+
+    def recorrer(funcion, fraccion, pila):
+        _, _, tt, ct, _ = stats.stats[funcion]
+        pila = pila + [_nombre(funcion)]
+        propio = tt * fraccion * 1e6
+        if propio >= MINIMO_US:
+            pilas[';'.join(pila)] += propio
+        if len(pila) >= PROFUNDIDAD_MAX:
+            return
+        for hijo, ct_llamada in llamados.get(funcion, []):
+            ct_hijo = stats.stats[hijo][3]
+            if hijo == funcion or _nombre(hijo) in pila or not ct_hijo:
+                continue
+            parte = fraccion * ct_llamada / ct_hijo
+            if stats.stats[hijo][3] * parte * 1e6 >= MINIMO_US:
+                recorrer(hijo, parte, pila)
+
+    raices = [f for f, (_, _, _, _, llamadores) in stats.stats.items() if not llamadores]
+    for raiz in raices:
+        recorrer(raiz, 1.0, [])
+    return '\n'.join(f'{pila} {int(us)}' for pila, us in pilas.most_common() if int(us) > 0) + '\n'
+
+
+def reiniciar():
+    with _lock:
+        _perfiles.clear()
+    for archivo in _archivos():
+        for ruta in (archivo, archivo + '.resumen'):
+            if os.path.exists(ruta):
+                os.remove(ruta)
@@ -0,0 +1,154 @@
+import json
+import string
+from functools import lru_cache
+
+# Botones por tipo de mensaje (compartidos por api.py, mensajes.py y reasignacion.py)
+BOTONES_POR_MENSAJE = {
+    'nuevo_lead': [
+        {'id': 'recibido', 'label': 'Recibido', 'accion': 'confirmar_recepcion'},
+        {'id': 'rechazar', 'label': 'Rechazar', 'accion': 'rechazar_lead'}
+    ],
+    'recordatorio_confirmacion': [
+        {'id': 'recibido', 'label': 'Recibido', 'accion': 'confirmar_recepcion'},
+        {'id': 'rechazar', 'label': 'Rechazar', 'accion': 'rechazar_lead'}
+    ],
+    'pedir_contacto': [
+        {'id': 'si_contacte', 'label': 'Si, contacte', 'accion': 'marcar_contactado'},
+        {'id': 'no_pude', 'label': 'No pude', 'accion': 'no_pudo_contactar'},
+        {'id': 'no_contesta', 'label': 'No contesta', 'accion': 'cliente_no_contesta'}
+    ],
+    'seguimiento': [
+        {'id': 'en_negociacion', 'label': 'En negociacion', 'accion': 'marcar_negociacion'},
+        {'id': 'cerrado', 'label': 'Cerrado', 'accion': 'marcar_cerrado'},
+        {'id': 'perdido', 'label': 'Perdido', 'accion': 'marcar_perdido'}
+    ],
+    'felicitacion': [],
+    'alerta_sin_respuesta': [
+        {'id': 'recibido', 'label': 'Recibido', 'accion': 'confirmar_recepcion'}
+    ]
+}
+
+# Botones de los avisos de llamada, segun el estado del contacto
+BOTONES_LLAMADA = {
+    'postventa': [
+        {'id': 'atendido', 'label': 'Ya lo atendi', 'accion': 'marcar_atendido_postventa'},
+        {'id': 'llamar', 'label': 'Voy a llamar', 'accion': 'confirmar_llamada'}
+    ],
+    'reactivacion': [
+        {'id': 'reactivar', 'label': 'Reactivar lead', 'accion': 'reactivar_lead'},
+        {'id': 'ignorar', 'label': 'No interesa', 'accion': 'mantener_perdido'}
+    ],
+    'sin_contactar': [
+        {'id': 'contactado', 'label': 'Ya lo contacte', 'accion': 'marcar_contactado'},
+        {'id': 'llamar', 'label': 'Voy a llamar', 'accion': 'confirmar_llamada'}
+    ],
+    'negociacion': [
+        {'id': 'cerrado', 'label': 'Cerrado', 'accion': 'marcar_cerrado'},
+        {'id': 'seguir', 'label': 'Sigo en contacto', 'accion': 'confirmar_seguimiento'},
+        {'id': 'perdido', 'label': 'Perdido', 'accion': 'marcar_perdido'}
+    ],
+    'atendido': [
+        {'id': 'atendido', 'label': 'Atendido', 'accion': 'marcar_atendido'}
+    ]
+}
+
+# Plantillas de mensaje: id -> (tipo, texto, botones). Un mensaje guarda solo
+# el id y sus parametros propios; {nombre}, {telefono} e {interes} (la
+# propiedad) se toman del contacto al leer
+PLANTILLAS = {
+    'nuevo_lead': ('nuevo_lead', 'Nuevo lead asignado: {nombre} ({telefono}){interes}',
+                   BOTONES_POR_MENSAJE['nuevo_lead']),
+    'lead_reasignado': ('nuevo_lead', 'Lead reasignado: {nombre} ({telefono}){interes}',
+                        BOTONES_POR_MENSAJE['nuevo_lead']),
+    'recordatorio_confirmacion': ('recordatorio_confirmacion',
+                                  'Recordatorio: Tienes un lead pendiente de confirmar: {nombre} ({telefono})',
+                                  BOTONES_POR_MENSAJE['recordatorio_confirmacion']),
+    'pedir_contacto': ('pedir_contacto', '¿Pudiste contactar a {nombre}?',
+                       BOTONES_POR_MENSAJE['pedir_contacto']),
+    'reintentar_contacto': ('pedir_contacto', 'Recordatorio: Intenta contactar a {nombre} ({telefono})',
+                            BOTONES_POR_MENSAJE['pedir_contacto']),
+    'no_contesta': ('pedir_contacto', '¿Pudiste contactar a {nombre}? (intento anterior: no contesta)',
+                    BOTONES_POR_MENSAJE['pedir_contacto']),
+    'seguimiento': ('seguimiento', '¿Como va la gestion con {nombre}?',
+                    BOTONES_POR_MENSAJE['seguimiento']),
+    'felicitacion': ('felicitacion', 'Felicitaciones! Lead {nombre} marcado como cerrado.',
+                     BOTONES_POR_MENSAJE['felicitacion']),
+    'lead_perdido': ('felicitacion', 'Lead {nombre} marcado como perdido. Sigue adelante!', []),
+    'llamada_postventa': ('seguimiento_llamada',
+                          'Postventa: {nombre} ({telefono}) intento comunicarse. Ya es cliente cerrado.',
+                          BOTONES_LLAMADA['postventa']),
+    'llamada_reactivacion': ('seguimiento_llamada',
+                             'Reactivacion: {nombre} ({telefono}) llamo nuevamente. Estaba marcado como perdido.',
+                             BOTONES_LLAMADA['reactivacion']),
+    'llamada_sin_contactar': ('seguimiento_llamada',
+                              'Llamada perdida: {nombre} ({telefono}) intento comunicarse. Aun no lo has contactado.',
+                              BOTONES_LLAMADA['sin_contactar']),
+    'llamada_contactado': ('seguimiento_llamada',
+                           'Seguimiento: {nombre} ({telefono}) llamo. Ya lo habias contactado antes.',
+                           BOTONES_POR_MENSAJE['seguimiento']),
+    'llamada_negociacion': ('seguimiento_llamada',
+                            'Cliente activo: {nombre} ({telefono}) llamo. Esta en negociacion.',
+                            BOTONES_LLAMADA['negociacion']),
+    'llamada_estado': ('seguimiento_llamada',
+                       'Llamada de: {nombre} ({telefono}). Estado actual: {estado}',
+                       BOTONES_LLAMADA['atendido']),
+    'seguimiento_requerido': ('seguimiento_llamada', 'Seguimiento requerido: {nombre} ({telefono})',
+                              BOTONES_LLAMADA['atendido'])
+}
+
+# Mensajes ya armados que se conservan: las bandejas se consultan cada pocos
+# segundos y casi siempre con los mismos contactos
+TAMANO_CACHE = 4096
+
+
+def _compilar(texto):
+    """(parte fija, campo) del formato, analizado una sola vez por plantilla."""
+    return tuple((literal, campo) for literal, campo, _, _ in string.Formatter().parse(texto))
+
+
+_compiladas = {plantilla_id: _compilar(texto) for plantilla_id, (_, texto, _) in PLANTILLAS.items()}
+
+
+def tipo(plantilla_id):
+    return PLANTILLAS[plantilla_id][0]
+
+
+def codificar(parametros):
+    """Parametros propios del mensaje como JSON compacto (None si no hay)."""
+    if not parametros:
+        return None
+    return json.dumps(parametros, separators=(',', ':'), ensure_ascii=False)
+
+
+def _interes(tipo_propiedad, direccion):
+    if tipo_propiedad is None or direccion is None:
+        return ''
+    return f"\nInteresado en: {tipo_propiedad} - {direccion}"
+
+
+@lru_cache(maxsize=TAMANO_CACHE)
+def renderizar(plantilla_id, parametros, nombre, telefono, tipo_propiedad=None, direccion=None):
+    """
+    (contenido, botones) de un mensaje guardado como plantilla. parametros es
+    el JSON guardado en la fila. Los botones son la lista de la plantilla:
+    no se deben modificar.
+    """
+    partes = _compiladas.get(plantilla_id)
+    if partes is None:
+        return '', []
+    valores = json.loads(parametros) if parametros else {}
+    valores.update(nombre=nombre or '', telefono=telefono or '', interes=_interes(tipo_propiedad, direccion))
+    contenido = ''.join(literal + ('' if campo is None else str(valores.get(campo, '')))
+                        for literal, campo in partes)
+    return contenido, PLANTILLAS[plantilla_id][2]
+
+
+def estadisticas():
+    info = renderizar.cache_info()
+    return {
+        'plantillas': len(PLANTILLAS),
+        'entradas': info.currsize,
+        'tamano_max': info.maxsize,
+        'aciertos': info.hits,
+        'fallos': info.misses
+    }
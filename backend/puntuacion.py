@@ -0,0 +1,342 @@
+import math
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import database as db
+
+# Pesos por defecto. Se pueden cambiar con CRM_PESOS_ASIGNACION="carga=2,tipo=0.8"
+PESOS_DEFECTO = {
+    'carga': 1.0,         # leads abiertos (resta)
+    'conversion': 1.0,    # tasa de cierre reciente (suma)
+    'tipo': 0.5,          # especialidad en el tipo de la propiedad (suma)
+    'banda': 0.5,         # especialidad en la banda de precio (suma)
+    'pendientes': 0.5,    # mensajes sin responder (resta)
+    'propietario': 1.0    # el agente es dueno de la propiedad (suma)
+}
+
+# Leads abiertos maximos por agente en asignaciones por lote (0 = sin limite)
+CAPACIDAD_AGENTE = int(os.environ.get('CRM_CAPACIDAD_AGENTE', '0'))
+
+# Ventana de la tasa de conversion y suavizado hacia la tasa global
+DIAS_CONVERSION = 90
+SUAVIZADO_CONVERSION = 5
+
+# Cada cuanto se recargan las caracteristicas desde la base (segundos)
+REFRESCO_SEG = int(os.environ.get('CRM_PUNTUACION_REFRESCO_SEG', '60'))
+
+_motor = None
+_lock = threading.Lock()
+# Hay un motor nuevo armandose en segundo plano
+_recargando = False
+
+
+def _leer_pesos(texto):
+    pesos = dict(PESOS_DEFECTO)
+    for par in filter(None, (p.strip() for p in (texto or '').split(','))):
+        nombre, _, valor = par.partition('=')
+        if nombre.strip() not in pesos:
+            raise ValueError(f'Peso desconocido: {nombre}')
+        pesos[nombre.strip()] = float(valor)
+    return pesos
+
+
+PESOS = _leer_pesos(os.environ.get('CRM_PESOS_ASIGNACION'))
+
+
+def _bandas(precios):
+    """Indice de RANGOS_PRECIO por precio; el ultimo indice es 'sin precio'."""
+    minimos = np.array([minimo for _, minimo in db.RANGOS_PRECIO], dtype=float)
+    precios = np.asarray(precios, dtype=float)
+    bandas = np.searchsorted(minimos, np.nan_to_num(precios, nan=-1), side='right') - 1
+    bandas[np.isnan(precios) | (bandas < 0)] = len(minimos)
+    return bandas
+
+
+def lead_desde_propiedad(propiedad):
+    """Descripcion de un lead para el motor a partir de su propiedad (o None)."""
+    if not propiedad:
+        return {}
+    # Filas de pandas traen NaN en lugar de None
+    return {campo: (None if pd.isna(propiedad.get(origen)) else propiedad.get(origen))
+            for campo, origen in (('tipo', 'tipo'), ('precio', 'precio'), ('propietario_id', 'agente_id'))}
+
+
+class MotorPuntuacion:
+    """
+    Puntaje de cada agente para cada lead, sobre arreglos NumPy en memoria.
+
+    Las caracteristicas por agente (carga, conversion, especialidad por tipo
+    y banda de precio, bandeja sin responder) se cargan de una vez y se
+    ajustan en memoria con cada asignacion, hasta la siguiente recarga.
+    """
+
+    def __init__(self, pesos=None, capacidad=CAPACIDAD_AGENTE):
+        self.pesos = dict(PESOS, **(pesos or {}))
+        self.capacidad = capacidad
+        self.cargado = 0
+        self.ids = np.zeros(0, dtype=np.int64)
+
+    def cargar(self, agentes_ids, carga, conversion, propiedades, pendientes):
+        """
+        agentes_ids: ids de los agentes. carga y pendientes: Series por agente.
+        conversion: DataFrame (agente_id, asignados, cerrados).
+        propiedades: DataFrame (agente_id, tipo, precio).
+        """
+        self.ids = np.asarray(sorted(int(i) for i in agentes_ids), dtype=np.int64)
+        self._posicion = {int(a): i for i, a in enumerate(self.ids)}
+        n = len(self.ids)
+
+        def por_agente(serie):
+            valores = np.zeros(n)
+            for agente_id, valor in serie.items():
+                if pd.notna(agente_id) and int(agente_id) in self._posicion:
+                    valores[self._posicion[int(agente_id)]] = valor
+            return valores
+
+        self.carga = por_agente(carga)
+        self.pendientes = por_agente(pendientes)
+
+        conversion = conversion.set_index('agente_id') if not conversion.empty else conversion
+        asignados = por_agente(conversion['asignados']) if not conversion.empty else np.zeros(n)
+        cerrados = por_agente(conversion['cerrados']) if not conversion.empty else np.zeros(n)
+        global_ = cerrados.sum() / asignados.sum() if asignados.sum() else 0.0
+        self.conversion = (cerrados + SUAVIZADO_CONVERSION * global_) / (asignados + SUAVIZADO_CONVERSION)
+
+        # Especialidad: fraccion de las propiedades del agente en cada tipo / banda
+        propiedades = propiedades.dropna(subset=['agente_id'])
+        propiedades = propiedades[propiedades['agente_id'].astype(np.int64).isin(self._posicion)]
+        self.tipos = {t: i for i, t in enumerate(sorted(propiedades['tipo'].dropna().unique()))}
+        filas = propiedades['agente_id'].astype(np.int64).map(self._posicion).to_numpy(dtype=np.int64)
+        tipos = propiedades['tipo'].map(self.tipos).fillna(-1).astype(int).to_numpy()
+        bandas = _bandas(propiedades['precio'].to_numpy())
+
+        por_tipo = np.zeros((n, len(self.tipos)))
+        validos = tipos >= 0
+        np.add.at(por_tipo, (filas[validos], tipos[validos]), 1)
+        por_banda = np.zeros((n, len(db.RANGOS_PRECIO) + 1))
+        np.add.at(por_banda, (filas, bandas), 1)
+        totales = np.maximum(np.bincount(filas, minlength=n), 1)[:, None] if n else np.ones((0, 1))
+        self.esp_tipo = por_tipo / totales
+        self.esp_banda = por_banda / totales
+
+        self.cargado = time.monotonic()
+        return self
+
+    def _describir(self, leads):
+        """Indices de tipo, banda y propietario de cada lead (-1 = no aplica)."""
+        tipos = np.array([self.tipos.get(l.get('tipo'), -1) for l in leads], dtype=int)
+        precios = np.array([l.get('precio') if l.get('precio') is not None else np.nan for l in leads], dtype=float)
+        bandas = _bandas(precios)
+        bandas[np.array([l.get('precio') is None for l in leads], dtype=bool)] = -1
+        duenos = np.array([
+            self._posicion.get(int(l['propietario_id']), -1) if l.get('propietario_id') else -1
+            for l in leads
+        ], dtype=int)
+        return tipos, bandas, duenos
+
+    def _puntaje_fijo(self, leads):
+        """Parte del puntaje que no cambia al asignar dentro del lote (leads x agentes)."""
+        tipos, bandas, duenos = self._describir(leads)
+        p = self.pesos
+        puntaje = np.tile(p['conversion'] * self.conversion, (len(leads), 1))
+        con_tipo = tipos >= 0
+        puntaje[con_tipo] += p['tipo'] * self.esp_tipo[:, tipos[con_tipo]].T
+        con_banda = bandas >= 0
+        puntaje[con_banda] += p['banda'] * self.esp_banda[:, bandas[con_banda]].T
+        con_dueno = np.flatnonzero(duenos >= 0)
+        puntaje[con_dueno, duenos[con_dueno]] += p['propietario']
+        return puntaje
+
+    def _puntaje_variable(self, carga, pendientes):
+        escala_carga = self.capacidad or max(carga.max(initial=0), 1)
+        escala_pendientes = max(pendientes.max(initial=0), 1)
+        return -(self.pesos['carga'] * carga / escala_carga
+                 + self.pesos['pendientes'] * pendientes / escala_pendientes)
+
+    def puntuar(self, leads):
+        """Matriz de puntajes (leads x agentes) con la carga actual."""
+        return self._puntaje_fijo(leads) + self._puntaje_variable(self.carga, self.pendientes)
+
+    def asignar_lote(self, leads, capacidad=None, excluir=()):
+        """
+        Asigna cada lead al agente de mayor puntaje respetando la capacidad.
+
+        Por rondas: cada lead pendiente elige su mejor agente disponible y cada
+        agente acepta a lo sumo su parte pareja del resto, quedandose con los
+        de mayor puntaje; luego se recalcula la carga. Retorna una lista de
+        ids de agente (None si no quedo capacidad).
+        """
+        capacidad = self.capacidad if capacidad is None else capacidad
+        if not leads or not len(self.ids):
+            return [None] * len(leads)
+
+        fijo = self._puntaje_fijo(leads)
+        carga = self.carga.copy()
+        pendientes = self.pendientes.copy()
+        restantes = np.full(len(self.ids), np.inf) if not capacidad else np.maximum(capacidad - carga, 0)
+        for agente_id in excluir:
+            if int(agente_id) in self._posicion:
+                restantes[self._posicion[int(agente_id)]] = 0
+
+        asignado = np.full(len(leads), -1)
+        while True:
+            sin_asignar = np.flatnonzero(asignado < 0)
+            disponibles = restantes > 0
+            if not sin_asignar.size or not disponibles.any():
+                break
+
+            puntaje = fijo[sin_asignar] + self._puntaje_variable(carga, pendientes)
+            puntaje[:, ~disponibles] = -np.inf
+            elegido = puntaje.argmax(axis=1)
+            mejor = puntaje[np.arange(len(sin_asignar)), elegido]
+
+            parte = math.ceil(len(sin_asignar) / disponibles.sum())
+            cupo = np.minimum(restantes, parte)
+
+            # Ordenar por agente y, dentro de cada agente, por puntaje descendente
+            orden = np.lexsort((-mejor, elegido))
+            agentes_orden = elegido[orden]
+            posicion = np.arange(len(orden)) - np.searchsorted(agentes_orden, agentes_orden)
+            aceptados = orden[posicion < cupo[agentes_orden]]
+
+            asignado[sin_asignar[aceptados]] = elegido[aceptados]
+            recibidos = np.bincount(elegido[aceptados], minlength=len(self.ids))
+            carga += recibidos
+            pendientes += recibidos
+            restantes -= recibidos
+
+        # No se toca el estado: la carga y los pendientes suben recien cuando
+        # el lead y su aviso se confirman en la base (registrar)
+        return [int(self.ids[a]) if a >= 0 else None for a in asignado]
+
+    def mejor_agente(self, lead):
+        """Un solo lead: si todos estan a capacidad, igual va al de mejor puntaje."""
+        return self.asignar_lote([lead])[0] or self.asignar_lote([lead], capacidad=0)[0]
+
+    def registrar(self, agente_id, cerrados=0, respondidos=0, nuevos=0, asignados=0):
+        """Ajusta la carga (asignados, cerrados) y los pendientes (nuevos, respondidos) de un agente."""
+        posicion = self._posicion.get(int(agente_id)) if agente_id is not None else None
+        if posicion is not None:
+            self.carga[posicion] = max(self.carga[posicion] + asignados - cerrados, 0)
+            self.pendientes[posicion] = max(self.pendientes[posicion] + nuevos - respondidos, 0)
+
+
+def caracteristicas_sqlite():
+    """Agregados por agente leidos de todos los fragmentos."""
+    ids = []
+    carga = []
+    conversion = []
+    propiedades = []
+    pendientes = []
+    for ruta in db.rutas():
+        conn = db.get_connection(ruta)
+        # Los agentes de licencia no se puntuan
+        ids.extend(row[0] for row in conn.execute('SELECT id FROM agentes WHERE disponible = 1'))
+        carga.append(pd.read_sql_query(f'''
+            SELECT agente_asignado_id AS agente_id, COUNT(*) AS total FROM contactos
+            WHERE estado NOT IN {db.ESTADOS_CERRADOS}
+            GROUP BY agente_asignado_id
+        ''', conn))
+        conversion.append(pd.read_sql_query('''
+            SELECT agente_asignado_id AS agente_id, COUNT(*) AS asignados,
+                   SUM(estado = 'Cerrado') AS cerrados
+            FROM contactos WHERE fecha >= datetime('now', ?)
+            GROUP BY agente_asignado_id
+        ''', conn, params=(f'-{DIAS_CONVERSION} days',)))
+        propiedades.append(pd.read_sql_query('SELECT agente_id, tipo, precio FROM propiedades', conn))
+        pendientes.append(pd.read_sql_query('''
+            SELECT agente_id, COUNT(*) AS total FROM mensajes
+            WHERE respondido = 0
+            GROUP BY agente_id
+        ''', conn))
+        conn.close()
+
+    carga = pd.concat(carga).dropna().set_index('agente_id')['total']
+    pendientes = pd.concat(pendientes).dropna().set_index('agente_id')['total']
+    conversion = pd.concat(conversion).dropna(subset=['agente_id'])
+    return ids, carga, conversion, pd.concat(propiedades, ignore_index=True), pendientes
+
+
+def caracteristicas_tablas(agentes, propiedades, contactos, mensajes=None):
+    """Los mismos agregados a partir de DataFrames completos (asignacion.py)."""
+    abiertos = contactos[~contactos['estado'].isin(db.ESTADOS_CERRADOS)]
+    carga = abiertos.groupby('agente_asignado_id').size()
+
+    fechas = pd.to_datetime(contactos['fecha'], errors='coerce')
+    recientes = contactos[fechas >= pd.Timestamp.now() - pd.Timedelta(days=DIAS_CONVERSION)]
+    conversion = recientes.assign(cerrado=recientes['estado'] == 'Cerrado').groupby('agente_asignado_id').agg(
+        asignados=('estado', 'size'), cerrados=('cerrado', 'sum')
+    ).reset_index().rename(columns={'agente_asignado_id': 'agente_id'})
+
+    if mensajes is not None and not mensajes.empty:
+        sin_responder = mensajes[mensajes['respondido'].isin([0, False, '0', 'False'])]
+        pendientes = sin_responder.groupby('agente_id').size()
+    else:
+        pendientes = pd.Series(dtype=float)
+
+    if 'disponible' in agentes.columns:
+        agentes = agentes[agentes['disponible'].fillna(1).astype(bool)]
+    return agentes['id'].tolist(), carga, conversion, propiedades[['agente_id', 'tipo', 'precio']], pendientes
+
+
+def _recargar():
+    global _motor, _recargando
+    try:
+        motor = MotorPuntuacion().cargar(*caracteristicas_sqlite())
+        with _lock:
+            _motor = motor
+    except Exception as e:
+        print(f"--> PUNTUACION: error recargando el motor: {e}")
+    finally:
+        with _lock:
+            _recargando = False
+
+
+def obtener_motor(forzar=False):
+    """
+    Motor compartido de la API. La primera carga (o forzar) es sincronica; despues,
+    vencido REFRESCO_SEG, un hilo arma un motor nuevo fuera de _lock y reemplaza
+    la referencia. Mientras tanto las asignaciones siguen con el anterior.
+    """
+    global _motor, _recargando
+    if forzar or _motor is None:
+        motor = MotorPuntuacion().cargar(*caracteristicas_sqlite())
+        with _lock:
+            _motor = motor
+        return motor
+
+    with _lock:
+        motor = _motor
+        if _recargando or time.monotonic() - motor.cargado <= REFRESCO_SEG:
+            return motor
+        _recargando = True
+    threading.Thread(target=_recargar, name='puntuacion', daemon=True).start()
+    return motor
+
+
+def asignar(lead):
+    """Mejor agente para un lead (None si no hay agentes)."""
+    motor = obtener_motor()
+    with _lock:
+        return motor.mejor_agente(lead)
+
+
+def asignar_lote(leads, excluir=(), capacidad=None):
+    """Asignacion por lote con el motor compartido (ver MotorPuntuacion.asignar_lote)."""
+    motor = obtener_motor()
+    with _lock:
+        return motor.asignar_lote(leads, capacidad=capacidad, excluir=excluir)
+
+
+def registrar(agente_id, cerrados=0, respondidos=0, nuevos=0, asignados=0):
+    """
+    Ajuste incremental del motor ya cargado, despues de confirmar la escritura;
+    sin motor no hay nada que ajustar. asignados son leads creados o
+    reasignados al agente, nuevos son mensajes pendientes creados (no los
+    agrupados) y respondidos los que pasaron de pendientes a respondidos.
+    """
+    with _lock:
+        if _motor is not None:
+            _motor.registrar(agente_id, cerrados, respondidos, nuevos, asignados)
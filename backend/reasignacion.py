@@ -0,0 +1,93 @@
+import database as db
+import fragmentos
+import puntuacion
+
+
+def _otras_oficinas(agente_id):
+    """
+    Agentes que no pueden recibir leads de agente_id: los leads no cambian de
+    oficina porque su id pertenece al bloque (y fragmento) de la oficina.
+    """
+    numero = int(agente_id) // fragmentos.BLOQUE_IDS
+    return [int(a) for a in puntuacion.obtener_motor().ids if int(a) // fragmentos.BLOQUE_IDS != numero]
+
+
+def _registrar(movidos_por_agente, reemplazados, recibidos_por_agente):
+    """
+    Ajusta el motor una vez confirmada la reasignacion: descuenta los leads
+    que dejaron los agentes anteriores y los pendientes reemplazados, y suma
+    a cada agente nuevo sus leads y su aviso 'lead_reasignado' por lead.
+    """
+    for agente_id, cantidad in movidos_por_agente.items():
+        puntuacion.registrar(agente_id, cerrados=cantidad)
+    for agente_id, cantidad in reemplazados.items():
+        puntuacion.registrar(agente_id, respondidos=cantidad)
+    for agente_id, cantidad in recibidos_por_agente.items():
+        puntuacion.registrar(agente_id, nuevos=cantidad, asignados=cantidad)
+
+
+def reasignar_rechazo(contacto, agente_id):
+    """
+    Lead rechazado: pasa al agente de mejor puntaje de la misma oficina,
+    excluyendo al que lo rechazo. Retorna el agente nuevo o None si no hay otro.
+    """
+    propiedad = db.get_propiedad(contacto['propiedad_id']) if contacto.get('propiedad_id') else None
+    excluir = [int(agente_id)] + _otras_oficinas(agente_id)
+    nuevo = puntuacion.asignar_lote([puntuacion.lead_desde_propiedad(propiedad)], excluir=excluir)[0]
+    if nuevo is None:
+        return None
+
+    reemplazados = db.reasignar_contactos([(contacto['id'], nuevo)], nuevo_estado='Asignado')
+    _registrar({int(agente_id): 1}, reemplazados, {nuevo: 1})
+    return nuevo
+
+
+def rebalancear(agentes_ids, licencia=False):
+    """
+    Reparte los leads abiertos de uno o mas agentes entre el resto de su
+    oficina, con el motor de puntaje y una transaccion por fragmento.
+    Con licencia=True los agentes ademas dejan de recibir leads nuevos.
+    """
+    agentes_ids = [int(a) for a in agentes_ids]
+    if licencia:
+        for agente_id in agentes_ids:
+            db.actualizar_disponibilidad(agente_id, False)
+        puntuacion.obtener_motor(forzar=True)
+
+    # Agrupar por oficina: cada grupo se reparte dentro de su oficina
+    por_oficina = {}
+    for lead in db.get_leads_abiertos(agentes_ids):
+        por_oficina.setdefault(lead['agente_asignado_id'] // fragmentos.BLOQUE_IDS, []).append(lead)
+
+    reasignados = 0
+    sin_agente = 0
+    for leads in por_oficina.values():
+        excluir = agentes_ids + _otras_oficinas(leads[0]['agente_asignado_id'])
+        destinos = puntuacion.asignar_lote(leads, excluir=excluir)
+
+        asignaciones = []
+        movidos = {}
+        recibidos = {}
+        for lead, destino in zip(leads, destinos):
+            if destino is None:
+                sin_agente += 1
+                continue
+            asignaciones.append((lead['id'], destino))
+            movidos[lead['agente_asignado_id']] = movidos.get(lead['agente_asignado_id'], 0) + 1
+            recibidos[destino] = recibidos.get(destino, 0) + 1
+
+        _registrar(movidos, db.reasignar_contactos(asignaciones), recibidos)
+        reasignados += len(asignaciones)
+
+    return {'reasignados': reasignados, 'sin_agente': sin_agente}
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 2:
+        print("Uso: python reasignacion.py <agente_id> [<agente_id> ...] [--licencia]")
+        sys.exit(1)
+    db.init_db()
+    ids = [a for a in sys.argv[1:] if a != '--licencia']
+    resultado = rebalancear(ids, licencia='--licencia' in sys.argv)
+    print(f"Reasignados {resultado['reasignados']} leads ({resultado['sin_agente']} sin agente disponible)")
@@ -0,0 +1,353 @@
+import fcntl
+import json
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+import cache
+import database as db
+import escritura
+import fragmentos
+
+# Paginas copiadas por paso de la API de backup; entre pasos los escritores avanzan
+PAGINAS_POR_PASO = int(os.environ.get('CRM_RESPALDO_PAGINAS', '256'))
+
+# Pausa entre pasos (segundos)
+PAUSA_SEG = 0.005
+
+# Reinicios tolerados por escrituras concurrentes antes de copiar en un solo paso
+MAX_REINICIOS = 3
+
+# Lock compartido del proceso de la API mientras vive (ver marcar_servicio_activo)
+_servicio = None
+
+
+def dir_respaldos():
+    """Los respaldos viven junto a la base principal: data/respaldos/<id>/."""
+    return os.environ.get('CRM_RESPALDOS_DIR') or os.path.join(os.path.dirname(db.DB_PATH), 'respaldos')
+
+
+def ruta_servicio():
+    """Lock de servicio junto a la base principal: data/servicio.lock."""
+    return os.path.join(os.path.dirname(db.DB_PATH), 'servicio.lock')
+
+
+def marcar_servicio_activo():
+    """
+    Toma el lock de servicio compartido por el resto de la vida del proceso.
+    Lo llama cada proceso de la API al arrancar; si hay una restauracion en
+    curso espera a que termine.
+    """
+    global _servicio
+    if _servicio is None:
+        os.makedirs(os.path.dirname(ruta_servicio()) or '.', exist_ok=True)
+        archivo = open(ruta_servicio(), 'a')
+        fcntl.flock(archivo, fcntl.LOCK_SH)
+        _servicio = archivo
+    return _servicio
+
+
+def bloquear_servicio(tarea):
+    """
+    Lock de servicio exclusivo para tareas que reescriben las bases en el
+    lugar; falla si algun proceso de la API sigue vivo. Se libera con close().
+    """
+    os.makedirs(os.path.dirname(ruta_servicio()) or '.', exist_ok=True)
+    archivo = open(ruta_servicio(), 'a')
+    try:
+        fcntl.flock(archivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        archivo.close()
+        raise RuntimeError(f'La API esta corriendo: detenerla antes de {tarea}')
+    return archivo
+
+
+def _archivos():
+    """(nombre, ruta) de cada fragmento y su archivo de mensajes."""
+    archivos = []
+    for ruta in db.rutas():
+        for candidato in (ruta, db.ruta_archivo(ruta)):
+            if os.path.exists(candidato):
+                nombre = os.path.basename(candidato)
+                if any(n == nombre for n, _ in archivos):
+                    nombre = f'{len(archivos)}_{nombre}'
+                archivos.append((nombre, candidato))
+    return archivos
+
+
+class _Reinicio(Exception):
+    pass
+
+
+def _copiar_en_linea(origen, destino):
+    """
+    Copia consistente con la API de backup de SQLite, de a PAGINAS_POR_PASO.
+    Cada paso toma el bloqueo de lectura solo mientras copia esas paginas.
+    Si otra conexion escribe entre pasos SQLite reinicia la copia; con
+    escrituras constantes, despues de MAX_REINICIOS se copia en un solo paso.
+    """
+    fuente = sqlite3.connect(origen)
+    copia = sqlite3.connect(destino)
+    pasos = []
+    reinicios = [0]
+    anterior = [None]
+    fin_paso = [time.perf_counter()]
+
+    def progreso(estado, restantes, total):
+        pasos.append(time.perf_counter() - fin_paso[0])
+        if anterior[0] is not None and restantes > anterior[0]:
+            reinicios[0] += 1
+            if reinicios[0] > MAX_REINICIOS:
+                raise _Reinicio()
+        anterior[0] = restantes
+        time.sleep(PAUSA_SEG)
+        fin_paso[0] = time.perf_counter()
+
+    inicio = time.perf_counter()
+    try:
+        fuente.backup(copia, pages=PAGINAS_POR_PASO, progress=progreso)
+    except _Reinicio:
+        fin_paso[0] = time.perf_counter()
+        fuente.backup(copia, pages=-1)
+        pasos.append(time.perf_counter() - fin_paso[0])
+    segundos = time.perf_counter() - inicio
+    paginas = copia.execute('PRAGMA page_count').fetchone()[0]
+    integridad = copia.execute('PRAGMA integrity_check').fetchone()[0]
+    fuente.close()
+    copia.close()
+
+    return {
+        'paginas': paginas,
+        'bytes': os.path.getsize(destino),
+        'segundos': round(segundos, 3),
+        'pasos': len(pasos),
+        'reinicios': reinicios[0],
+        'pausa_max_ms': round(max(pasos, default=0) * 1000, 2),
+        'mb_por_seg': round(os.path.getsize(destino) / 1e6 / segundos, 1) if segundos else None,
+        'integridad': integridad
+    }
+
+
+def _paginas(ruta, tamano):
+    with open(ruta, 'rb') as f:
+        while True:
+            pagina = f.read(tamano)
+            if not pagina:
+                return
+            yield pagina
+
+
+def _guardar_delta(base, nueva, salida):
+    """Guarda en 'salida' (una base SQLite) solo las paginas de 'nueva' distintas de 'base'."""
+    conn = sqlite3.connect(nueva)
+    tamano = conn.execute('PRAGMA page_size').fetchone()[0]
+    conn.close()
+
+    delta = sqlite3.connect(salida)
+    delta.execute('CREATE TABLE meta (clave TEXT PRIMARY KEY, valor INTEGER)')
+    delta.execute('CREATE TABLE paginas (numero INTEGER PRIMARY KEY, datos BLOB)')
+    total = 0
+    distintas = 0
+    paginas_base = _paginas(base, tamano)
+    for numero, pagina in enumerate(_paginas(nueva, tamano)):
+        total += 1
+        if next(paginas_base, None) != pagina:
+            delta.execute('INSERT INTO paginas VALUES (?, ?)', (numero, pagina))
+            distintas += 1
+    delta.executemany('INSERT INTO meta VALUES (?, ?)', [('tamano_pagina', tamano), ('paginas', total)])
+    delta.commit()
+    delta.close()
+    return distintas
+
+
+def _aplicar_delta(delta, destino):
+    conn = sqlite3.connect(delta)
+    meta = dict(conn.execute('SELECT clave, valor FROM meta'))
+    with open(destino, 'r+b') as f:
+        for numero, datos in conn.execute('SELECT numero, datos FROM paginas ORDER BY numero'):
+            f.seek(numero * meta['tamano_pagina'])
+            f.write(datos)
+        f.truncate(meta['paginas'] * meta['tamano_pagina'])
+    conn.close()
+
+
+def _leer_manifiesto(respaldo_id):
+    ruta = os.path.join(dir_respaldos(), respaldo_id, 'manifiesto.json')
+    if not os.path.exists(ruta):
+        raise ValueError(f'Respaldo desconocido: {respaldo_id}')
+    with open(ruta) as f:
+        return json.load(f)
+
+
+def listar_respaldos():
+    """Manifiestos de los respaldos, del mas viejo al mas nuevo."""
+    directorio = dir_respaldos()
+    if not os.path.isdir(directorio):
+        return []
+    return [_leer_manifiesto(nombre) for nombre in sorted(os.listdir(directorio))
+            if os.path.exists(os.path.join(directorio, nombre, 'manifiesto.json'))]
+
+
+def crear_respaldo(incremental=False):
+    """
+    Respaldo en linea de todos los fragmentos, sin detener la API.
+
+    Un respaldo incremental guarda solo las paginas que cambiaron desde el
+    ultimo respaldo completo; para restaurar alcanza con ese completo y el
+    incremental. Cada copia se verifica con PRAGMA integrity_check.
+    """
+    completos = [r for r in listar_respaldos() if r['tipo'] == 'completo']
+    base = completos[-1] if incremental and completos else None
+
+    respaldo_id = datetime.now().strftime('%Y%m%d-%H%M%S')
+    directorio = os.path.join(dir_respaldos(), respaldo_id)
+    while os.path.exists(directorio):
+        respaldo_id += '_'
+        directorio = os.path.join(dir_respaldos(), respaldo_id)
+    os.makedirs(directorio)
+
+    inicio = time.perf_counter()
+    archivos = []
+    for nombre, ruta in _archivos():
+        copia = os.path.join(directorio, nombre)
+        datos = dict(_copiar_en_linea(ruta, copia), nombre=nombre, ruta=ruta, tipo='completo')
+        if datos['integridad'] != 'ok':
+            shutil.rmtree(directorio)
+            raise RuntimeError(f'Copia de {ruta} con errores: {datos["integridad"]}')
+
+        anterior = next((a for a in base['archivos'] if a['ruta'] == ruta), None) if base else None
+        if anterior and anterior['tipo'] == 'completo':
+            datos['paginas_distintas'] = _guardar_delta(
+                os.path.join(dir_respaldos(), base['id'], anterior['nombre']), copia, copia + '.delta'
+            )
+            os.remove(copia)
+            datos.update(tipo='delta', bytes=os.path.getsize(copia + '.delta'))
+        archivos.append(datos)
+
+    mapa = fragmentos.ruta_mapa(db.DB_PATH)
+    if os.path.exists(mapa):
+        shutil.copyfile(mapa, os.path.join(directorio, 'fragmentos.json'))
+
+    manifiesto = {
+        'id': respaldo_id,
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'tipo': 'incremental' if base else 'completo',
+        'base': base['id'] if base else None,
+        'segundos': round(time.perf_counter() - inicio, 3),
+        'bytes': sum(a['bytes'] for a in archivos),
+        'archivos': archivos
+    }
+    with open(os.path.join(directorio, 'manifiesto.json'), 'w') as f:
+        json.dump(manifiesto, f, indent=2)
+    return manifiesto
+
+
+def _reconstruir(manifiesto, archivo, destino):
+    """Arma en 'destino' la base de un archivo del respaldo y la verifica."""
+    directorio = os.path.join(dir_respaldos(), manifiesto['id'])
+    if archivo['tipo'] == 'delta':
+        base = next(a for a in _leer_manifiesto(manifiesto['base'])['archivos'] if a['ruta'] == archivo['ruta'])
+        shutil.copyfile(os.path.join(dir_respaldos(), manifiesto['base'], base['nombre']), destino)
+        _aplicar_delta(os.path.join(directorio, archivo['nombre'] + '.delta'), destino)
+    else:
+        shutil.copyfile(os.path.join(directorio, archivo['nombre']), destino)
+
+    conn = sqlite3.connect(destino)
+    integridad = conn.execute('PRAGMA integrity_check').fetchone()[0]
+    conn.close()
+    if integridad != 'ok':
+        raise RuntimeError(f'Respaldo de {archivo["ruta"]} con errores: {integridad}')
+
+
+def verificar_respaldo(respaldo_id):
+    """Reconstruye cada archivo en un temporal y corre integrity_check."""
+    manifiesto = _leer_manifiesto(respaldo_id)
+    temporal = os.path.join(dir_respaldos(), respaldo_id, 'verificacion.tmp')
+    try:
+        for archivo in manifiesto['archivos']:
+            _reconstruir(manifiesto, archivo, temporal)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+    return len(manifiesto['archivos'])
+
+
+def restaurar_respaldo(respaldo_id, destino=None):
+    """
+    Restaura un respaldo. Cada archivo se arma y verifica en '<ruta>.restaurando'
+    y recien cuando todos estan bien se reemplazan con os.replace (atomico).
+
+    Restaurar sobre la base en uso exige la API detenida: otro worker con
+    conexiones abiertas seguiria escribiendo en los archivos reemplazados.
+    Se verifica con el lock de servicio exclusivo, que se mantiene hasta el
+    final para que ningun worker arranque a mitad del reemplazo.
+    Con 'destino' se restaura en ese directorio sin tocar la base en uso.
+    """
+    manifiesto = _leer_manifiesto(respaldo_id)
+    servicio = None if destino else bloquear_servicio(
+        'restaurar sobre la base en uso (o restaurar en otro directorio)')
+    try:
+        return _restaurar(manifiesto, destino)
+    finally:
+        if servicio is not None:
+            servicio.close()
+
+
+def _restaurar(manifiesto, destino):
+    respaldo_id = manifiesto['id']
+    inicio = time.perf_counter()
+    listos = []
+    try:
+        for archivo in manifiesto['archivos']:
+            final = os.path.join(destino, archivo['nombre']) if destino else archivo['ruta']
+            os.makedirs(os.path.dirname(final) or '.', exist_ok=True)
+            _reconstruir(manifiesto, archivo, final + '.restaurando')
+            listos.append(final)
+    except Exception:
+        for final in listos + [final]:
+            if os.path.exists(final + '.restaurando'):
+                os.remove(final + '.restaurando')
+        raise
+
+    if not destino:
+        # Escritores agrupados de este proceso: tienen conexiones abiertas a los archivos viejos
+        escritura.detener_todos()
+    for final in listos:
+        # Un journal viejo se aplicaria sobre la base restaurada
+        for sufijo in ('-journal', '-wal', '-shm'):
+            if os.path.exists(final + sufijo):
+                os.remove(final + sufijo)
+        os.replace(final + '.restaurando', final)
+
+    mapa = os.path.join(dir_respaldos(), respaldo_id, 'fragmentos.json')
+    if os.path.exists(mapa):
+        shutil.copyfile(mapa, os.path.join(destino, 'fragmentos.json') if destino
+                        else fragmentos.ruta_mapa(db.DB_PATH))
+    if not destino:
+        cache.invalidar_todo()
+
+    return {'archivos': len(listos), 'segundos': round(time.perf_counter() - inicio, 3)}
+
+
+if __name__ == '__main__':
+    import sys
+    comando = sys.argv[1] if len(sys.argv) > 1 else ''
+
+    if comando == 'crear':
+        r = crear_respaldo(incremental='--incremental' in sys.argv)
+        print(f"Respaldo {r['tipo']} {r['id']}: {r['bytes']} bytes en {r['segundos']} s")
+        for a in r['archivos']:
+            print(f"  {a['nombre']:<25} {a['tipo']:<9} {a['paginas']} paginas, {a['mb_por_seg']} MB/s, "
+                  f"pausa max {a['pausa_max_ms']} ms")
+    elif comando == 'listar':
+        for r in listar_respaldos():
+            print(f"{r['id']:<18} {r['tipo']:<12} {r['bytes']:>12} bytes  base: {r['base'] or '-'}")
+    elif comando == 'verificar' and len(sys.argv) == 3:
+        print(f"Respaldo {sys.argv[2]}: {verificar_respaldo(sys.argv[2])} archivos verificados")
+    elif comando == 'restaurar' and len(sys.argv) in (3, 4):
+        r = restaurar_respaldo(sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else None)
+        print(f"Restaurados {r['archivos']} archivos en {r['segundos']} s")
+    else:
+        print("Uso: python respaldo.py [crear [--incremental] | listar | verificar <id> | restaurar <id> [directorio]]")
+        sys.exit(1)
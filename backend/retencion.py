@@ -0,0 +1,200 @@
+import os
+import threading
+import time
+import database as db
+import respaldo
+
+# Dias que se conservan los mensajes respondidos de leads cerrados o perdidos (0 = sin archivado)
+RETENCION_DIAS = int(os.environ.get('CRM_RETENCION_DIAS', '0'))
+
+# Cada cuanto corre el archivado en segundo plano (segundos)
+INTERVALO_SEG = int(os.environ.get('CRM_RETENCION_INTERVALO_SEG', '3600'))
+
+# Mensajes movidos por transaccion; lotes chicos = bloqueos de escritura cortos
+TAMANO_LOTE = 500
+
+# Paginas liberadas por paso de incremental_vacuum
+PAGINAS_VACUUM = 256
+
+# Pausa entre lotes para dejar pasar a otros escritores
+PAUSA_SEG = 0.05
+
+
+def _conectar_archivo(ruta):
+    """Conexion a un fragmento con su archivo adjunto como 'archivo'."""
+    conn = db.get_connection(ruta)
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    cursor.execute('ATTACH DATABASE ? AS archivo', (db.ruta_archivo(ruta),))
+    _sincronizar_esquema(cursor)
+    return conn
+
+
+def _sincronizar_esquema(cursor):
+    """Crea archivo.mensajes y agrega las columnas nuevas de mensajes."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archivo.mensajes AS
+        SELECT * FROM main.mensajes WHERE 0
+    ''')
+    cursor.execute('PRAGMA main.table_info(mensajes)')
+    columnas = [(row[1], row[2]) for row in cursor.fetchall()]
+    cursor.execute('PRAGMA archivo.table_info(mensajes)')
+    existentes = {row[1] for row in cursor.fetchall()}
+    for nombre, tipo in columnas + [('fecha_archivo', 'TIMESTAMP')]:
+        if nombre not in existentes:
+            cursor.execute(f'ALTER TABLE archivo.mensajes ADD COLUMN {nombre} {tipo}')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS archivo.ux_archivo_id ON mensajes(id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS archivo.idx_archivo_agente_fecha ON mensajes(agente_id, fecha)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS archivo.idx_archivo_contacto_fecha ON mensajes(contacto_id, fecha)')
+    # Los resumenes de analitica.py recalculan dias completos tambien sobre el archivo
+    cursor.execute('CREATE INDEX IF NOT EXISTS archivo.idx_archivo_fecha ON mensajes(fecha)')
+    return [nombre for nombre, _ in columnas]
+
+
+def archivar_mensajes(dias=None, tamano_lote=TAMANO_LOTE):
+    """
+    Mueve al archivo los mensajes respondidos con mas de 'dias' de antiguedad
+    cuyo lead esta cerrado o perdido. Cada lote es una transaccion corta.
+    Cada fragmento tiene su propio archivo.
+    """
+    dias = RETENCION_DIAS if dias is None else dias
+    return sum(_archivar_fragmento(ruta, dias, tamano_lote) for ruta in db.rutas())
+
+
+def _archivar_fragmento(ruta, dias, tamano_lote):
+    conn = _conectar_archivo(ruta)
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA main.table_info(mensajes)')
+    columnas = ', '.join(row[1] for row in cursor.fetchall())
+
+    total = 0
+    while True:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('DROP TABLE IF EXISTS temp.lote_archivo')
+        cursor.execute(f'''
+            CREATE TEMP TABLE lote_archivo AS
+            SELECT m.id FROM main.mensajes m
+            JOIN main.contactos c ON c.id = m.contacto_id
+            WHERE m.respondido = 1
+              AND m.fecha < datetime('now', ?)
+              AND c.estado IN {db.ESTADOS_CERRADOS}
+            LIMIT ?
+        ''', (f'-{int(dias)} days', tamano_lote))
+        cursor.execute('SELECT COUNT(*) FROM temp.lote_archivo')
+        movidos = cursor.fetchone()[0]
+        if movidos == 0:
+            cursor.execute('COMMIT')
+            break
+
+        cursor.execute(f'''
+            INSERT INTO archivo.mensajes ({columnas}, fecha_archivo)
+            SELECT {columnas}, CURRENT_TIMESTAMP FROM main.mensajes
+            WHERE id IN (SELECT id FROM temp.lote_archivo)
+        ''')
+        cursor.execute('DELETE FROM main.mensajes WHERE id IN (SELECT id FROM temp.lote_archivo)')
+        cursor.execute('COMMIT')
+
+        total += movidos
+        if movidos < tamano_lote:
+            break
+        time.sleep(PAUSA_SEG)
+
+    conn.close()
+    return total
+
+
+def liberar_espacio(paginas=PAGINAS_VACUUM):
+    """Devuelve al sistema las paginas libres, de a 'paginas' por transaccion."""
+    return sum(_liberar_fragmento(ruta, paginas) for ruta in db.rutas())
+
+
+def _liberar_fragmento(ruta, paginas):
+    conn = db.get_connection(ruta)
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA auto_vacuum')
+    if cursor.fetchone()[0] != 2:
+        # Base anterior a auto_vacuum: ver convertir_auto_vacuum
+        conn.close()
+        return 0
+    liberadas = 0
+    while True:
+        cursor.execute('PRAGMA freelist_count')
+        libres = cursor.fetchone()[0]
+        if libres == 0:
+            break
+        # executescript corre el pragma hasta el final; execute libera una sola pagina
+        conn.executescript(f'PRAGMA incremental_vacuum({min(paginas, libres)});')
+        cursor.execute('PRAGMA freelist_count')
+        restantes = cursor.fetchone()[0]
+        if restantes >= libres:
+            break
+        liberadas += libres - restantes
+        time.sleep(PAUSA_SEG)
+    conn.close()
+    return liberadas
+
+
+def convertir_auto_vacuum():
+    """
+    Pasa a auto_vacuum incremental los fragmentos creados antes de que
+    init_fragmento lo fijara. Requiere un VACUUM completo de cada base, asi
+    que se corre una sola vez, a mano y con la API detenida.
+    Retorna las rutas convertidas.
+    """
+    servicio = respaldo.bloquear_servicio('convertir las bases a auto_vacuum incremental')
+    convertidas = []
+    try:
+        for ruta in db.rutas():
+            conn = db.get_connection(ruta)
+            conn.isolation_level = None
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                conn.execute('VACUUM')
+                convertidas.append(ruta)
+            conn.close()
+    finally:
+        servicio.close()
+    return convertidas
+
+
+def ejecutar(dias=None):
+    archivados = archivar_mensajes(dias)
+    paginas = liberar_espacio()
+    return {'archivados': archivados, 'paginas_liberadas': paginas}
+
+
+def _bucle(dias, intervalo):
+    while True:
+        try:
+            resultado = ejecutar(dias)
+            if resultado['archivados']:
+                print(f"--> RETENCION: {resultado['archivados']} mensajes archivados, "
+                      f"{resultado['paginas_liberadas']} paginas liberadas")
+        except Exception as e:
+            print(f"--> RETENCION: error archivando mensajes: {e}")
+        time.sleep(intervalo)
+
+
+def iniciar_en_segundo_plano(dias=None, intervalo=INTERVALO_SEG):
+    """Lanza el archivado periodico si hay politica de retencion configurada."""
+    dias = RETENCION_DIAS if dias is None else dias
+    if dias <= 0:
+        return None
+    hilo = threading.Thread(target=_bucle, args=(dias, intervalo), name='retencion', daemon=True)
+    hilo.start()
+    return hilo
+
+
+if __name__ == '__main__':
+    import sys
+    if '--auto-vacuum' in sys.argv:
+        convertidas = convertir_auto_vacuum()
+        print(f"Convertidas a auto_vacuum incremental: {', '.join(convertidas) or 'ninguna'}")
+        sys.exit(0)
+    dias = int(sys.argv[1]) if len(sys.argv) > 1 else RETENCION_DIAS
+    if dias <= 0:
+        print("Uso: python retencion.py <dias>  (o CRM_RETENCION_DIAS) | --auto-vacuum")
+        sys.exit(1)
+    resultado = ejecutar(dias)
+    print(f"Archivados {resultado['archivados']} mensajes, liberadas {resultado['paginas_liberadas']} paginas")
@@ -0,0 +1,423 @@
+"""
+Simulador de eventos discretos del flujo de leads, con reloj virtual, sobre
+una base temporal. Los leads entran por la vista real de POST /contactos
+(asignacion con puntuacion.py) y los agentes responden con la vista real de
+POST /mensajes/accion; los recordatorios salen de mensajes.py segun TIEMPOS.
+
+    python simulador.py                                   # 40 leads/dia, 5 agentes, 30 dias
+    python simulador.py --leads-dia 200 --agentes 4,6,8   # compara planteles
+    python simulador.py --tiempos espera_confirmacion=60,espera_contacto=720
+    python simulador.py --tiempos demo                    # TIEMPOS de demo (minutos)
+    python simulador.py --dias 90 --jornada 9-18 --json resultado.json
+
+Los tiempos son minutos virtuales y parten de TIEMPOS_PRODUCCION. Cada agente
+atiende un mensaje a la vez (--atencion-min), solo en su jornada, despues de
+la demora de respuesta de cada tipo de mensaje (lognormal, RESPUESTA_MIN).
+Los recordatorios tambien salen solo en la jornada.
+"""
+import heapq
+import io
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+from contextlib import redirect_stdout
+import numpy as np
+import database as db
+import mensajes
+import puntuacion
+
+MINUTOS_DIA = 24 * 60
+
+# Demora hasta que el agente puede actuar sobre cada tipo de mensaje:
+# (mediana en minutos, sigma de la lognormal). Incluye esperar al cliente
+RESPUESTA_MIN = {
+    'nuevo_lead': (15, 1.0),
+    'recordatorio_confirmacion': (10, 1.0),
+    'pedir_contacto': (240, 1.0),
+    'seguimiento': (2 * MINUTOS_DIA, 0.8)
+}
+
+# Probabilidades de cada respuesta del agente
+PROBABILIDADES = {
+    'rechazo': 0.05,        # rechaza el lead nuevo
+    'contacto': 0.7,        # logra hablar con el cliente (si no: no pudo / no contesta)
+    'cierre': 0.25,         # en negociacion: cierra
+    'perdida': 0.2          # en negociacion: lo pierde (el resto sigue negociando)
+}
+
+# Mensajes que el agente no responde (sin botones)
+SIN_ACCION = ('felicitacion',)
+
+# Estados en los que cada aviso sigue vigente; uno viejo de un lead que ya
+# avanzo (p. ej. el aviso original despues de confirmar el recordatorio) se ignora
+VIGENTE_EN = {
+    'nuevo_lead': ('Asignado',),
+    'recordatorio_confirmacion': ('Asignado',),
+    'pedir_contacto': ('Confirmado',),
+    'seguimiento': ('Contactado', 'En Negociacion')
+}
+
+# Recordatorio que se envia si un mensaje sigue pendiente: tipo -> (clave de TIEMPOS, generador)
+RECORDATORIOS = {
+    'nuevo_lead': ('espera_confirmacion', mensajes.generar_recordatorio_confirmacion),
+    'pedir_contacto': ('espera_contacto', mensajes.generar_pedir_contacto),
+    'seguimiento': ('seguimiento_negociacion', mensajes.generar_seguimiento)
+}
+
+PROPIEDADES = 50
+PERCENTILES = (50, 90, 99)
+
+
+def _leer_tiempos(texto):
+    if texto == 'demo':
+        return dict(mensajes.TIEMPOS)
+    tiempos = dict(mensajes.TIEMPOS_PRODUCCION)
+    for par in filter(None, (p.strip() for p in (texto or '').split(','))):
+        clave, _, valor = par.partition('=')
+        if clave not in tiempos:
+            raise ValueError(f"TIEMPOS no tiene '{clave}'")
+        tiempos[clave] = float(valor)
+    return tiempos
+
+
+def sembrar(agentes):
+    """Base vacia con los agentes (ids 1..agentes) y un catalogo chico."""
+    db.init_db()
+    conn = db.get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        WITH RECURSIVE s(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM s WHERE i < {agentes})
+        INSERT INTO agentes (id, nombre, email, whatsapp) SELECT i, 'Agente ' || i, '', '' FROM s
+    ''')
+    cursor.execute(f'''
+        WITH RECURSIVE s(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM s WHERE i < {PROPIEDADES})
+        INSERT INTO propiedades (id, direccion, tipo, precio, agente_id)
+        SELECT i, 'Calle ' || i, CASE i % 4 WHEN 0 THEN 'Casa' WHEN 1 THEN 'Departamento'
+                                           WHEN 2 THEN 'Terreno' ELSE 'Local Comercial' END,
+               1000000 + (i * 7919) % 14000000, 1 + i % {agentes}
+        FROM s
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def _percentiles(valores, escala=1.0):
+    if not valores:
+        return {f'p{p}': None for p in PERCENTILES}
+    return {f'p{p}': round(float(v) / escala, 2) for p, v in zip(PERCENTILES, np.percentile(valores, PERCENTILES))}
+
+
+class Simulacion:
+    """Cola de eventos (minuto virtual, secuencia, evento, datos) sobre la base temporal."""
+
+    def __init__(self, agentes, leads_dia, dias, tiempos, atencion_min=5, jornada=(9, 18), semilla=1):
+        import api
+        self.api = api
+        self.agentes = agentes
+        self.leads_dia = leads_dia
+        self.dias = dias
+        self.tiempos = tiempos
+        self.atencion_min = atencion_min
+        self.jornada = jornada
+        self.rng = np.random.default_rng(semilla)
+        self.ahora = 0.0
+        self._eventos = []
+        self._secuencia = 0
+
+        # Mensajes conocidos: id -> (agente_id, contacto_id, tipo); y el ultimo id visto
+        self.mensajes = {}
+        self._ultimo_id = {ruta: 0 for ruta in db.rutas()}
+        # Conexiones propias para las consultas del simulador (no las de la API)
+        self._conexiones = {}
+        self.colas = {}
+        self.ocupado = {}
+        self.llegada = {}
+        self.confirmado = {}
+        self.contactado = {}
+
+        self.acciones = {}
+        self.recordatorios = 0
+        self.leads = 0
+        self.diario = []
+        self.pendientes_por_tipo = {}
+
+    # Reloj y cola de eventos
+
+    def programar(self, minuto, evento, *datos):
+        self._secuencia += 1
+        heapq.heappush(self._eventos, (minuto, self._secuencia, evento, datos))
+
+    def _habil(self, minuto):
+        """Primer minuto de jornada a partir de minuto."""
+        inicio, fin = self.jornada[0] * 60, self.jornada[1] * 60
+        dia, hora = divmod(minuto, MINUTOS_DIA)
+        if inicio <= hora < fin:
+            return minuto
+        if hora >= fin:
+            dia += 1
+        return dia * MINUTOS_DIA + inicio
+
+    def _demora(self, tipo):
+        mediana, sigma = RESPUESTA_MIN.get(tipo, RESPUESTA_MIN['nuevo_lead'])
+        return float(self.rng.lognormal(math.log(mediana), sigma))
+
+    # Llamadas a la API real (sin limitador ni perfilado: se llama a la vista)
+
+    def _vista(self, vista, ruta, datos):
+        with self.api.app.test_request_context(ruta, method='POST', json=datos), redirect_stdout(io.StringIO()):
+            respuesta = self.api.app.make_response(vista.__wrapped__())
+        return respuesta.status_code, respuesta.get_json()
+
+    def _conexion(self, ruta):
+        if ruta not in self._conexiones:
+            self._conexiones[ruta] = db.get_connection(ruta)
+        return self._conexiones[ruta]
+
+    def cerrar(self):
+        for conn in self._conexiones.values():
+            conn.close()
+        self._conexiones.clear()
+
+    def _programar_recordatorio(self, mensaje_id, tipo):
+        if tipo in RECORDATORIOS:
+            minuto = self._habil(self.ahora + self.tiempos[RECORDATORIOS[tipo][0]])
+            self.programar(minuto, 'recordatorio', mensaje_id)
+
+    def _nuevos_mensajes(self):
+        """Mensajes creados desde la ultima consulta: se programa su respuesta y su recordatorio."""
+        for ruta in db.rutas():
+            filas = self._conexion(ruta).execute(
+                'SELECT id, agente_id, contacto_id, tipo FROM mensajes WHERE id > ? ORDER BY id',
+                (self._ultimo_id.get(ruta, 0),)
+            ).fetchall()
+            for mensaje_id, agente_id, contacto_id, tipo in filas:
+                self._ultimo_id[ruta] = mensaje_id
+                self.mensajes[mensaje_id] = (agente_id, contacto_id, tipo)
+                if tipo in SIN_ACCION:
+                    continue
+                self.programar(self.ahora + self._demora(tipo), 'disponible', mensaje_id)
+                self._programar_recordatorio(mensaje_id, tipo)
+
+    def _pendiente(self, mensaje_id):
+        row = self._conexion(db.ruta_para_id(mensaje_id)).execute(
+            'SELECT respondido, agente_id FROM mensajes WHERE id = ?', (mensaje_id,)
+        ).fetchone()
+        return row is not None and not row[0], row[1] if row else None
+
+    # Eventos
+
+    def llegada_lead(self):
+        self.leads += 1
+        datos = {
+            'nombre': f'Lead {self.leads}',
+            'telefono': f'77{self.leads:08d}',
+            'propiedad_id': int(self.rng.integers(1, PROPIEDADES + 1))
+        }
+        estado, contacto = self._vista(self.api.create_contacto, '/contactos', datos)
+        if estado == 201:
+            self.llegada[contacto['id']] = self.ahora
+        self._nuevos_mensajes()
+        self.programar(self.ahora + self.rng.exponential(MINUTOS_DIA / self.leads_dia), 'lead')
+
+    def disponible(self, mensaje_id):
+        agente_id = self.mensajes[mensaje_id][0]
+        self.colas.setdefault(agente_id, deque()).append(mensaje_id)
+        if not self.ocupado.get(agente_id):
+            self._atender_siguiente(agente_id)
+
+    def _atender_siguiente(self, agente_id):
+        cola = self.colas.get(agente_id)
+        if not cola:
+            self.ocupado[agente_id] = False
+            return
+        self.ocupado[agente_id] = True
+        self.programar(self._habil(self.ahora) + self.atencion_min, 'atendido', agente_id, cola.popleft())
+
+    def _decidir(self, tipo, estado):
+        if estado not in VIGENTE_EN.get(tipo, (estado,)):
+            return None
+        azar = self.rng.random()
+        if tipo in ('nuevo_lead', 'recordatorio_confirmacion'):
+            return 'rechazar_lead' if azar < PROBABILIDADES['rechazo'] else 'confirmar_recepcion'
+        if tipo == 'pedir_contacto':
+            if azar < PROBABILIDADES['contacto']:
+                return 'marcar_contactado'
+            return 'no_pudo_contactar' if self.rng.random() < 0.5 else 'cliente_no_contesta'
+        if estado != 'En Negociacion':
+            return 'marcar_negociacion'
+        if azar < PROBABILIDADES['cierre']:
+            return 'marcar_cerrado'
+        if azar < PROBABILIDADES['cierre'] + PROBABILIDADES['perdida']:
+            return 'marcar_perdido'
+        return 'marcar_negociacion'
+
+    def atendido(self, agente_id, mensaje_id):
+        pendiente, actual = self._pendiente(mensaje_id)
+        _, contacto_id, tipo = self.mensajes[mensaje_id]
+        contacto = db.get_contacto(contacto_id)
+        # Reasignado, ya respondido o de un lead que ya avanzo
+        accion = None
+        if pendiente and actual == agente_id and contacto:
+            accion = self._decidir(tipo, contacto['estado'])
+        if accion:
+            self._vista(self.api.ejecutar_accion, '/mensajes/accion',
+                        {'mensaje_id': mensaje_id, 'accion': accion, 'contacto_id': contacto_id})
+            self.acciones[accion] = self.acciones.get(accion, 0) + 1
+            if accion == 'confirmar_recepcion':
+                self.confirmado.setdefault(contacto_id, self.ahora)
+            elif accion == 'marcar_contactado':
+                self.contactado.setdefault(contacto_id, self.ahora)
+            self._nuevos_mensajes()
+        self._atender_siguiente(agente_id)
+
+    def recordatorio(self, mensaje_id):
+        pendiente, agente_id = self._pendiente(mensaje_id)
+        if not pendiente:
+            return
+        _, contacto_id, tipo = self.mensajes[mensaje_id]
+        contacto = db.get_contacto(contacto_id)
+        if not contacto or contacto['estado'] not in VIGENTE_EN[tipo]:
+            return
+        with redirect_stdout(io.StringIO()):
+            RECORDATORIOS[tipo][1](contacto, {'id': agente_id})
+        self.recordatorios += 1
+        self._nuevos_mensajes()
+        self._programar_recordatorio(mensaje_id, tipo)
+
+    def cierre_dia(self):
+        """Foto diaria: leads abiertos, bandejas (pendientes con botones) y colas de trabajo."""
+        conn = self._conexion(db.DB_PATH)
+        abiertos, cerrados, perdidos = conn.execute(f'''
+            SELECT SUM(estado NOT IN {db.ESTADOS_CERRADOS}), SUM(estado = 'Cerrado'), SUM(estado = 'Perdido')
+            FROM contactos
+        ''').fetchone()
+        bandejas = dict(conn.execute(f'''
+            SELECT agente_id, COUNT(*) FROM mensajes
+            WHERE respondido = 0 AND tipo NOT IN ({', '.join('?' * len(SIN_ACCION))})
+            GROUP BY agente_id
+        ''', SIN_ACCION).fetchall())
+        bandejas = [bandejas.get(a, 0) for a in range(1, self.agentes + 1)]
+        # Pendientes por (tipo, estado del lead): muestra los avisos que quedaron viejos
+        self.pendientes_por_tipo = {f'{tipo}/{estado}': cantidad for tipo, estado, cantidad in conn.execute('''
+            SELECT m.tipo, c.estado, COUNT(*) FROM mensajes m JOIN contactos c ON c.id = m.contacto_id
+            WHERE m.respondido = 0 GROUP BY m.tipo, c.estado ORDER BY COUNT(*) DESC
+        ''')}
+        self.diario.append({
+            'dia': int(self.ahora // MINUTOS_DIA),
+            'abiertos': abiertos or 0,
+            'cerrados': cerrados or 0,
+            'perdidos': perdidos or 0,
+            'bandeja_media': round(float(np.mean(bandejas)), 2),
+            'bandeja_max': int(max(bandejas)),
+            'cola_trabajo': sum(len(c) for c in self.colas.values())
+        })
+        # El motor de puntaje se recarga con el reloj real: aca, una vez por dia virtual
+        puntuacion.obtener_motor(forzar=True)
+        self.programar(self.ahora + MINUTOS_DIA, 'dia')
+
+    def correr(self):
+        fin = self.dias * MINUTOS_DIA
+        self.programar(self.rng.exponential(MINUTOS_DIA / self.leads_dia), 'lead')
+        self.programar(MINUTOS_DIA, 'dia')
+        manejadores = {
+            'lead': self.llegada_lead,
+            'disponible': self.disponible,
+            'atendido': self.atendido,
+            'recordatorio': self.recordatorio,
+            'dia': self.cierre_dia
+        }
+        eventos = 0
+        while self._eventos and self._eventos[0][0] <= fin:
+            self.ahora, _, evento, datos = heapq.heappop(self._eventos)
+            manejadores[evento](*datos)
+            eventos += 1
+        return eventos
+
+    def reporte(self):
+        ultimo = self.diario[-1] if self.diario else {}
+        espera_confirmacion = [self.confirmado[c] - self.llegada[c] for c in self.confirmado if c in self.llegada]
+        espera_contacto = [self.contactado[c] - self.llegada[c] for c in self.contactado if c in self.llegada]
+        return {
+            'agentes': self.agentes,
+            'leads_dia': self.leads_dia,
+            'dias': self.dias,
+            'tiempos': self.tiempos,
+            'leads': self.leads,
+            'cerrados_por_dia': round(ultimo.get('cerrados', 0) / self.dias, 2),
+            'perdidos_por_dia': round(ultimo.get('perdidos', 0) / self.dias, 2),
+            'acciones_por_dia': round(sum(self.acciones.values()) / self.dias, 2),
+            'acciones': self.acciones,
+            'recordatorios': self.recordatorios,
+            'abiertos_final': ultimo.get('abiertos', 0),
+            'abiertos_max': max((d['abiertos'] for d in self.diario), default=0),
+            'bandeja_media_final': ultimo.get('bandeja_media', 0),
+            'bandeja_max': max((d['bandeja_max'] for d in self.diario), default=0),
+            'cola_trabajo_max': max((d['cola_trabajo'] for d in self.diario), default=0),
+            'horas_a_confirmacion': _percentiles(espera_confirmacion, 60),
+            'horas_a_contacto': _percentiles(espera_contacto, 60),
+            'sin_contactar': len(self.llegada) - len(espera_contacto),
+            'pendientes_por_tipo': self.pendientes_por_tipo,
+            'diario': self.diario
+        }
+
+
+def simular(agentes, leads_dia, dias, tiempos=None, atencion_min=5, jornada=(9, 18), semilla=1):
+    """Corre una simulacion en una base temporal (en memoria compartida si existe) y retorna el reporte."""
+    ruta_original = db.DB_PATH
+    directorio = tempfile.mkdtemp(prefix='crm_sim_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    db.DB_PATH = os.path.join(directorio, 'crm.db')
+    inicio = time.perf_counter()
+    try:
+        sembrar(agentes)
+        puntuacion.obtener_motor(forzar=True)
+        simulacion = Simulacion(agentes, leads_dia, dias, tiempos or dict(mensajes.TIEMPOS_PRODUCCION),
+                                atencion_min, jornada, semilla)
+        try:
+            eventos = simulacion.correr()
+        finally:
+            simulacion.cerrar()
+        reporte = simulacion.reporte()
+    finally:
+        db.DB_PATH = ruta_original
+        shutil.rmtree(directorio, ignore_errors=True)
+    reporte['eventos'] = eventos
+    reporte['segundos'] = round(time.perf_counter() - inicio, 2)
+    return reporte
+
+
+def _argumento(nombre, defecto=None):
+    if nombre in sys.argv:
+        return sys.argv[sys.argv.index(nombre) + 1]
+    return defecto
+
+
+if __name__ == '__main__':
+    planteles = [int(a) for a in _argumento('--agentes', '5').split(',')]
+    leads_dia = float(_argumento('--leads-dia', '40'))
+    dias = int(_argumento('--dias', '30'))
+    tiempos = _leer_tiempos(_argumento('--tiempos'))
+    atencion_min = float(_argumento('--atencion-min', '5'))
+    jornada = tuple(int(h) for h in _argumento('--jornada', '9-18').split('-'))
+    semilla = int(_argumento('--semilla', '1'))
+
+    reportes = []
+    print(f"{leads_dia:g} leads/dia, {dias} dias, jornada {jornada[0]}-{jornada[1]} h, TIEMPOS {tiempos}")
+    print(f"\n{'agentes':>7} {'cerr/dia':>8} {'abiertos':>8} {'bandeja':>8} {'band.max':>8} "
+          f"{'contacto p50/p90/p99 (h)':>26} {'record.':>7} {'seg':>6}")
+    for agentes in planteles:
+        reporte = simular(agentes, leads_dia, dias, tiempos, atencion_min, jornada, semilla)
+        reportes.append(reporte)
+        contacto = '/'.join('-' if v is None else f'{v:g}' for v in reporte['horas_a_contacto'].values())
+        print(f"{agentes:>7} {reporte['cerrados_por_dia']:>8} {reporte['abiertos_final']:>8} "
+              f"{reporte['bandeja_media_final']:>8} {reporte['bandeja_max']:>8} {contacto:>26} "
+              f"{reporte['recordatorios']:>7} {reporte['segundos']:>6}")
+
+    if _argumento('--json'):
+        with open(_argumento('--json'), 'w') as f:
+            json.dump(reportes, f, indent=2)
+        print(f"\nReporte guardado en {_argumento('--json')}")
@@ -3,8 +3,11 @@ const API_URL = 'http://localhost:5000';
 // Estado global simple
 let state = {
     contactos: [],
+    contactosPorId: new Map(),
+    marcaContactos: null,
     agentes: [],
     propiedades: [],
+    propiedadesPorId: {},
     token: localStorage.getItem('crm_token') || null,
     user: JSON.parse(localStorage.getItem('crm_user') || 'null')
 };
@@ -109,8 +112,8 @@ async function init() {
     await loadData();
     setupEventListeners();
 
-    // Auto refresh cada 10s
-    setInterval(loadDashboardData, 10000);
+    // Auto refresh cada 10s (solo trae lo que cambio)
+    setInterval(refrescar, 10000);
 
     // Cargar dashboard inicial
     renderDashboard();
@@ -118,18 +121,16 @@ async function init() {
 
 async function loadData() {
     try {
-        const [resContactos, resAgentes, resPropiedades] = await Promise.all([
-            authFetch(`${API_URL}/contactos`),
-            authFetch(`${API_URL}/agentes`),
-            authFetch(`${API_URL}/propiedades`)
+        const [, resAgentes] = await Promise.all([
+            cargarContactos(),
+            authFetch(`${API_URL}/agentes`)
         ]);
 
-        state.contactos = await resContactos.json();
         state.agentes = await resAgentes.json();
-        state.propiedades = await resPropiedades.json();
 
         // Actualizar dropdowns
         updateDropdowns();
+        await cargarCatalogo();
     } catch (error) {
         console.error('Error cargando datos:', error);
     }
@@ -142,26 +143,246 @@ async function loadDashboardData() {
         const data = await res.json();
         updateDashboardMetrics(data);
 
-        // Recargar tabla completa tambien
-        const resCont = await authFetch(`${API_URL}/contactos`);
-        state.contactos = await resCont.json();
-        renderContactsTable();
+        // Solo los contactos modificados desde la ultima carga
+        const cambiaron = await cargarContactos();
+        if (cambiaron && !document.getElementById('buscar-contactos').value.trim()) {
+            renderContactsTable();
+        }
     } catch (e) {
         console.error("Error refreshing dashboard", e);
     }
 }
 
-function updateDropdowns() {
-    // Propiedades en Captura
+async function refrescar() {
+    await loadDashboardData();
+    if (!document.getElementById('agente-section').classList.contains('hidden')) {
+        const agenteId = parseInt(document.getElementById('select-agente-simulacion').value);
+        if (agenteId) cargarMensajesWhatsApp(agenteId);
+    }
+}
+
+// Columnas que usan la tabla y la vista de agente
+const CAMPOS_CONTACTOS = 'nombre,telefono,estado,agente_asignado_id,propiedad_id,fecha,fecha_actualizacion';
+
+// Respuesta ?formato=compacto: primera fila = nombres de columna
+function desdeCompacto(filas) {
+    const [columnas, ...datos] = filas;
+    return datos.map(fila => Object.fromEntries(columnas.map((c, i) => [c, fila[i]])));
+}
+
+// Trae todos los contactos la primera vez y despues solo los modificados
+// (?desde=). Retorna true si algo cambio.
+async function cargarContactos() {
+    const desde = state.marcaContactos ? `&desde=${encodeURIComponent(state.marcaContactos)}` : '';
+    const res = await authFetch(`${API_URL}/contactos?fields=${CAMPOS_CONTACTOS}&formato=compacto${desde}`);
+    const filas = desdeCompacto(await res.json());
+
+    let cambiaron = !state.marcaContactos;
+    filas.forEach(c => {
+        const anterior = state.contactosPorId.get(c.id);
+        if (!anterior || anterior.fecha_actualizacion !== c.fecha_actualizacion) {
+            state.contactosPorId.set(c.id, c);
+            cambiaron = true;
+        }
+        if (!state.marcaContactos || c.fecha_actualizacion > state.marcaContactos) {
+            state.marcaContactos = c.fecha_actualizacion;
+        }
+    });
+
+    if (cambiaron) {
+        state.contactos = [...state.contactosPorId.values()].sort(
+            (a, b) => (b.fecha || '').localeCompare(a.fecha || '') || b.id - a.id
+        );
+    }
+    return cambiaron;
+}
+
+// --- LISTAS VIRTUALES ---
+
+// Solo existen en el DOM las filas visibles (mas un margen). Cada fila se
+// identifica por su id: se reutiliza entre refrescos y solo se reescribe si
+// cambio su firma. Las alturas se miden al dibujar; las filas que aun no se
+// vieron usan altoEstimado.
+function crearListaVirtual({ contenedor, cuerpo, altoEstimado, crearFila, actualizarFila, firma, crearEspaciador, margen = 8 }) {
+    const nodos = new Map();
+    const alturas = new Map();
+    const arriba = crearEspaciador();
+    const abajo = crearEspaciador();
+    let items = [];
+    let pendiente = false;
+
+    cuerpo.replaceChildren(arriba, abajo);
+
+    function render() {
+        pendiente = false;
+
+        // Posicion acumulada de cada fila
+        const tops = new Array(items.length + 1);
+        tops[0] = 0;
+        for (let k = 0; k < items.length; k++) {
+            tops[k + 1] = tops[k] + (alturas.get(items[k].id) || altoEstimado);
+        }
+
+        const desde = contenedor.scrollTop;
+        const hasta = desde + (contenedor.clientHeight || 600);
+        let inicio = 0;
+        while (inicio < items.length && tops[inicio + 1] < desde) inicio++;
+        let fin = inicio;
+        while (fin < items.length && tops[fin] < hasta) fin++;
+        inicio = Math.max(0, inicio - margen);
+        fin = Math.min(items.length, fin + margen);
+
+        arriba.style.height = `${tops[inicio]}px`;
+        abajo.style.height = `${tops[items.length] - tops[fin]}px`;
+
+        const visibles = new Set();
+        let anterior = arriba;
+        for (let k = inicio; k < fin; k++) {
+            const item = items[k];
+            const f = firma(item);
+            let nodo = nodos.get(item.id);
+            if (!nodo) {
+                nodo = crearFila(item);
+                nodos.set(item.id, nodo);
+            } else if (nodo.dataset.firma !== f) {
+                actualizarFila(nodo, item);
+            }
+            nodo.dataset.firma = f;
+            if (anterior.nextSibling !== nodo) {
+                cuerpo.insertBefore(nodo, anterior.nextSibling);
+            }
+            anterior = nodo;
+            visibles.add(item.id);
+        }
+        for (const [id, nodo] of nodos) {
+            if (!visibles.has(id)) {
+                nodo.remove();
+                nodos.delete(id);
+            }
+        }
+
+        // Con las alturas reales corregir los espaciadores una vez
+        let cambio = false;
+        for (const [id, nodo] of nodos) {
+            const alto = nodo.offsetHeight;
+            if (alto && alturas.get(id) !== alto) {
+                alturas.set(id, alto);
+                cambio = true;
+            }
+        }
+        if (cambio) programar();
+    }
+
+    function programar() {
+        if (!pendiente) {
+            pendiente = true;
+            requestAnimationFrame(render);
+        }
+    }
+
+    contenedor.addEventListener('scroll', programar);
+
+    return {
+        setItems(nuevos, { alFinal = false } = {}) {
+            const estabaAlFinal = contenedor.scrollHeight > 0 &&
+                contenedor.scrollTop + contenedor.clientHeight >= contenedor.scrollHeight - 20;
+            items = nuevos;
+            render();
+            if (alFinal || estabaAlFinal) {
+                contenedor.scrollTop = contenedor.scrollHeight;
+                render();
+            }
+        }
+    };
+}
+
+// Rangos de precio de las facetas (mismas etiquetas que RANGOS_PRECIO en el backend;
+// 'Sin precio' se pide con sin_precio=1)
+const RANGOS_PRECIO = {
+    '0-2M': [0, 1999999],
+    '2M-5M': [2000000, 4999999],
+    '5M-10M': [5000000, 9999999],
+    '10M+': [10000000, null]
+};
+
+let timerCatalogo = null;
+
+function filtrarCatalogo() {
+    clearTimeout(timerCatalogo);
+    timerCatalogo = setTimeout(cargarCatalogo, 150);
+}
+
+async function cargarCatalogo() {
+    // Primera pagina del catalogo con los filtros de Captura
+    const params = new URLSearchParams({ limite: 50 });
+    const texto = document.getElementById('catalogo-texto').value.trim();
+    const tipo = document.getElementById('catalogo-tipo').value;
+    const precio = document.getElementById('catalogo-precio').value;
+    const rango = RANGOS_PRECIO[precio];
+    if (texto) params.set('q', texto);
+    if (tipo) params.set('tipo', tipo);
+    if (rango) {
+        params.set('precio_min', rango[0]);
+        if (rango[1] !== null) params.set('precio_max', rango[1]);
+    } else if (precio === 'Sin precio') {
+        params.set('sin_precio', 1);
+    }
+
+    try {
+        const res = await authFetch(`${API_URL}/propiedades?${params}`);
+        const data = await res.json();
+        state.propiedades = data.items;
+        data.items.forEach(p => { state.propiedadesPorId[p.id] = p; });
+        renderCatalogo(data.items);
+        renderFacetas(data.facetas);
+    } catch (err) {
+        console.error('Error cargando catalogo:', err);
+    }
+}
+
+function renderCatalogo(propiedades) {
     const propSelect = document.getElementById('propiedad');
+    const seleccionada = propSelect.value;
     propSelect.innerHTML = '<option value="">-- Sin propiedad especifica --</option>';
-    state.propiedades.forEach(p => {
+    propiedades.forEach(p => {
         const opt = document.createElement('option');
         opt.value = p.id;
-        opt.textContent = `${p.tipo} - ${p.direccion} ($${p.precio})`;
+        opt.textContent = `${p.tipo ?? 'Sin tipo'} - ${p.direccion} (${p.precio === null ? 'Sin precio' : '$' + p.precio})`;
         propSelect.appendChild(opt);
     });
+    propSelect.value = seleccionada;
+}
+
+function renderFacetas(facetas) {
+    // Conserva la seleccion actual y solo actualiza los conteos
+    const llenar = (id, valores, etiquetaTodos) => {
+        const select = document.getElementById(id);
+        const actual = select.value;
+        select.innerHTML = `<option value="">${etiquetaTodos}</option>`;
+        Object.entries(valores || {}).forEach(([valor, total]) => {
+            const opt = document.createElement('option');
+            opt.value = valor;
+            opt.textContent = `${valor} (${total})`;
+            select.appendChild(opt);
+        });
+        select.value = actual;
+    };
+    llenar('catalogo-tipo', facetas.tipo, 'Todos los tipos');
+    llenar('catalogo-precio', facetas.precio, 'Cualquier precio');
+}
 
+async function cargarPropiedadesPorId(ids) {
+    // Trae solo las propiedades que aun no estan en cache
+    const faltantes = [...new Set(ids)].filter(id => id && !state.propiedadesPorId[id]);
+    for (let i = 0; i < faltantes.length; i += 200) {
+        const lote = faltantes.slice(i, i + 200);
+        const res = await authFetch(`${API_URL}/propiedades?ids=${lote.join(',')}&limite=${lote.length}`);
+        const data = await res.json();
+        data.items.forEach(p => { state.propiedadesPorId[p.id] = p; });
+    }
+}
+
+function updateDropdowns() {
     // Agentes en Vista Agente
     const agentSelect = document.getElementById('select-agente-simulacion');
     agentSelect.innerHTML = '';
@@ -235,6 +456,7 @@ function updateDashboardMetrics(data) {
     document.getElementById('kpi-nuevos').textContent = novos_hoy_simulado(); // Simulamos "hoy" vs total
 
     document.getElementById('kpi-pendientes').textContent = nuevos;
+    document.getElementById('kpi-conversion').textContent = `${((data.tasa_conversion || 0) * 100).toFixed(1)}%`;
 
     // Listas simples para graficas
     const listEstado = document.getElementById('list-estado');
@@ -255,31 +477,95 @@ function novos_hoy_simulado() {
     return state.contactos.filter(c => c.estado === 'Nuevo').length;
 }
 
+let listaContactos = null;
+
+function crearFilaContacto(c) {
+    const tr = document.createElement('tr');
+    tr.innerHTML = `
+        <td class="px-6 py-4 whitespace-nowrap"></td>
+        <td class="px-6 py-4 whitespace-nowrap"></td>
+        <td class="px-6 py-4 whitespace-nowrap"><span></span></td>
+        <td class="px-6 py-4 whitespace-nowrap"></td>
+        <td class="px-6 py-4 whitespace-nowrap text-sm text-gray-500"></td>
+    `;
+    actualizarFilaContacto(tr, c);
+    return tr;
+}
+
+// Solo reescribe el texto de las celdas; la fila se conserva
+function actualizarFilaContacto(tr, c) {
+    const agente = state.agentes.find(a => a.id === c.agente_asignado_id);
+    const estado = tr.cells[2].firstElementChild;
+    tr.cells[0].textContent = c.nombre;
+    tr.cells[1].textContent = c.telefono;
+    estado.textContent = c.estado;
+    estado.className = `px-2 inline-flex text-xs leading-5 font-semibold rounded-full ${getEstadoColor(c.estado)}`;
+    tr.cells[3].textContent = c.agente_nombre || (agente ? agente.nombre : 'Sin asignar');
+    tr.cells[4].textContent = new Date(c.fecha).toLocaleDateString();
+}
+
+function obtenerListaContactos() {
+    if (!listaContactos) {
+        listaContactos = crearListaVirtual({
+            contenedor: document.getElementById('contactos-scroll'),
+            cuerpo: document.getElementById('table-contacts'),
+            altoEstimado: 53,
+            crearFila: crearFilaContacto,
+            actualizarFila: actualizarFilaContacto,
+            firma: c => `${c.nombre}|${c.telefono}|${c.estado}|${c.agente_asignado_id}|${c.fecha}`,
+            crearEspaciador: () => document.createElement('tr')
+        });
+    }
+    return listaContactos;
+}
+
 function renderContactsTable() {
-    const tbody = document.getElementById('table-contacts');
-    tbody.innerHTML = '';
-
-    // Mostrar ultimos 10
-    const ultimos = [...state.contactos].reverse().slice(0, 10);
-
-    ultimos.forEach(c => {
-        const agente = state.agentes.find(a => a.id === c.agente_asignado_id);
-        const tr = document.createElement('tr');
-        tr.innerHTML = `
-            <td class="px-6 py-4 whitespace-nowrap">${c.nombre}</td>
-            <td class="px-6 py-4 whitespace-nowrap">${c.telefono}</td>
-            <td class="px-6 py-4 whitespace-nowrap"><span class="px-2 inline-flex text-xs leading-5 font-semibold rounded-full bg-blue-100 text-blue-800">${c.estado}</span></td>
-            <td class="px-6 py-4 whitespace-nowrap">${agente ? agente.nombre : 'Sin asignar'}</td>
-            <td class="px-6 py-4 whitespace-nowrap text-sm text-gray-500">${new Date(c.fecha).toLocaleDateString()}</td>
-        `;
-        tbody.appendChild(tr);
-    });
+    obtenerListaContactos().setItems(state.contactos);
+}
+
+let timerBusqueda = null;
+
+function buscarContactos() {
+    // Espera a que el usuario deje de escribir antes de consultar
+    clearTimeout(timerBusqueda);
+    timerBusqueda = setTimeout(async () => {
+        const texto = document.getElementById('buscar-contactos').value.trim();
+        if (!texto) {
+            renderContactsTable();
+            return;
+        }
+        try {
+            const res = await authFetch(`${API_URL}/buscar?q=${encodeURIComponent(texto)}&limite=10`);
+            const data = await res.json();
+            renderResultadosBusqueda(data.contactos);
+        } catch (err) {
+            console.error('Error buscando contactos:', err);
+        }
+    }, 150);
+}
+
+function renderResultadosBusqueda(contactos) {
+    // Mismas filas que la tabla: las que ya estaban dibujadas se reutilizan
+    obtenerListaContactos().setItems(contactos);
 }
 
 // --- CAPTURA ---
 
+// Clave de idempotencia del formulario en curso: reintentos y doble click la reutilizan
+let claveRegistro = null;
+
+function nuevaClaveIdempotencia() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+}
+
 async function registrarContacto(e) {
     e.preventDefault();
+    if (!claveRegistro) {
+        claveRegistro = nuevaClaveIdempotencia();
+    }
     const nombre = document.getElementById('nombre').value;
     const telefono = document.getElementById('telefono').value;
     const propiedadId = document.getElementById('propiedad').value;
@@ -308,11 +594,17 @@ async function registrarContacto(e) {
     try {
         const res = await authFetch(`${API_URL}/contactos`, {
             method: 'POST',
+            headers: { 'Idempotency-Key': claveRegistro },
             body: JSON.stringify(data)
         });
 
         if (res.ok) {
-            showNotification('Contacto registrado y asignado exitosamente');
+            claveRegistro = null;
+            if (res.status === 201) {
+                showNotification('Contacto registrado y asignado exitosamente');
+            } else {
+                showNotification('El contacto ya tenia un lead abierto; no se reasigno');
+            }
             document.getElementById('form-captura').reset();
             // Resetear visibilidad de campos
             document.getElementById('asignacion-container').classList.remove('hidden');
@@ -340,31 +632,51 @@ async function cargarVistaAgente() {
     cargarLeadsAgente(agenteId);
 }
 
+// Mensajes ya cargados del agente en pantalla; los refrescos piden solo lo nuevo
+let chat = { agenteId: null, porId: new Map(), marca: null };
+let listaChat = null;
+
+function obtenerListaChat() {
+    if (!listaChat) {
+        listaChat = crearListaVirtual({
+            contenedor: document.getElementById('whatsapp-chat'),
+            cuerpo: document.getElementById('whatsapp-mensajes'),
+            altoEstimado: 90,
+            crearFila: crearMensajeWhatsApp,
+            actualizarFila: (nodo, msg) => nodo.replaceChildren(...crearMensajeWhatsApp(msg).childNodes),
+            firma: msg => `${msg.respondido}|${msg.respuesta}|${msg.contenido}|${msg.fecha}|${msg.repeticiones}`,
+            crearEspaciador: () => document.createElement('div')
+        });
+    }
+    return listaChat;
+}
+
 async function cargarMensajesWhatsApp(agenteId) {
     try {
-        const res = await authFetch(`${API_URL}/mensajes/agente/${agenteId}`);
-        const mensajes = await res.json();
-
-        const chatContainer = document.getElementById('whatsapp-chat');
-        chatContainer.innerHTML = '';
-
-        if (mensajes.length === 0) {
-            chatContainer.innerHTML = `
-                <div class="text-center text-gray-500 mt-10">
-                    <i class="fas fa-inbox text-4xl mb-2"></i>
-                    <p>No hay mensajes</p>
-                </div>
-            `;
-            return;
+        const primeraCarga = chat.agenteId !== agenteId;
+        if (primeraCarga) {
+            chat = { agenteId, porId: new Map(), marca: null };
         }
 
+        const desde = chat.marca ? `?desde=${encodeURIComponent(chat.marca)}` : '';
+        const res = await authFetch(`${API_URL}/mensajes/agente/${agenteId}${desde}`);
+        const mensajes = await res.json();
+        if (chat.agenteId !== agenteId) return;  // se cambio de agente mientras cargaba
+
         mensajes.forEach(msg => {
-            const msgEl = crearMensajeWhatsApp(msg);
-            chatContainer.appendChild(msgEl);
+            chat.porId.set(msg.id, msg);
+            const ultima = msg.fecha_respuesta && msg.fecha_respuesta > msg.fecha ? msg.fecha_respuesta : msg.fecha;
+            if (!chat.marca || ultima > chat.marca) chat.marca = ultima;
         });
+        if (!primeraCarga && mensajes.length === 0) return;
 
-        // Scroll al final
-        chatContainer.scrollTop = chatContainer.scrollHeight;
+        const ordenados = [...chat.porId.values()].sort(
+            (a, b) => (a.fecha || '').localeCompare(b.fecha || '') || a.id - b.id
+        );
+        document.getElementById('whatsapp-vacio').classList.toggle('hidden', ordenados.length > 0);
+
+        // Scroll al final al abrir el chat (y con mensajes nuevos si ya estaba al final)
+        obtenerListaChat().setItems(ordenados, { alFinal: primeraCarga });
     } catch (err) {
         console.error('Error cargando mensajes:', err);
     }
@@ -372,7 +684,7 @@ async function cargarMensajesWhatsApp(agenteId) {
 
 function crearMensajeWhatsApp(msg) {
     const div = document.createElement('div');
-    div.className = 'mb-3';
+    div.className = 'pb-3';  // padding: cuenta en offsetHeight de la lista virtual
 
     const hora = new Date(msg.fecha).toLocaleTimeString('es', { hour: '2-digit', minute: '2-digit' });
 
@@ -381,9 +693,13 @@ function crearMensajeWhatsApp(msg) {
     burbuja.className = 'bg-white rounded-lg p-3 shadow max-w-xs ml-0';
 
     // Contenido
+    // Un aviso repetido reemplaza al pendiente anterior y suma repeticiones
+    const repetido = msg.repeticiones > 1
+        ? `<span class="ml-1 px-1 rounded bg-yellow-100 text-yellow-800">x${msg.repeticiones}</span>`
+        : '';
     burbuja.innerHTML = `
         <p class="text-sm text-gray-800">${msg.contenido}</p>
-        <p class="text-xs text-gray-400 text-right mt-1">${hora}</p>
+        <p class="text-xs text-gray-400 text-right mt-1">${hora}${repetido}</p>
     `;
 
     div.appendChild(burbuja);
@@ -455,13 +771,19 @@ async function ejecutarAccionWhatsApp(mensajeId, accion, contactoId) {
     }
 }
 
-function cargarLeadsAgente(agenteId) {
+async function cargarLeadsAgente(agenteId) {
     const leads = state.contactos.filter(c =>
         c.agente_asignado_id === agenteId &&
         c.estado !== 'Cerrado' &&
         c.estado !== 'Perdido'
     );
 
+    try {
+        await cargarPropiedadesPorId(leads.map(l => l.propiedad_id));
+    } catch (err) {
+        console.error('Error cargando propiedades:', err);
+    }
+
     const lista = document.getElementById('list-agente-leads');
     lista.innerHTML = '';
 
@@ -471,7 +793,7 @@ function cargarLeadsAgente(agenteId) {
     }
 
     leads.forEach(lead => {
-        const propiedad = state.propiedades.find(p => p.id === lead.propiedad_id);
+        const propiedad = state.propiedadesPorId[lead.propiedad_id];
         const li = document.createElement('li');
         li.className = 'px-4 py-3 hover:bg-gray-50';
         li.innerHTML = `
@@ -512,6 +834,9 @@ async function cambiarEstado(id, nuevoEstado) {
             showNotification(`Estado actualizado a: ${nuevoEstado}`);
             await loadData();
             cargarVistaAgente(); // Refrescar vista actual
+        } else if (res.status === 409) {
+            const data = await res.json();
+            showNotification(`${data.error} (lead #${data.contacto_abierto_id})`);
         }
     } catch (err) {
         console.error(err);